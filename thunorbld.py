@@ -162,7 +162,8 @@ class ThunorBld(ThunorCmdHelper):
 
         # Install Python reqs
         self._log.info('Sync Python dependencies')
-        self._run_cmd(['uv', 'sync', '--frozen'])
+        self._run_cmd(['uv', 'sync', '--frozen', '--extra', 'columnar',
+                       '--extra', 'speedups'])
 
         # Build static files
         self.make_static()
@@ -256,6 +256,8 @@ class ThunorCtl(ThunorCmdHelper):
         cmd = ['python', 'manage.py', 'thunor_purge']
         if self.args.verbosity > 0:
             cmd += ['--verbosity={}'.format(self.args.verbosity)]
+        if self.args.threads > 1:
+            cmd += ['--threads={}'.format(self.args.threads)]
         if self.args.dry_run:
             cmd += ['--dry-run']
 
@@ -267,6 +269,26 @@ class ThunorCtl(ThunorCmdHelper):
 
         return self._run_cmd(cmd)
 
+    def thunorweb_warm_cache(self):
+        self._log.info('Thunor Web cache warm-up')
+        cmd = ['python', 'manage.py', 'thunor_warm_cache']
+        if self.args.verbosity > 0:
+            cmd += ['--verbosity={}'.format(self.args.verbosity)]
+        if self.args.concurrency > 1:
+            cmd += ['--concurrency={}'.format(self.args.concurrency)]
+        if self.args.time_budget is not None:
+            cmd += ['--time-budget={}'.format(self.args.time_budget)]
+        if self.args.restart:
+            cmd += ['--restart']
+
+        if not self.args.dev:
+            cmd = ['docker', 'compose',
+                   'run',
+                   '--rm',
+                   self.MAIN_CONTAINER_SERVICE] + cmd
+
+        return self._run_cmd(cmd)
+
     @property
     def _certbot_cmd(self):
         return ['docker', 'compose', '-f',
@@ -569,8 +591,32 @@ class ThunorCtl(ThunorCmdHelper):
         )
         parser_thunor_purge.add_argument('--verbosity', type=int,
                                          default=0)
+        parser_thunor_purge.add_argument(
+            '--threads', type=int, default=1,
+            help='Number of threads used to delete stale files'
+        )
         parser_thunor_purge.set_defaults(func=self.thunorweb_purge)
 
+        parser_warm_cache = subparsers.add_parser(
+            'warmcache', help='Prefill the cache with dataset groupings, '
+                              'downloads and plots'
+        )
+        parser_warm_cache.add_argument('--verbosity', type=int,
+                                       default=0)
+        parser_warm_cache.add_argument(
+            '--concurrency', type=int, default=1,
+            help='Number of datasets to warm in parallel'
+        )
+        parser_warm_cache.add_argument(
+            '--time-budget', type=float, default=None,
+            help='Stop starting new datasets after this many seconds'
+        )
+        parser_warm_cache.add_argument(
+            '--restart', action='store_true',
+            help='Warm all datasets, rather than resuming from the last run'
+        )
+        parser_warm_cache.set_defaults(func=self.thunorweb_warm_cache)
+
         parser_migrate = subparsers.add_parser(
             'migrate', help='Initialise or migrate the database')
         parser_migrate.set_defaults(func=self.migrate)
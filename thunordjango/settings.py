@@ -216,6 +216,19 @@ else:
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache'
     }
 
+# Frequently used cache entries are also kept in each process's memory.
+# Entries expire after LOCAL_CACHE_TTL seconds, and writes from other
+# processes are picked up within LOCAL_CACHE_POLL_INTERVAL seconds.
+LOCAL_CACHE_MAX_ENTRIES = int(os.environ.get(
+    'THUNOR_LOCAL_CACHE_MAX_ENTRIES', 256))
+LOCAL_CACHE_TTL = float(os.environ.get('THUNOR_LOCAL_CACHE_TTL', 300))
+LOCAL_CACHE_POLL_INTERVAL = float(os.environ.get(
+    'THUNOR_LOCAL_CACHE_POLL_INTERVAL', 1))
+# Users' object permissions are cached for this many seconds (0 disables).
+# Changes made through Thunor take effect immediately; others, like group
+# membership changes in the admin site, may take up to this long.
+PERMISSIONS_CACHE_TTL = int(os.environ.get('THUNOR_PERMISSIONS_CACHE_TTL', 30))
+
 if 'AWS_S3_SECRET_ACCESS_KEY' in os.environ:
     logger.debug('Enabling S3 storage')
     STORAGES = {
@@ -346,10 +359,45 @@ MEDIA_ROOT = os.environ.get('DJANGO_MEDIA_ROOT', os.path.join(STATE_DIR,
 MEDIA_URL = os.environ.get('DJANGO_MEDIA_URL', '/_state/thunor-files/')
 DATA_UPLOAD_MAX_NUMBER_FIELDS = int(os.environ.get(
     'DJANGO_UPLOAD_MAX_NUMBER_FIELDS', 1000))
+# Django's default upload handlers, but hashing files as they're received,
+# so re-uploaded plate files can be recognised without reading them again
+FILE_UPLOAD_HANDLERS = [
+    'thunorweb.uploadhandlers.HashingMemoryFileUploadHandler',
+    'thunorweb.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# Large plate files can be uploaded in chunks (see thunorweb.views.uploads).
+# Partial uploads are assembled in CHUNKED_UPLOAD_DIR, and removed by
+# thunor_process_uploads if unfinished after CHUNKED_UPLOAD_EXPIRY_HOURS.
+CHUNKED_UPLOAD_DIR = os.environ.get(
+    'THUNOR_CHUNKED_UPLOAD_DIR', os.path.join(STATE_DIR, 'chunked-uploads'))
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get(
+    'THUNOR_CHUNKED_UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get(
+    'THUNOR_CHUNKED_UPLOAD_MAX_SIZE', 4 * 1024 * 1024 * 1024))
+CHUNKED_UPLOAD_EXPIRY_HOURS = int(os.environ.get(
+    'THUNOR_CHUNKED_UPLOAD_EXPIRY_HOURS', 24))
+# Parse finished uploads in a background thread of the web server process.
+# thunor_process_uploads should still run periodically (the Docker image
+# runs it every 10 minutes using uwsgi's cron): it parses uploads when the
+# background thread is disabled, and requeues uploads left "processing" for
+# more than CHUNKED_UPLOAD_REQUEUE_HOURS, e.g. because the worker running
+# the thread was recycled. Set that to 0 to disable requeueing.
+CHUNKED_UPLOAD_BACKGROUND_THREAD = os.environ.get(
+    'THUNOR_CHUNKED_UPLOAD_BACKGROUND_THREAD', 'true').lower() == 'true'
+CHUNKED_UPLOAD_REQUEUE_HOURS = float(os.environ.get(
+    'THUNOR_CHUNKED_UPLOAD_REQUEUE_HOURS', 2))
 
 # These DOWNLOADS_* settings need to match nginx config unless using S3
 DOWNLOADS_PREFIX = 'downloads'
 DOWNLOADS_URL = '/_thunor_downloads/'
+# Exports are written to a temporary file before being saved to storage.
+# Files up to this size (in bytes) are kept in memory, larger ones on disk.
+DOWNLOADS_SPOOL_MAX_SIZE = int(os.environ.get(
+    'THUNOR_DOWNLOADS_SPOOL_MAX_SIZE', 8 * 1024 * 1024))
+# Number of rows formatted at a time when writing TSV exports
+DOWNLOADS_CSV_CHUNK_ROWS = int(os.environ.get(
+    'THUNOR_DOWNLOADS_CSV_CHUNK_ROWS', 10000))
 # Serve static files directly rather than through nginx
 DJANGO_SERVE_FILES_DIRECTLY = (
     os.environ.get('DJANGO_SERVE_FILES_DIRECTLY', 'false').lower() == 'true'
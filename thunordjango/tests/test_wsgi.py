@@ -1,9 +1,50 @@
-from django.test import RequestFactory, TestCase
+import json
+import os
+import subprocess
+import sys
 
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+from thunordjango.wsgi import application
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+# Includes Django setup; this takes about 2 seconds at present
+IMPORT_TIME_BUDGET_SECONDS = 5
+# Slow-to-import plotting modules which aren't needed until a plot is
+# requested. pandas and scipy aren't deferred, as the models need them
+# through thunor.io.
+DEFERRED_MODULES = ('plotly', 'thunor.plots', 'seaborn', 'matplotlib')
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
 from thunordjango.wsgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "modules": [m for m in sys.argv[1:] if m in sys.modules]
+}))
+'''
 
 
 class TestHandler(TestCase):
     def test_handles_request(self):
         rf = RequestFactory()
         application.resolve_request(rf.get("/"))
+
+
+class TestStartup(SimpleTestCase):
+    def test_import_time(self):
+        """
+        Load the WSGI application and URLconf in a fresh interpreter,
+        without importing the plotting modules
+        """
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT] + list(DEFERRED_MODULES),
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+
+        self.assertEqual(result['modules'], [])
+        self.assertLess(result['seconds'], IMPORT_TIME_BUDGET_SECONDS)
@@ -2,7 +2,8 @@ from __future__ import unicode_literals
 
 from django.apps import AppConfig
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.db.utils import OperationalError, ProgrammingError
 
 
@@ -24,6 +25,12 @@ class ThunorConfig(AppConfig):
         post_save.connect(add_to_default_group,
                           sender=settings.AUTH_USER_MODEL)
 
+        # Tag indexes include cell line and drug names
+        for model_name in ('CellLine', 'Drug'):
+            model = self.get_model(model_name)
+            post_save.connect(entity_changed, sender=model)
+            post_delete.connect(entity_changed, sender=model)
+
 
 def add_to_default_group(sender, **kwargs):
     user = kwargs["instance"]
@@ -31,3 +38,12 @@ def add_to_default_group(sender, **kwargs):
         from django.contrib.auth.models import Group
         group, _ = Group.objects.get_or_create(name='Public')
         user.groups.add(group)
+
+
+def entity_changed(sender, **kwargs):
+    # New entities aren't in any tags yet, and fixture loads (raw) don't
+    # need the cache updating
+    if kwargs.get('created') or kwargs.get('raw'):
+        return
+    from thunorweb.views.tags import invalidate_tag_index
+    transaction.on_commit(invalidate_tag_index)
@@ -0,0 +1,176 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+
+# Shared cache key holding a counter which is incremented on every write
+# through the two-tier cache. Processes poll it to discover that their local
+# copies may be out of date.
+GENERATION_CACHE_KEY = 'thunor_local_cache_generation'
+# Each write also records the key it changed under its generation number,
+# so other processes only need to drop that key
+INVALIDATION_LOG_CACHE_KEY = 'thunor_local_cache_invalidated_{:d}'
+INVALIDATION_LOG_TIMEOUT = 3600
+# Processes which have fallen further behind than this drop all their
+# entries, rather than reading the log
+INVALIDATION_LOG_MAX_READ = 1000
+
+
+class TwoTierCache(object):
+    """
+    A process-local LRU cache in front of the Django cache
+
+    Values are kept in memory for up to ``ttl`` seconds, so hot keys (like
+    dataset groupings) don't need fetching and unpickling from Redis or the
+    database cache on every request. Writes and deletes made through this
+    class increment a generation counter in the shared cache. Each process
+    checks the counter at most every ``poll_interval`` seconds, and drops
+    the keys written since it last checked. If that list is incomplete
+    (e.g. the process has been idle for a long time), all local entries are
+    dropped instead.
+
+    Values are held locally in pickled form and unpickled on each hit, so
+    callers get their own copy, which they may modify. Unpickling in memory
+    is still much cheaper than fetching from the shared cache.
+    """
+    def __init__(self, backend=None, max_entries=None, ttl=None,
+                 poll_interval=None):
+        self._backend = backend
+        self.max_entries = settings.LOCAL_CACHE_MAX_ENTRIES \
+            if max_entries is None else max_entries
+        self.ttl = settings.LOCAL_CACHE_TTL if ttl is None else ttl
+        self.poll_interval = settings.LOCAL_CACHE_POLL_INTERVAL \
+            if poll_interval is None else poll_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._next_poll = 0
+
+    @property
+    def backend(self):
+        return cache if self._backend is None else self._backend
+
+    @property
+    def enabled(self):
+        # Without a shared cache, there's no way to invalidate other
+        # processes' entries
+        return self.max_entries > 0 and self.ttl > 0 and \
+            not isinstance(self.backend, DummyCache)
+
+    def _invalidated_keys(self, from_generation, to_generation):
+        """
+        Keys written after from_generation, up to and including to_generation
+
+        Returns None if they aren't all known, so every key must be dropped.
+        """
+        if from_generation is None or to_generation is None or \
+                not 0 < to_generation - from_generation <= \
+                INVALIDATION_LOG_MAX_READ:
+            return None
+        log_keys = [INVALIDATION_LOG_CACHE_KEY.format(g) for g in
+                    range(from_generation + 1, to_generation + 1)]
+        logged = self.backend.get_many(log_keys)
+        if len(logged) != len(log_keys):
+            return None
+        return logged.values()
+
+    def _check_generation(self, now):
+        if now < self._next_poll:
+            return
+        generation = self.backend.get(GENERATION_CACHE_KEY)
+        known_generation = self._generation
+        invalidated = ()
+        if generation != known_generation:
+            invalidated = self._invalidated_keys(known_generation, generation)
+        with self._lock:
+            if self._generation != known_generation:
+                # Written by this process in the meantime, check again
+                # next time
+                return
+            if invalidated is None:
+                self._entries.clear()
+            else:
+                for key in invalidated:
+                    self._entries.pop(key, None)
+            self._generation = generation
+            self._next_poll = now + self.poll_interval
+
+    def _bump_generation(self, key):
+        self.backend.add(GENERATION_CACHE_KEY, 0, timeout=None)
+        try:
+            generation = self.backend.incr(GENERATION_CACHE_KEY)
+        except ValueError:
+            # Evicted between add() and incr()
+            generation = None
+        if generation is not None:
+            self.backend.set(INVALIDATION_LOG_CACHE_KEY.format(generation),
+                             key, timeout=INVALIDATION_LOG_TIMEOUT)
+        with self._lock:
+            if generation is None:
+                self._entries.clear()
+                self._generation = None
+            elif self._generation is not None and \
+                    generation == self._generation + 1:
+                self._generation = generation
+            # Otherwise another process has written in the meantime, and
+            # the next poll drops the keys it wrote
+
+    def _set_local(self, key, value, now):
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return self.backend.get(key, default)
+
+        now = time.monotonic()
+        self._check_generation(now)
+        pickled = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    pickled = entry[1]
+                else:
+                    del self._entries[key]
+        if pickled is not None:
+            return pickle.loads(pickled)
+
+        value = self.backend.get(key)
+        if value is None:
+            return default
+        self._set_local(key, value, now)
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout=timeout)
+        if not self.enabled:
+            return
+        self._bump_generation(key)
+        self._set_local(key, value, time.monotonic())
+
+    def delete(self, key):
+        self.backend.delete(key)
+        if not self.enabled:
+            return
+        self._bump_generation(key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear_local(self):
+        """ Drop all of this process's local entries """
+        with self._lock:
+            self._entries.clear()
+            self._next_poll = 0
+
+
+tiered_cache = TwoTierCache()
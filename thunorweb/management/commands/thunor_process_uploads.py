@@ -0,0 +1,66 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from thunorweb.models import ChunkedUpload
+from thunorweb.tasks import process_chunked_upload
+
+VERBOSE_THRESHOLD = 2
+
+
+class Command(BaseCommand):
+    help = 'Parse finished chunked plate file uploads, and remove ' \
+           'unfinished ones which have expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requeue-after', type=float, default=None,
+                            help='Also process uploads which have been '
+                                 '"processing" for longer than this many '
+                                 'hours (e.g. after a server restart). '
+                                 'Defaults to the '
+                                 'CHUNKED_UPLOAD_REQUEUE_HOURS setting; '
+                                 'use 0 to disable')
+
+    def handle(self, *args, **options):
+        verbose = int(options['verbosity']) >= VERBOSE_THRESHOLD
+        now = timezone.now()
+
+        requeue_after = options['requeue_after']
+        if requeue_after is None:
+            requeue_after = settings.CHUNKED_UPLOAD_REQUEUE_HOURS
+        if requeue_after > 0:
+            n_requeued = ChunkedUpload.objects.filter(
+                status=ChunkedUpload.STATUS_PROCESSING,
+                modified_date__lt=now - timedelta(hours=requeue_after)
+            ).update(status=ChunkedUpload.STATUS_PENDING)
+            if verbose and n_requeued:
+                self.stdout.write('Requeued {} uploads'.format(n_requeued))
+
+        num_processed = 0
+        for upload_id in ChunkedUpload.objects.filter(
+                status=ChunkedUpload.STATUS_PENDING).order_by(
+                'modified_date').values_list('id', flat=True):
+            if process_chunked_upload(upload_id):
+                num_processed += 1
+                if verbose:
+                    upload = ChunkedUpload.objects.get(id=upload_id)
+                    self.stdout.write('Processed {}'.format(upload))
+
+        expired = ChunkedUpload.objects.filter(
+            status=ChunkedUpload.STATUS_UPLOADING,
+            modified_date__lt=now - timedelta(
+                hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS))
+        num_expired = 0
+        for upload in expired:
+            try:
+                os.remove(upload.path)
+            except FileNotFoundError:
+                pass
+            upload.delete()
+            num_expired += 1
+
+        self.stdout.write('Processed {} uploads, removed {} expired '
+                          'uploads'.format(num_processed, num_expired))
@@ -1,18 +1,27 @@
 import datetime
+import itertools
 import json
 import logging
 import os
+import posixpath
 import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.admin.models import DELETION, LogEntry
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
 from django.utils import timezone
 
-from thunorweb.models import HTSDataset, PlateFile
+from thunorweb.models import CurveFit, HTSDataset, PlateFile, Well, WellDrug
+from thunorweb.partitions import drop_dataset_partitions
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +30,18 @@ VERBOSE_THRESHOLD = 2
 INFO_THRESHOLD = 1
 # One year, plus leeway for leap years/whatever
 STATIC_FILE_MAX_AGE_DAYS = 370
+# Primary key range covered by each DELETE statement when purging datasets
+PURGE_CHUNK_SIZE = 50000
+SECONDS_IN_DAY = 86400
+PLATE_FILES_DIR = 'plate-files'
+# Number of uploaded files checked against the database per query
+UPLOAD_SCAN_BATCH_SIZE = 1000
+# Maximum number of keys per S3 DeleteObjects request
+S3_DELETE_BATCH_SIZE = 1000
+
+# A file found while scanning. For local files, path is the full path; for
+# S3, it's the object key.
+ScannedFile = namedtuple('ScannedFile', 'path name size mtime')
 
 
 class Command(BaseCommand):
@@ -35,35 +56,99 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--dry-run', action='store_true',
                             help='Don\'t actually delete anything',)
+        parser.add_argument('--chunk-size', type=int,
+                            default=PURGE_CHUNK_SIZE,
+                            help='Primary key range deleted per statement '
+                                 'when purging datasets (default: '
+                                 '%(default)s)')
+        parser.add_argument('--threads', type=int, default=1,
+                            help='Number of threads used to delete local '
+                                 'files (default: %(default)s)')
 
-    def _delete_if_older_than(self, file, min_age_days, delete_callback=None,
-                              **options):
-        if not os.path.isfile(file):
-            return
-        date_cutoff = datetime.datetime.now() - datetime.timedelta(
-            days=min_age_days)
-        f_stat = os.stat(file)
-        last_mod = datetime.datetime.utcfromtimestamp(f_stat.st_mtime)
-        if last_mod > date_cutoff:
-            return
+    def _scan_local(self, directory):
+        """
+        Yield the regular files in a local directory
 
-        # Delete the file
-        size_mb = f_stat.st_size / MB_IN_BYTES
-        if int(options['verbosity']) >= VERBOSE_THRESHOLD:
-            self.stdout.write(
-                'Delete {} (last modified: {}, size: {:.2f}MiB)'.format(
-                    os.path.basename(file),
-                    last_mod.strftime('%Y-%m-%d %H:%M:%S'),
-                    size_mb
+        Uses os.scandir, so the file type comes from the directory listing
+        and each file is stat'ed at most once.
+        """
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                f_stat = entry.stat()
+                yield ScannedFile(entry.path, entry.name, f_stat.st_size,
+                                  f_stat.st_mtime)
+
+    def _scan_s3(self, prefix):
+        """
+        Yield the files under a prefix in S3 storage
+
+        Sizes and modification times come from the bucket listing itself,
+        rather than a HEAD request per object.
+        """
+        key_prefix = posixpath.join(default_storage.location, prefix, '')
+        for obj in default_storage.bucket.objects.filter(Prefix=key_prefix):
+            yield ScannedFile(obj.key, posixpath.basename(obj.key), obj.size,
+                              obj.last_modified.timestamp())
+
+    def _delete_files(self, files, min_age_days, s3=False,
+                      delete_callback=None, **options):
+        """
+        Delete the files which are older than min_age_days
+
+        Parameters
+        ----------
+        files: iterable of ScannedFile
+            Candidate files for deletion
+        min_age_days: int
+            Only delete files last modified longer ago than this
+        s3: bool
+            Files are in S3 storage, rather than on the local filesystem
+        delete_callback: callable or None
+            Called with each ScannedFile after it has been deleted
+        """
+        mtime_cutoff = time.time() - min_age_days * SECONDS_IN_DAY
+        to_delete = []
+        for file in files:
+            if file.mtime > mtime_cutoff:
+                continue
+
+            size_mb = file.size / MB_IN_BYTES
+            if int(options['verbosity']) >= VERBOSE_THRESHOLD:
+                self.stdout.write(
+                    'Delete {} (last modified: {}, size: {:.2f}MiB)'.format(
+                        file.name,
+                        datetime.datetime.fromtimestamp(
+                            file.mtime, datetime.timezone.utc
+                        ).strftime('%Y-%m-%d %H:%M:%S'),
+                        size_mb
+                    )
                 )
-            )
-        self.size_deleted += size_mb
-        self.num_deleted += 1
+            self.size_deleted += size_mb
+            self.num_deleted += 1
+            to_delete.append(file)
 
-        if not options['dry_run']:
-            os.unlink(file)
-            if delete_callback is not None:
-                delete_callback()
+        if options['dry_run'] or not to_delete:
+            return
+
+        if s3:
+            for i in range(0, len(to_delete), S3_DELETE_BATCH_SIZE):
+                default_storage.bucket.delete_objects(Delete={'Objects': [
+                    {'Key': f.path}
+                    for f in to_delete[i:i + S3_DELETE_BATCH_SIZE]
+                ]})
+        elif options['threads'] > 1:
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                # Consume the iterator to raise any exceptions
+                list(pool.map(os.unlink, (f.path for f in to_delete)))
+        else:
+            for f in to_delete:
+                os.unlink(f.path)
+
+        if delete_callback is not None:
+            for f in to_delete:
+                delete_callback(f)
 
     def _delete_old_bundles(self, *args, **options):
         stats_file = settings.WEBPACK_LOADER['DEFAULT']['STATS_FILE']
@@ -74,25 +159,102 @@ class Command(BaseCommand):
             sys.stderr.write('Webpack bundle status is not "done"')
             sys.exit(1)
 
-        files = [v['name'] for f in stats['chunks'].values() for v in f]
-        files += os.path.basename(stats_file)
+        files = set(v['name'] for f in stats['chunks'].values() for v in f)
+        files.add(os.path.basename(stats_file))
 
         # Clean up build files
         if int(options['verbosity']) > INFO_THRESHOLD:
             sys.stdout.write('Delete old webpack build files\n')
         for dir in settings.STATICFILES_DIRS:
-            for file in os.listdir(dir):
-                if file in files:
-                    continue
-                f = os.path.join(dir, file)
-                self._delete_if_older_than(f, 0, **options)
+            self._delete_files(
+                (f for f in self._scan_local(dir) if f.name not in files),
+                0, **options)
 
         # Clean up static files
         if int(options['verbosity']) > INFO_THRESHOLD:
             sys.stdout.write('Delete old static files\n')
-        for file in os.listdir(settings.STATIC_ROOT):
-            f = os.path.join(settings.STATIC_ROOT, file)
-            self._delete_if_older_than(f, STATIC_FILE_MAX_AGE_DAYS, **options)
+        self._delete_files(self._scan_local(settings.STATIC_ROOT),
+                           STATIC_FILE_MAX_AGE_DAYS, **options)
+
+    def _stale_uploads(self, files):
+        """
+        Filter out files attached to a PlateFile
+
+        Membership is checked against the database in batches, so the full
+        set of plate file names is never held in memory.
+        """
+        for batch in itertools.batched(files, UPLOAD_SCAN_BATCH_SIZE):
+            names = {'{}/{}'.format(PLATE_FILES_DIR, f.name): f
+                     for f in batch}
+            in_use = set(PlateFile.objects.filter(
+                file__in=names.keys()).values_list('file', flat=True))
+            for name, f in names.items():
+                if name not in in_use:
+                    yield f
+
+    def _delete_in_chunks(self, queryset, **options):
+        """
+        Delete the rows matched by queryset using bulk DELETE statements
+
+        Unlike QuerySet.delete(), this doesn't load the rows (or related
+        rows) into memory. Each statement covers a bounded primary key range
+        and is committed separately, so callers must delete dependent tables
+        first.
+        """
+        model = queryset.model
+        bounds = queryset.aggregate(lo=Min('pk'), hi=Max('pk'))
+        if bounds['lo'] is None:
+            return 0
+
+        qn = connection.ops.quote_name
+        delete_sql = 'DELETE FROM {} WHERE {} IN ({{}})'.format(
+            qn(model._meta.db_table), qn(model._meta.pk.column))
+        chunk_size = options['chunk_size']
+        num_deleted = 0
+        for chunk_start in range(bounds['lo'], bounds['hi'] + 1, chunk_size):
+            chunk = queryset.filter(
+                pk__gte=chunk_start, pk__lt=chunk_start + chunk_size
+            ).values('pk')
+            sql, params = chunk.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(delete_sql.format(sql), params)
+                num_deleted += cursor.rowcount
+            if int(options['verbosity']) > VERBOSE_THRESHOLD:
+                self.stdout.write('  {}: {} rows deleted so far'.format(
+                    model.__name__, num_deleted))
+
+        return num_deleted
+
+    def _purge_dataset(self, dataset, **options):
+        """ Delete a dataset and its related objects in dependency order """
+        start_time = time.monotonic()
+        verbose = int(options['verbosity']) >= VERBOSE_THRESHOLD
+
+        # Dropping the partitions removes the bulk of the dataset's
+        # rows without the ORM cascade visiting each one
+        for partition in drop_dataset_partitions(dataset.id):
+            if verbose:
+                self.stdout.write('  Dropped partition {}'.format(partition))
+
+        for queryset in (
+            WellDrug.objects.filter(well__plate__dataset_id=dataset.id),
+            Well.objects.filter(plate__dataset_id=dataset.id),
+            CurveFit.objects.filter(fit_set__dataset_id=dataset.id)
+        ):
+            table_start_time = time.monotonic()
+            num_deleted = self._delete_in_chunks(queryset, **options)
+            if verbose:
+                self.stdout.write('  {}: deleted {} rows in {:.1f}s'.format(
+                    queryset.model.__name__, num_deleted,
+                    time.monotonic() - table_start_time))
+
+        # The remaining related objects (plates, files, permissions etc.) are
+        # few in number, so let the ORM cascade handle them
+        dataset.delete()
+
+        if verbose:
+            self.stdout.write('  Dataset removed in {:.1f}s'.format(
+                time.monotonic() - start_time))
 
     def handle(self, *args, **options):
         ct = ContentType.objects.get_for_model(HTSDataset)
@@ -124,36 +286,41 @@ class Command(BaseCommand):
                 action_flag=DELETION,
                 change_message='Dataset removed after retention time elapsed'
             )
-            d.delete()
+            self._purge_dataset(d, **options)
 
         # Delete uploaded files not attached to a dataset, if old enough
         if int(options['verbosity']) > INFO_THRESHOLD:
             sys.stdout.write('Delete stale uploads\n')
 
-        plate_files_dir = os.path.join(settings.MEDIA_ROOT, 'plate-files')
+        s3 = default_storage.__class__.__name__ == "S3Storage"
+        if s3:
+            uploads = self._scan_s3(PLATE_FILES_DIR)
+        else:
+            uploads = self._scan_local(
+                os.path.join(settings.MEDIA_ROOT, PLATE_FILES_DIR))
 
-        plate_file_paths = set(pf.file.path for pf in PlateFile.objects.all())
         ct_platefile = ContentType.objects.get_for_model(PlateFile)
 
-        for f_name in os.listdir(plate_files_dir):
-            f = os.path.join(plate_files_dir, f_name)
-            if f in plate_file_paths:
-                continue
-
-            def delete_callback():
-                LogEntry.objects.log_action(
-                    user_id=user_id,
-                    content_type_id=ct_platefile.id,
-                    object_id=None,
-                    object_repr=f,
-                    action_flag=DELETION,
-                    change_message='Plate file deleted after retention '
-                                   'time elapsed'
-                )
-            self._delete_if_older_than(f,
-                                       settings.NON_DATASET_UPLOAD_RETENTION_DAYS,
-                                       delete_callback=delete_callback,
-                                       **options)
+        def delete_callback(f):
+            LogEntry.objects.log_action(
+                user_id=user_id,
+                content_type_id=ct_platefile.id,
+                object_id=None,
+                object_repr=f.path,
+                action_flag=DELETION,
+                change_message='Plate file deleted after retention '
+                               'time elapsed'
+            )
+        for batch in itertools.batched(self._stale_uploads(uploads),
+                                       UPLOAD_SCAN_BATCH_SIZE):
+            # Check again with the stored files locked, as an upload may
+            # have reused one of them since the first check
+            with transaction.atomic():
+                PlateFile.lock_stored_files(exclusive=True)
+                self._delete_files(
+                    self._stale_uploads(batch),
+                    settings.NON_DATASET_UPLOAD_RETENTION_DAYS,
+                    s3=s3, delete_callback=delete_callback, **options)
 
         self.stdout.write('Deleted {} files, total size {:.2f}MiB'.format(
             self.num_deleted, self.size_deleted))
@@ -0,0 +1,60 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from thunorweb.models import HTSDataset
+from thunorweb.plate_parsers import PlateFileParser
+
+
+class Command(BaseCommand):
+    help = 'Check plate files can be imported, reporting all problems, ' \
+           'without saving anything to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', metavar='file',
+                            help='Plate file(s) to check')
+        parser.add_argument('--dataset-id', type=int, default=None,
+                            help='Also check plate names against this '
+                                 'existing dataset')
+
+    def handle(self, *args, **options):
+        dataset = None
+        if options['dataset_id'] is not None:
+            try:
+                dataset = HTSDataset.objects.get(id=options['dataset_id'],
+                                                 deleted_date=None)
+            except HTSDataset.DoesNotExist:
+                raise CommandError('Dataset {} does not exist'.format(
+                    options['dataset_id']))
+
+        plate_files = []
+        try:
+            for path in options['files']:
+                try:
+                    plate_files.append(File(open(path, 'rb'),
+                                            name=os.path.basename(path)))
+                except OSError as e:
+                    raise CommandError('Unable to open {}: {}'.format(
+                        path, e.strerror))
+
+            results = PlateFileParser(plate_files, dataset=dataset,
+                                      validate_only=True).parse_all()
+        finally:
+            for f in plate_files:
+                f.close()
+
+        num_invalid = 0
+        for path, res in zip(options['files'], results):
+            if res['success']:
+                self.stdout.write('{}: OK ({})'.format(
+                    path, res['file_format']))
+                continue
+            num_invalid += 1
+            self.stdout.write('{}:'.format(path))
+            for problem in res['problems']:
+                self.stdout.write('  ' + problem)
+
+        if num_invalid:
+            raise CommandError('{} of {} files are invalid'.format(
+                num_invalid, len(results)))
@@ -0,0 +1,131 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import F
+from django.http import HttpResponse
+
+from thunorweb.models import HTSDataset
+from thunorweb.pandas import NoDataException, dataset_curve_fits
+from thunorweb.tasks import dataset_groupings
+from thunorweb.views.plots import ctrl_cell_counts_plot
+
+VERBOSE_THRESHOLD = 2
+# Records which datasets have been warmed, and at which modification date.
+# Kept in the cache itself, so it's lost whenever the warmed entries are.
+WARM_STATE_CACHE_KEY = 'thunor_warm_cache_state'
+
+
+class Command(BaseCommand):
+    help = 'Prefill the cache with dataset groupings, curve fits and ' \
+           'plots, most recently viewed datasets first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of datasets to warm in parallel '
+                                 '(default: %(default)s)')
+        parser.add_argument('--time-budget', type=float, default=None,
+                            help='Don\'t start warming any more datasets '
+                                 'after this many seconds')
+        parser.add_argument('--restart', action='store_true',
+                            help='Warm all datasets, rather than resuming '
+                                 'from the last run')
+        parser.add_argument('--regenerate', action='store_true',
+                            help='Regenerate cached entries even if they '
+                                 'are up to date (implies --restart)')
+        parser.add_argument('--datasets', type=int, nargs='+',
+                            help='Only warm these dataset IDs')
+
+    def _warm_dataset(self, dataset, regenerate=False):
+        """ Warm the caches for a dataset, returns the names of those warmed """
+        warmed = []
+        try:
+            groupings = dataset_groupings(dataset,
+                                          regenerate_cache=regenerate)
+            warmed.append('groupings')
+            single_timepoint = groupings['singleTimepoint'] is not False
+
+            stat_types = ['viability']
+            if not single_timepoint:
+                stat_types.append('dip')
+            for stat_type in stat_types:
+                try:
+                    dataset_curve_fits(dataset, stat_type,
+                                       regenerate_cache=regenerate)
+                except NoDataException:
+                    continue
+                warmed.append('{}_curve_fits'.format(stat_type))
+
+            if single_timepoint and not isinstance(
+                    ctrl_cell_counts_plot(dataset,
+                                          regenerate_cache=regenerate),
+                    HttpResponse):
+                warmed.append('ctrlcellbox')
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+        return warmed
+
+    def handle(self, *args, **options):
+        verbose = int(options['verbosity']) >= VERBOSE_THRESHOLD
+        start_time = time.monotonic()
+        deadline = None
+        if options['time_budget'] is not None:
+            deadline = start_time + options['time_budget']
+
+        resume = not (options['restart'] or options['regenerate'])
+        state = (cache.get(WARM_STATE_CACHE_KEY) if resume else None) or {}
+
+        # Datasets which have never been viewed go last
+        datasets = HTSDataset.objects.filter(deleted_date=None).order_by(
+            F('last_viewed').desc(nulls_last=True), '-modified_date')
+        if options['datasets']:
+            datasets = datasets.filter(id__in=options['datasets'])
+        datasets = list(datasets)
+        num_total = len(datasets)
+        # Datasets modified since they were warmed need warming again
+        datasets = [d for d in datasets
+                    if state.get(d.id) != d.modified_date]
+        if verbose and len(datasets) < num_total:
+            self.stdout.write('Resuming: {} datasets already warmed'.format(
+                num_total - len(datasets)))
+
+        def warm(dataset):
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            return self._warm_dataset(dataset,
+                                      regenerate=options['regenerate'])
+
+        num_warmed = 0
+        num_failed = 0
+        with ThreadPoolExecutor(
+                max_workers=max(options['concurrency'], 1)) as pool:
+            futures = {pool.submit(warm, d): d for d in datasets}
+            for future in as_completed(futures):
+                dataset = futures[future]
+                try:
+                    warmed = future.result()
+                except Exception as e:
+                    num_failed += 1
+                    self.stderr.write('Dataset {} failed: {}'.format(
+                        dataset.id, e))
+                    continue
+                if warmed is None:
+                    continue
+
+                num_warmed += 1
+                state[dataset.id] = dataset.modified_date
+                cache.set(WARM_STATE_CACHE_KEY, state, timeout=None)
+                if verbose:
+                    self.stdout.write('Warmed dataset {} ({}): {}'.format(
+                        dataset.id, dataset.name, ', '.join(warmed)))
+
+        num_remaining = len(datasets) - num_warmed - num_failed
+        self.stdout.write(
+            'Warmed {} datasets in {:.1f}s ({} failed, {} not started '
+            'within the time budget)'.format(
+                num_warmed, time.monotonic() - start_time, num_failed,
+                num_remaining))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Convert WellMeasurement and WellStatistic into PostgreSQL LIST partitioned
+tables, with one partition per dataset plus a DEFAULT partition.
+
+Each table is rebuilt: the existing table is renamed, a partitioned
+replacement is created (with a dataset_id column populated from
+well -> plate -> dataset), partitions are created for every existing
+dataset, the rows are copied across and the old table is dropped. On large
+installations this copies every row, so allow for a maintenance window.
+
+PostgreSQL requires the partition key to be part of every unique
+constraint, so dataset_id is appended to them, and the primary key becomes
+(id, dataset_id). The state operations describe the same schema to Django.
+"""
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _partition_sql(table, columns, unique_cols):
+    """ SQL to convert table into a partitioned table """
+    col_names = ', '.join(c[0] for c in columns)
+    col_defs = ',\n    '.join('{} {}'.format(*c) for c in columns)
+    seq = '{}_part_id_seq'.format(table)
+    return """
+ALTER TABLE {table} RENAME TO {table}_unpartitioned;
+
+CREATE SEQUENCE {seq};
+SELECT setval('{seq}',
+              COALESCE((SELECT MAX(id) FROM {table}_unpartitioned), 0) + 1,
+              false);
+
+CREATE TABLE {table} (
+    id integer NOT NULL DEFAULT nextval('{seq}'),
+    dataset_id integer NOT NULL,
+    {col_defs},
+    PRIMARY KEY (id, dataset_id),
+    UNIQUE ({unique_cols}, dataset_id),
+    FOREIGN KEY (dataset_id) REFERENCES thunorweb_htsdataset (id)
+        DEFERRABLE INITIALLY DEFERRED,
+    FOREIGN KEY (well_id) REFERENCES thunorweb_well (id)
+        DEFERRABLE INITIALLY DEFERRED
+) PARTITION BY LIST (dataset_id);
+
+ALTER SEQUENCE {seq} OWNED BY {table}.id;
+
+CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;
+
+DO $$
+DECLARE d integer;
+BEGIN
+    FOR d IN SELECT id FROM thunorweb_htsdataset LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF {table} '
+                       'FOR VALUES IN (%s)', '{table}_d' || d, d);
+    END LOOP;
+END $$;
+
+INSERT INTO {table} (id, dataset_id, {col_names})
+SELECT t.id, p.dataset_id, {t_col_names}
+FROM {table}_unpartitioned t
+JOIN thunorweb_well w ON w.id = t.well_id
+JOIN thunorweb_plate p ON p.id = w.plate_id;
+
+DROP TABLE {table}_unpartitioned;
+""".format(table=table, seq=seq, col_defs=col_defs, col_names=col_names,
+           t_col_names=', '.join('t.' + c[0] for c in columns),
+           unique_cols=', '.join(unique_cols))
+
+
+def _unpartition_sql(table, columns, unique_cols):
+    """ SQL to convert a partitioned table back into a regular table """
+    col_names = ', '.join(c[0] for c in columns)
+    col_defs = ',\n    '.join('{} {}'.format(*c) for c in columns)
+    return """
+CREATE TABLE {table}_unpartitioned (
+    id serial PRIMARY KEY,
+    {col_defs},
+    UNIQUE ({unique_cols}),
+    FOREIGN KEY (well_id) REFERENCES thunorweb_well (id)
+        DEFERRABLE INITIALLY DEFERRED
+);
+
+INSERT INTO {table}_unpartitioned (id, {col_names})
+SELECT id, {col_names} FROM {table};
+
+SELECT setval(pg_get_serial_sequence('{table}_unpartitioned', 'id'),
+              COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false);
+
+DROP TABLE {table};
+
+ALTER TABLE {table}_unpartitioned RENAME TO {table};
+""".format(table=table, col_defs=col_defs, col_names=col_names,
+           unique_cols=', '.join(unique_cols))
+
+
+WELLMEASUREMENT_COLS = (
+    ('well_id', 'integer NOT NULL'),
+    ('assay', 'text NOT NULL'),
+    ('timepoint', 'interval NOT NULL'),
+    ('value', 'double precision NULL'),
+)
+WELLMEASUREMENT_UNIQUE = ('well_id', 'assay', 'timepoint')
+
+WELLSTATISTIC_COLS = (
+    ('well_id', 'integer NOT NULL'),
+    ('stat_name', 'text NOT NULL'),
+    ('stat_date', 'timestamp with time zone NOT NULL'),
+    ('value', 'double precision NULL'),
+)
+WELLSTATISTIC_UNIQUE = ('well_id', 'stat_name')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thunorweb', '0015_dataset_lics'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='wellmeasurement',
+                    name='dataset',
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='thunorweb.htsdataset'),
+                    preserve_default=False,
+                ),
+                migrations.AddField(
+                    model_name='wellstatistic',
+                    name='dataset',
+                    field=models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to='thunorweb.htsdataset'),
+                    preserve_default=False,
+                ),
+                migrations.AlterUniqueTogether(
+                    name='wellmeasurement',
+                    unique_together={('well', 'assay', 'timepoint',
+                                      'dataset')},
+                ),
+                migrations.AlterUniqueTogether(
+                    name='wellstatistic',
+                    unique_together={('well', 'stat_name', 'dataset')},
+                ),
+                migrations.AddField(
+                    model_name='wellmeasurement',
+                    name='pk',
+                    field=models.CompositePrimaryKey(
+                        'id', 'dataset', blank=True, editable=False,
+                        primary_key=True, serialize=False),
+                ),
+                migrations.AddField(
+                    model_name='wellstatistic',
+                    name='pk',
+                    field=models.CompositePrimaryKey(
+                        'id', 'dataset', blank=True, editable=False,
+                        primary_key=True, serialize=False),
+                ),
+                migrations.AlterField(
+                    model_name='wellmeasurement',
+                    name='id',
+                    field=models.IntegerField(db_default=models.Func(
+                        models.Value('thunorweb_wellmeasurement_part_id_seq'),
+                        function='nextval',
+                        output_field=models.IntegerField())),
+                ),
+                migrations.AlterField(
+                    model_name='wellstatistic',
+                    name='id',
+                    field=models.IntegerField(db_default=models.Func(
+                        models.Value('thunorweb_wellstatistic_part_id_seq'),
+                        function='nextval',
+                        output_field=models.IntegerField())),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    _partition_sql('thunorweb_wellmeasurement',
+                                   WELLMEASUREMENT_COLS,
+                                   WELLMEASUREMENT_UNIQUE),
+                    _unpartition_sql('thunorweb_wellmeasurement',
+                                     WELLMEASUREMENT_COLS,
+                                     WELLMEASUREMENT_UNIQUE)
+                ),
+                migrations.RunSQL(
+                    _partition_sql('thunorweb_wellstatistic',
+                                   WELLSTATISTIC_COLS,
+                                   WELLSTATISTIC_UNIQUE),
+                    _unpartition_sql('thunorweb_wellstatistic',
+                                     WELLSTATISTIC_COLS,
+                                     WELLSTATISTIC_UNIQUE)
+                ),
+            ]
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thunorweb', '0016_partition_wellmeasurement_wellstatistic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='curvefit',
+            name='ic50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='ec50',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='emax',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='emax_rel',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='emax_obs_rel',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='einf',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='aa',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='curvefit',
+            name='hill',
+            field=models.FloatField(null=True),
+        ),
+    ]
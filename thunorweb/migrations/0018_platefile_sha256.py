@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thunorweb', '0017_curvefit_standard_params'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='platefile',
+            name='file_name',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='platefile',
+            name='sha256',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
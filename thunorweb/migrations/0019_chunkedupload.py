@@ -0,0 +1,31 @@
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thunorweb', '0018_platefile_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False,
+                                        primary_key=True, serialize=False)),
+                ('file_name', models.TextField()),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('status', models.TextField(default='uploading')),
+                ('result', models.JSONField(null=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('modified_date', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='thunorweb.htsdataset')),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thunorweb', '0019_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='curvefit',
+            name='aa_warning',
+            field=models.TextField(null=True),
+        ),
+    ]
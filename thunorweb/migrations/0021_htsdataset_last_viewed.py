@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thunorweb', '0020_curvefit_aa_warning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htsdataset',
+            name='last_viewed',
+            field=models.DateTimeField(default=None, editable=False, null=True),
+        ),
+    ]
@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
+import os
+import uuid
+
 from django.conf import settings
-from django.db import models
+from django.db import connection, models
 from guardian.models import GroupObjectPermissionBase, UserObjectPermissionBase
 from thunor.io import PlateMap
 
@@ -22,6 +25,10 @@ class HTSDataset(models.Model):
     modified_date = models.DateTimeField(auto_now=True)
     deleted_date = models.DateTimeField(null=True, default=None,
                                         editable=False)
+    # When the dataset page was last viewed, updated at most once every
+    # LAST_VIEWED_RESOLUTION (see views.datasets)
+    last_viewed = models.DateTimeField(null=True, default=None,
+                                       editable=False)
     creator = models.TextField(null=True)
     license_text = models.TextField(null=True)
 
@@ -56,14 +63,73 @@ class HTSDatasetGroupObjectPermission(GroupObjectPermissionBase):
     content_object = models.ForeignKey(HTSDataset, on_delete=models.CASCADE)
 
 
+# PostgreSQL advisory lock key guarding stored plate files (see
+# PlateFile.lock_stored_files)
+PLATE_FILE_STORAGE_LOCK = 0x74686e7266696c65
+
+
 class PlateFile(models.Model):
     dataset = models.ForeignKey(HTSDataset, on_delete=models.CASCADE)
     upload_date = models.DateTimeField(auto_now_add=True)
+    # Files are stored under their SHA-256, so identical uploads share one
+    # stored file. It's kept while any PlateFile refers to it (see
+    # thunor_purge).
     file = models.FileField(upload_to='plate-files')
     file_format = models.TextField(null=True)
+    file_name = models.TextField(null=True)
+    sha256 = models.CharField(max_length=64, null=True, db_index=True)
 
     def __str__(self):
-        return '%s' % self.file.name
+        return '%s' % (self.file_name or self.file.name)
+
+    @staticmethod
+    def lock_stored_files(exclusive=False):
+        """
+        Lock the stored plate files until the current transaction ends
+
+        Uploads take a shared lock before reusing a stored file, and
+        thunor_purge takes an exclusive one to check a file is unused and
+        delete it. Once the purge has the lock, any upload which reused a
+        file has committed, so its PlateFile is visible.
+
+        Parameters
+        ----------
+        exclusive: bool
+            Take an exclusive lock, rather than a shared one
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock{}(%s)'.format(
+                    '' if exclusive else '_shared'),
+                [PLATE_FILE_STORAGE_LOCK])
+
+
+class ChunkedUpload(models.Model):
+    """ A plate file being uploaded in chunks, then parsed in the background """
+    STATUS_UPLOADING = 'uploading'
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4,
+                          editable=False)
+    dataset = models.ForeignKey(HTSDataset, on_delete=models.CASCADE)
+    file_name = models.TextField()
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    status = models.TextField(default=STATUS_UPLOADING)
+    result = models.JSONField(null=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    modified_date = models.DateTimeField(auto_now=True)
+
+    @property
+    def path(self):
+        """ Local path the chunks are assembled in """
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, self.id.hex)
+
+    def __str__(self):
+        return '%s (%s)' % (self.file_name, self.status)
 
 
 class CellLine(models.Model):
@@ -150,10 +216,29 @@ class Well(models.Model):
     cell_line = models.ForeignKey(CellLine, null=True, on_delete=models.CASCADE)
 
 
+# Note about partitioning: WellMeasurement and WellStatistic are LIST
+# partitioned by dataset in PostgreSQL (see migration 0016 and
+# thunorweb.partitions). The dataset column duplicates well__plate__dataset,
+# but lets per-dataset queries use partition pruning and lets a dataset's rows
+# be dropped with its partition. PostgreSQL requires the partition key in
+# every unique constraint, so the primary key is (id, dataset), with id
+# generated from a sequence shared by all partitions.
+
+
+def _partition_id_default(table):
+    return models.Func(models.Value('{}_part_id_seq'.format(table)),
+                       function='nextval', output_field=models.IntegerField())
+
+
 class WellMeasurement(models.Model):
     class Meta:
-        unique_together = (("well", "assay", "timepoint"), )
+        unique_together = (("well", "assay", "timepoint", "dataset"), )
 
+    pk = models.CompositePrimaryKey('id', 'dataset')
+    id = models.IntegerField(
+        db_default=_partition_id_default('thunorweb_wellmeasurement'))
+    dataset = models.ForeignKey(HTSDataset, db_index=False,
+                                on_delete=models.CASCADE)
     well = models.ForeignKey(Well, db_index=False, on_delete=models.CASCADE)
     assay = models.TextField()
     timepoint = models.DurationField()
@@ -178,8 +263,13 @@ class WellDrug(models.Model):
 
 class WellStatistic(models.Model):
     class Meta:
-        unique_together = (('well', 'stat_name'), )
+        unique_together = (('well', 'stat_name', 'dataset'), )
 
+    pk = models.CompositePrimaryKey('id', 'dataset')
+    id = models.IntegerField(
+        db_default=_partition_id_default('thunorweb_wellstatistic'))
+    dataset = models.ForeignKey(HTSDataset, db_index=False,
+                                on_delete=models.CASCADE)
     well = models.ForeignKey(Well, on_delete=models.CASCADE)
     stat_name = models.TextField()
     stat_date = models.DateTimeField(auto_now=True)
@@ -214,6 +304,18 @@ class CurveFit(models.Model):
     min_dose = models.FloatField()
     emax_obs = models.FloatField()
     aa_obs = models.FloatField(null=True)
+    # Standard parameters, precomputed when the curve is fitted. Fits made
+    # before these were added have them set to null.
+    ic50 = models.FloatField(null=True)
+    ec50 = models.FloatField(null=True)
+    emax = models.FloatField(null=True)
+    emax_rel = models.FloatField(null=True)
+    emax_obs_rel = models.FloatField(null=True)
+    einf = models.FloatField(null=True)
+    aa = models.FloatField(null=True)
+    hill = models.FloatField(null=True)
+    # Message of any AAFitWarning raised when calculating aa
+    aa_warning = models.TextField(null=True)
 
 
 class HTSDatasetFile(models.Model):
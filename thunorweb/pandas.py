@@ -2,14 +2,22 @@ import pickle
 from collections.abc import Iterable
 from datetime import timedelta
 
+import numpy as np
 import pandas as pd
 import thunor.curve_fit
-from django.core.cache import cache
 from django.db.models import Count, F, Max, Sum
 from django.db.models.functions import Coalesce
 from thunor.io import HtsPandas
 
-from .models import CurveFit, Well, WellDrug, WellMeasurement, WellStatistic
+from .caching import tiered_cache
+from .models import (
+    CurveFit,
+    CurveFitSet,
+    Well,
+    WellDrug,
+    WellMeasurement,
+    WellStatistic,
+)
 
 
 class NoDataException(Exception):
@@ -17,6 +25,15 @@ class NoDataException(Exception):
 
 
 DIP_STATS = ('dip_rate', 'dip_fit_std_err')
+# Fit parameters stored on each CurveFit when it's calculated
+STANDARD_FIT_PARAMS = ('ic50', 'ec50', 'emax', 'emax_rel', 'emax_obs_rel',
+                       'einf', 'aa', 'hill')
+# Parameters only applicable to DIP rate fits
+DIP_ONLY_FIT_PARAMS = ('emax_rel', 'emax_obs_rel')
+# Curve fits made with this fit protocol version or later have the standard
+# parameters, and any activity area fit warning, stored
+STANDARD_FIT_PARAMS_PROTOCOL = 3
+TIMECOURSE_DOWNSAMPLE_METHODS = ('lttb', 'minmax')
 
 
 def _add_int_or_list_filter(queryset, field_name, field_value):
@@ -236,7 +253,7 @@ def df_doses_assays_controls(dataset, drug_id, cell_line_id, assay,
         if isinstance(dataset_id, Iterable):
             raise NotImplementedError()
         controls = WellMeasurement.objects.filter(
-            well__plate__dataset_id=dataset_id)
+            dataset_id=dataset_id)
     else:
         # Just get controls on the plates with expt data
         controls = WellMeasurement.objects.filter(
@@ -284,9 +301,192 @@ def df_doses_assays_controls(dataset, drug_id, cell_line_id, assay,
     return HtsPandas(df_doses, df_vals, df_controls)
 
 
+def _lttb_indices(x, y, num_points):
+    """ Largest-Triangle-Three-Buckets downsampling, returns kept indices """
+    n = len(x)
+    if num_points >= n or num_points < 3:
+        return np.arange(n)
+
+    keep = np.zeros(num_points, dtype=np.intp)
+    keep[-1] = n - 1
+    every = (n - 2) / (num_points - 2)
+    a = 0
+    for i in range(num_points - 2):
+        # Average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[avg_start:avg_end].mean()
+        avg_y = y[avg_start:avg_end].mean()
+
+        # Keep the point in this bucket which forms the largest triangle
+        # with the previously kept point and the next bucket's average
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        keep[i + 1] = a
+
+    return keep
+
+
+def _minmax_indices(y, num_points):
+    """ Min/max bucket downsampling, returns kept indices """
+    n = len(y)
+    if num_points >= n or num_points < 4:
+        return np.arange(n)
+
+    num_buckets = (num_points - 2) // 2
+    edges = np.linspace(1, n - 1, num_buckets + 1).astype(np.intp)
+    keep = [0, n - 1]
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            keep.append(start + int(np.argmin(y[start:end])))
+            keep.append(start + int(np.argmax(y[start:end])))
+
+    return np.unique(keep)
+
+
+def downsample_timecourses(df_vals, num_points, method='lttb'):
+    """
+    Reduce the number of points in each well's time course
+
+    The first and last time points of each well are always kept.
+
+    Parameters
+    ----------
+    df_vals: pd.DataFrame
+        Assay or control values, with "value" column and "well_id" and
+        "timepoint" index levels
+    num_points: int
+        Maximum number of points to keep per time course
+    method: str
+        'lttb' (Largest-Triangle-Three-Buckets), which preserves the visual
+        shape of each curve, or 'minmax', which keeps the minimum and
+        maximum value in each bucket
+
+    Returns
+    -------
+    pd.DataFrame
+        The downsampled rows of df_vals, in their original order
+    """
+    if method not in TIMECOURSE_DOWNSAMPLE_METHODS:
+        raise ValueError('Unknown downsampling method: {}'.format(method))
+
+    if df_vals.empty:
+        return df_vals
+
+    group_levels = [lvl for lvl in df_vals.index.names if lvl != 'timepoint']
+    times = df_vals.index.get_level_values('timepoint')
+    x = (times / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+    y = df_vals['value'].to_numpy(dtype=float)
+
+    keep = []
+    for positions in df_vals.groupby(
+            level=group_levels, sort=False).indices.values():
+        positions = positions[np.argsort(x[positions], kind='stable')]
+        if method == 'lttb':
+            selected = _lttb_indices(x[positions], y[positions], num_points)
+        else:
+            selected = _minmax_indices(y[positions], num_points)
+        keep.append(positions[selected])
+
+    return df_vals.iloc[np.sort(np.concatenate(keep))]
+
+
+def _timecourse_mean_sd(df, group_col, log_transform):
+    df = df.sort_values(['well_id', 'timepoint'])
+    if log_transform:
+        df['value'] = np.log2(df['value'])
+        df['value'] -= df.groupby('well_id')['value'].transform('first')
+
+    return df.groupby([group_col, 'timepoint'])['value'].agg(['mean', 'std'])
+
+
+def aggregate_timecourses(df_data, assay, log_transform=False):
+    """
+    Replace the individual wells in a time course with their mean
+
+    Each dose (and the controls) is represented by a single well holding
+    the mean value at each time point, suitable for plot_time_course. If
+    log_transform is set, the mean is calculated over the wells' log2
+    changes from their first time point, as plotted by plot_time_course.
+
+    Parameters
+    ----------
+    df_data: HtsPandas
+        Time course data for a single cell line and drug
+    assay: str
+        Assay name
+    log_transform: bool
+        Aggregate log2 change, rather than raw values
+
+    Returns
+    -------
+    tuple
+        HtsPandas with one well per dose, and a dict mapping each dose
+        (or None, for controls) to a DataFrame of mean and standard
+        deviation, indexed by time point, in the units plotted
+    """
+    doses = df_data.doses.reset_index()
+    values = df_data.assays.loc[assay].reset_index()
+    values = values.merge(doses[['well_id', 'dose']], on='well_id')
+    stats = _timecourse_mean_sd(values, 'dose', log_transform)
+
+    # Use the first well of each dose to stand for the group
+    rep_doses = doses.drop_duplicates('dose')
+    rep_wells = dict(zip(rep_doses['dose'], rep_doses['well_id']))
+    summary = {}
+    assay_rows = []
+    for dose, dose_stats in stats.groupby(level='dose', sort=False):
+        dose_stats = dose_stats.droplevel('dose')
+        if log_transform:
+            dose_stats = dose_stats.assign(
+                mean=dose_stats['mean'] - dose_stats['mean'].iloc[0])
+        summary[dose] = dose_stats
+        assay_rows.append(pd.DataFrame({
+            'assay': assay,
+            'well_id': rep_wells[dose],
+            'timepoint': dose_stats.index,
+            'value': np.exp2(dose_stats['mean'].to_numpy())
+            if log_transform else dose_stats['mean'].to_numpy()
+        }))
+    df_assays = pd.concat(assay_rows, ignore_index=True).set_index(
+        list(df_data.assays.index.names))
+
+    df_controls = None
+    if df_data.controls is not None:
+        controls = df_data.controls.xs(assay, level='assay',
+                                       drop_level=False).reset_index()
+        # Controls are only plotted from plates with experiment data
+        controls = controls[controls['plate'].isin(rep_doses['plate'])]
+        if not controls.empty:
+            controls['group'] = 'control'
+            ctrl_stats = _timecourse_mean_sd(controls, 'group', log_transform)
+            ctrl_stats = ctrl_stats.droplevel('group')
+            if log_transform:
+                ctrl_stats = ctrl_stats.assign(
+                    mean=ctrl_stats['mean'] - ctrl_stats['mean'].iloc[0])
+            summary[None] = ctrl_stats
+            rep_ctrl = controls.iloc[0]
+            df_controls = pd.DataFrame({
+                col: rep_ctrl[col] for col in df_data.controls.index.names
+                if col != 'timepoint'
+            }, index=range(len(ctrl_stats)))
+            df_controls['timepoint'] = ctrl_stats.index
+            df_controls['value'] = np.exp2(ctrl_stats['mean'].to_numpy()) \
+                if log_transform else ctrl_stats['mean'].to_numpy()
+            df_controls.set_index(list(df_data.controls.index.names),
+                                  inplace=True)
+
+    df_doses = rep_doses.set_index(list(df_data.doses.index.names))
+
+    return HtsPandas(df_doses, df_assays, df_controls), summary
+
+
 def df_control_wells(dataset_id, assay=None):
     controls = WellMeasurement.objects.filter(
-        well__plate__dataset_id=dataset_id)
+        dataset_id=dataset_id)
 
     controls = controls.order_by(
         'well__cell_line')
@@ -420,7 +620,7 @@ def df_ctrl_dip_rates(dataset_id, plate_ids=None, cell_line_id=None,
     if plate_ids is not None and dataset_id is None:
         controls = controls.filter(well__plate_id__in=plate_ids)
     elif dataset_id is not None and plate_ids is None:
-        controls = controls.filter(well__plate__dataset__id=dataset_id)
+        controls = controls.filter(dataset_id=dataset_id)
     else:
         raise ValueError('Must specify one of dataset_id or plate_ids')
 
@@ -460,7 +660,20 @@ def _row_to_curve_fit(row):
 
 
 def df_curve_fits(dataset_ids, stat_type,
-                  drug_ids, cell_line_ids, viability_time=None):
+                  drug_ids, cell_line_ids, viability_time=None,
+                  include_fit_params=False, include_ids=False):
+    """
+    Fetch stored curve fits as a DataFrame
+
+    If include_fit_params is True, the precomputed standard fit parameters
+    (STANDARD_FIT_PARAMS) and "aa_warning" are included as columns. The
+    "fit_params_precomputed" attribute of the result is then True if they
+    are available for every fit, or False if some fits predate them and the
+    parameters need to be calculated from the curves.
+
+    If include_ids is True, the "cell_line_id" and "drug_id" columns hold
+    the database IDs of each fit's cell line and drug.
+    """
     cf = CurveFit.objects.filter(
         fit_set__stat_type=stat_type,
         fit_set__dataset_id__in=[dataset_ids] if isinstance(dataset_ids,
@@ -471,6 +684,13 @@ def df_curve_fits(dataset_ids, stat_type,
     cols = ['fit_set__dataset__name', 'cell_line__name', 'drug__name',
             'curve_fit_class', 'fit_params', 'max_dose',
             'min_dose', 'emax_obs', 'aa_obs']
+    if include_fit_params:
+        fit_param_cols = [p for p in STANDARD_FIT_PARAMS
+                          if stat_type == 'dip' or
+                          p not in DIP_ONLY_FIT_PARAMS]
+        cols += fit_param_cols + ['aa_warning', 'fit_set__fit_protocol']
+    if include_ids:
+        cols += ['cell_line_id', 'drug_id']
     if viability_time is None:
         cols += ['fit_set__viability_time']
     else:
@@ -505,6 +725,14 @@ def df_curve_fits(dataset_ids, stat_type,
     }, inplace=True)
     base_params.set_index(['dataset_id', 'cell_line', 'drug'], inplace=True)
 
+    if include_fit_params:
+        base_params[fit_param_cols] = base_params[fit_param_cols].astype(
+            float)
+        base_params.attrs['fit_params_precomputed'] = bool((
+            base_params['fit_set__fit_protocol'] >=
+            STANDARD_FIT_PARAMS_PROTOCOL).all())
+        base_params.drop(columns='fit_set__fit_protocol', inplace=True)
+
     base_params.attrs['drmetric'] = stat_type
     if stat_type == 'viability':
         base_params.attrs['viability_time'] = viability_time
@@ -513,6 +741,39 @@ def df_curve_fits(dataset_ids, stat_type,
     return base_params
 
 
+def _curve_fits_cache_key(dataset_id, stat_type):
+    return 'dataset_{}_curve_fits_{}'.format(dataset_id, stat_type)
+
+
+def dataset_curve_fits(dataset, stat_type, regenerate_cache=False):
+    """
+    All of a dataset's curve fits, with their fit parameters, from the cache
+
+    The result is df_curve_fits() with include_fit_params and include_ids
+    set. It's cached along with the dataset name and the fit sets' IDs and
+    calculation end times, so refitting or renaming the dataset invalidates
+    it. Don't modify the returned DataFrame in place.
+    """
+    version = (dataset.name, tuple(CurveFitSet.objects.filter(
+        dataset_id=dataset.id, stat_type=stat_type).order_by('id').values_list(
+        'id', 'calculation_end')))
+    if not version[1]:
+        raise NoDataException()
+
+    cache_key = _curve_fits_cache_key(dataset.id, stat_type)
+    if not regenerate_cache:
+        cache_val = tiered_cache.get(cache_key)
+        if cache_val is not None and cache_val[0] == version:
+            return cache_val[1]
+
+    base_params = df_curve_fits(dataset.id, stat_type, drug_ids=None,
+                                cell_line_ids=None, include_fit_params=True,
+                                include_ids=True)
+    tiered_cache.set(cache_key, (version, base_params), timeout=None)
+
+    return base_params
+
+
 def queryset_to_dataframe(queryset, columns, index=None, rename_columns=None):
     return pd.DataFrame.from_records(
         queryset.values_list(*columns).iterator(),
@@ -525,7 +786,8 @@ def has_drug_combinations(dataset_ids, use_cache=True):
     if not isinstance(dataset_ids, Iterable):
         dataset_ids = (dataset_ids, )
     for d in dataset_ids:
-        dataset_groupings = cache.get('dataset_{}_groupings'.format(d))
+        dataset_groupings = tiered_cache.get(
+            'dataset_{}_groupings'.format(d))
         if dataset_groupings is None or not use_cache:
             # Calculate from DB
             if WellDrug.objects.filter(
@@ -0,0 +1,155 @@
+"""
+Helpers for managing the per-dataset partitions of the WellMeasurement and
+WellStatistic tables (see migration 0016).
+
+Datasets created through Thunor get their own LIST partition of each table.
+Rows for datasets without a partition (e.g. loaded from a fixture, or where
+creating the partition timed out) are stored in the DEFAULT partition, and
+are moved into a dedicated partition if one is created later.
+
+Attaching or dropping a partition locks the parent table, blocking every
+query on it while the lock is held or waited for. Each step therefore runs
+in its own short transaction, and gives up after PARTITION_LOCK_TIMEOUT
+rather than queueing behind long-running queries. Call these functions
+outside of other transactions, so the locks are released straight away.
+"""
+import logging
+
+from django.db import OperationalError, connection, transaction
+
+from .models import WellMeasurement, WellStatistic
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_MODELS = (WellMeasurement, WellStatistic)
+PARTITION_LOCK_TIMEOUT = '5s'
+
+
+def partition_name(table, dataset_id):
+    return '{}_d{:d}'.format(table, dataset_id)
+
+
+def _partition_exists(cursor, partition):
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [partition])
+    return cursor.fetchone()[0]
+
+
+def _set_lock_timeout(cursor):
+    """ Limit lock waits for the rest of the current transaction """
+    cursor.execute("SELECT set_config('lock_timeout', %s, true)",
+                   [PARTITION_LOCK_TIMEOUT])
+
+
+def _create_partition(cursor, table, partition, dataset_id):
+    qn = connection.ops.quote_name
+    check_name = partition + '_check'
+    # The new table is built outside the partitioned table, so the parent
+    # is only locked by the final ATTACH. The CHECK constraint lets ATTACH
+    # skip scanning the new partition.
+    cursor.execute(
+        'CREATE TABLE {part} (LIKE {table} INCLUDING DEFAULTS '
+        'INCLUDING CONSTRAINTS)'.format(part=qn(partition), table=qn(table)))
+    cursor.execute(
+        'ALTER TABLE {part} ADD CONSTRAINT {check} '
+        'CHECK (dataset_id = {dataset_id:d})'.format(
+            part=qn(partition), check=qn(check_name), dataset_id=dataset_id))
+    cursor.execute(
+        'WITH moved AS (DELETE FROM {default} WHERE dataset_id = %s '
+        'RETURNING *) INSERT INTO {part} SELECT * FROM moved'.format(
+            default=qn(table + '_default'), part=qn(partition)),
+        [dataset_id])
+    _set_lock_timeout(cursor)
+    cursor.execute(
+        'ALTER TABLE {table} ATTACH PARTITION {part} '
+        'FOR VALUES IN ({dataset_id:d})'.format(
+            table=qn(table), part=qn(partition), dataset_id=dataset_id))
+    cursor.execute('ALTER TABLE {part} DROP CONSTRAINT {check}'.format(
+        part=qn(partition), check=qn(check_name)))
+
+
+def create_dataset_partitions(dataset_id):
+    """
+    Create a partition for the dataset in each partitioned table
+
+    Any rows for the dataset already in the DEFAULT partition are moved into
+    the new partition. Existing partitions are left untouched. If a table
+    stays locked for longer than PARTITION_LOCK_TIMEOUT, that table is
+    skipped and the dataset's rows are kept in its DEFAULT partition.
+
+    Parameters
+    ----------
+    dataset_id: int
+        Dataset primary key
+
+    Returns
+    -------
+    list
+        Names of the partitions created
+    """
+    created = []
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        partition = partition_name(table, dataset_id)
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                if _partition_exists(cursor, partition):
+                    continue
+                _create_partition(cursor, table, partition, dataset_id)
+        except OperationalError:
+            logger.warning('Unable to create partition %s, rows will be '
+                           'stored in the default partition', partition,
+                           exc_info=True)
+        else:
+            created.append(partition)
+
+    return created
+
+
+def drop_dataset_partitions(dataset_id):
+    """
+    Drop the dataset's partitions, deleting all its measurements and
+    statistics
+
+    Rows for the dataset held in the DEFAULT partition are deleted too, so
+    afterwards no WellMeasurement or WellStatistic rows refer to the dataset.
+
+    Each partition is emptied with TRUNCATE first, which only locks the
+    partition, so the parent table is only locked to drop an empty table.
+    If that lock isn't granted within PARTITION_LOCK_TIMEOUT, the empty
+    partition is left in place.
+
+    Parameters
+    ----------
+    dataset_id: int
+        Dataset primary key
+
+    Returns
+    -------
+    list
+        Names of the partitions dropped
+    """
+    qn = connection.ops.quote_name
+    dropped = []
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        partition = partition_name(table, dataset_id)
+        with transaction.atomic(), connection.cursor() as cursor:
+            exists = _partition_exists(cursor, partition)
+            if exists:
+                cursor.execute('TRUNCATE {}'.format(qn(partition)))
+            cursor.execute(
+                'DELETE FROM {default} WHERE dataset_id = %s'.format(
+                    default=qn(table + '_default')), [dataset_id])
+        if not exists:
+            continue
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                _set_lock_timeout(cursor)
+                cursor.execute('DROP TABLE {}'.format(qn(partition)))
+        except OperationalError:
+            logger.warning('Unable to drop empty partition %s', partition,
+                           exc_info=True)
+        else:
+            dropped.append(partition)
+
+    return dropped
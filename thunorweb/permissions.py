@@ -0,0 +1,151 @@
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import CharField, Value
+
+from thunorweb.models import (
+    CellLineTagGroupObjectPermission,
+    DrugTagGroupObjectPermission,
+    HTSDataset,
+    HTSDatasetGroupObjectPermission,
+    HTSDatasetUserObjectPermission,
+)
+
+# Incremented whenever object permissions are changed through Thunor, so
+# cached permissions from before the change are no longer used
+PERMISSIONS_VERSION_CACHE_KEY = 'thunor_permissions_version'
+REQUEST_ATTR = '_thunor_permissions'
+
+# Object permissions held by a user (or the Public group, for anonymous
+# users). datasets maps dataset IDs to sets of permission codenames;
+# cell_line_tags and drug_tags are the IDs of tags shared with the user
+# (tags the user owns aren't included).
+Permissions = namedtuple('Permissions',
+                         'version datasets cell_line_tags drug_tags')
+
+
+def _permissions_cache_key(request):
+    if not request.user.is_authenticated:
+        return 'permissions_public'
+    return 'permissions_user_{}'.format(request.user.id)
+
+
+def _fetch_permissions(request, version):
+    """ Fetch all of the requester's object permissions in one query """
+    if not request.user.is_authenticated:
+        group_filter = {'group__name': 'Public'}
+    else:
+        group_filter = {'group__user': request.user}
+
+    def rows(queryset, kind):
+        # The kind column is last, as annotations are placed after model
+        # fields in combined queries on some Django versions
+        return queryset.annotate(
+            kind=Value(kind, output_field=CharField())
+        ).values_list('content_object_id', 'permission__codename', 'kind')
+
+    queries = [
+        rows(HTSDatasetGroupObjectPermission.objects.filter(**group_filter),
+             'dataset'),
+        rows(CellLineTagGroupObjectPermission.objects.filter(**group_filter),
+             'cell_line_tag'),
+        rows(DrugTagGroupObjectPermission.objects.filter(**group_filter),
+             'drug_tag'),
+    ]
+    if request.user.is_authenticated:
+        queries.append(rows(HTSDatasetUserObjectPermission.objects.filter(
+            user=request.user), 'dataset'))
+
+    datasets = defaultdict(set)
+    tags = {'cell_line_tag': set(), 'drug_tag': set()}
+    for obj_id, codename, kind in queries[0].union(*queries[1:], all=True):
+        if kind == 'dataset':
+            datasets[obj_id].add(codename)
+        else:
+            tags[kind].add(obj_id)
+
+    return Permissions(
+        version=version,
+        datasets={k: frozenset(v) for k, v in datasets.items()},
+        cell_line_tags=frozenset(tags['cell_line_tag']),
+        drug_tags=frozenset(tags['drug_tag'])
+    )
+
+
+def get_permissions(request):
+    """
+    Get the object permissions for the user making a request
+
+    Anonymous users get the permissions of the Public group.
+    Permissions are fetched at most once per request, and cached across
+    requests for up to PERMISSIONS_CACHE_TTL seconds, or until
+    invalidate_permissions() is called.
+
+    Parameters
+    ----------
+    request: django.http.HttpRequest
+        The request
+
+    Returns
+    -------
+    Permissions
+        The requester's dataset permissions and shared tag IDs
+    """
+    permissions = getattr(request, REQUEST_ATTR, None)
+    if permissions is not None:
+        return permissions
+
+    cache_key = _permissions_cache_key(request)
+    cached = cache.get_many([cache_key, PERMISSIONS_VERSION_CACHE_KEY])
+    version = cached.get(PERMISSIONS_VERSION_CACHE_KEY, 0)
+    permissions = cached.get(cache_key)
+    if permissions is None or permissions.version != version:
+        permissions = _fetch_permissions(request, version)
+        if settings.PERMISSIONS_CACHE_TTL > 0:
+            cache.set(cache_key, permissions,
+                      timeout=settings.PERMISSIONS_CACHE_TTL)
+
+    setattr(request, REQUEST_ATTR, permissions)
+    return permissions
+
+
+def get_dataset_perms(request, dataset):
+    """
+    Get the permission codenames the requester has been granted on a dataset
+
+    Dataset ownership isn't considered, matching guardian's get_perms.
+    """
+    user = request.user
+    if user.is_authenticated:
+        if not user.is_active:
+            return frozenset()
+        if user.is_superuser:
+            return frozenset(HTSDataset.view_dataset_permission_names())
+    elif settings.LOGIN_REQUIRED:
+        return frozenset()
+    return get_permissions(request).datasets.get(dataset.id, frozenset())
+
+
+def has_dataset_perm(request, dataset, perm):
+    """ Check whether the requester owns or has a permission on a dataset """
+    if request.user.is_authenticated and dataset.owner_id == request.user.id:
+        return True
+    return perm in get_dataset_perms(request, dataset)
+
+
+def invalidate_permissions(request=None):
+    """
+    Discard cached permissions for all users
+
+    Call this after changing any object permissions. If a request is
+    supplied, its per-request permissions are discarded too.
+    """
+    cache.add(PERMISSIONS_VERSION_CACHE_KEY, 0, timeout=None)
+    try:
+        cache.incr(PERMISSIONS_VERSION_CACHE_KEY)
+    except ValueError:
+        # Key couldn't be stored (e.g. DummyCache), so nothing is cached
+        pass
+    if request is not None and hasattr(request, REQUEST_ATTR):
+        delattr(request, REQUEST_ATTR)
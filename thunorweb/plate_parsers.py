@@ -29,18 +29,26 @@ from .models import (
     WellDrug,
     WellMeasurement,
 )
+from .uploadhandlers import file_sha256
 
 
 class PlateFileUnknownFormat(PlateFileParseException):
     pass
 
 
+class PlateFileValidationException(PlateFileParseException):
+    """ A parsed plate file which can't be imported, with all the reasons """
+    def __init__(self, problems):
+        super().__init__('\n'.join(problems))
+        self.problems = problems
+
+
 def _plate_size_selector(num_wells):
     for size in STANDARD_PLATE_SIZES:
         if num_wells < size:
             return size
 
-    raise ValueError('Unsupported plate size: ' + num_wells)
+    raise ValueError('Unsupported plate size: {} wells'.format(num_wells))
 
 
 class PlateFileParser(object):
@@ -70,7 +78,19 @@ class PlateFileParser(object):
                            'application/x-hdf': 'hdf'
                            }
 
-    def __init__(self, plate_files, dataset):
+    def __init__(self, plate_files, dataset, validate_only=False):
+        """
+        Parameters
+        ----------
+        plate_files: File or list of File
+            The plate files to parse
+        dataset: HTSDataset or None
+            The dataset to import into. May be None when validating, in which
+            case plate names aren't checked against an existing dataset.
+        validate_only: bool
+            Parse and check the files, reporting any problems, but don't
+            write anything to the database or file storage
+        """
         if isinstance(plate_files, File):
             self.all_plate_files = [plate_files, ]
         elif isinstance(plate_files, collections.abc.Iterable):
@@ -87,6 +107,14 @@ class PlateFileParser(object):
         self._plate_objects = {}
         self._results = []
         self._well_sets = {}
+        self.validate_only = validate_only
+
+        if validate_only:
+            # Only plate names are needed, to check for collisions
+            if dataset is not None:
+                self._plate_objects = dict.fromkeys(Plate.objects.filter(
+                    dataset_id=dataset.id).values_list('name', flat=True))
+            return
 
         # Get existing well and plate objects
         for w in Well.objects.filter(
@@ -103,9 +131,39 @@ class PlateFileParser(object):
             self._well_sets.setdefault(w.plate_id, {})[w.well_num] = w.pk
 
     def _create_db_platefile(self):
-        self._db_platefile = PlateFile.objects.create(
-            dataset=self.dataset, file=self.plate_file,
-            file_format=self.file_format)
+        """
+        Record the plate file, storing its contents if they're new
+
+        Files are stored under their SHA-256, so if the same contents have
+        been uploaded before (to any dataset), the stored copy is reused.
+        """
+        if self.validate_only:
+            return
+
+        sha256 = file_sha256(self.plate_file)
+        db_platefile = PlateFile(dataset=self.dataset,
+                                 file_format=self.file_format,
+                                 file_name=self.file_name,
+                                 sha256=sha256)
+        stored_name = db_platefile.file.field.generate_filename(
+            db_platefile, sha256)
+        # Stops thunor_purge deleting a stored file while it's reused here
+        PlateFile.lock_stored_files()
+        if db_platefile.file.storage.exists(stored_name):
+            db_platefile.file.name = stored_name
+        else:
+            db_platefile.file.save(sha256, self.plate_file, save=False)
+        db_platefile.save()
+        self._db_platefile = db_platefile
+
+    def _existing_platefile(self):
+        """ Find an earlier upload of the current file to this dataset """
+        if self.dataset is None:
+            return None
+        return PlateFile.objects.filter(
+            dataset=self.dataset,
+            sha256=file_sha256(self.plate_file)
+        ).first()
 
     def _has_more_platefiles(self):
         return self._plate_file_position < (len(self.all_plate_files) - 1)
@@ -218,22 +276,31 @@ class PlateFileParser(object):
         WellDrug.objects.bulk_create(well_drugs_to_create,
                                      batch_size=settings.DB_MAX_BATCH_SIZE)
 
-    def _import_thunor(self, df_data):
-        """ Import from a Thunor core dataset with unstacked doses """
-        if settings.DATABASE_SETTING == 'postgres':
-            # This is wrapped in an outer commit block, so we can gain a bit of
-            # speed by not waiting for WAL in this inner transaction
-            Well.objects.raw('SET LOCAL synchronous_commit TO OFF;')
+    def _check_thunor(self, df_data):
+        """
+        Check a parsed dataset can be imported, without using the database
 
-        doses_unstacked = df_data.doses
+        Plate names are checked against those loaded when the parser was
+        created, and those in earlier files of the same batch.
+
+        Returns
+        -------
+        pd.Series
+            Plate size (96, 384 or 1536) for each plate name
+
+        Raises
+        ------
+        PlateFileValidationException
+            Listing every problem found
+        """
+        problems = []
 
         if settings.THUNOR_REQUIRE_CONTROLS:
             if df_data.controls is None:
-                raise PlateFileParseException(
+                problems.append(
                     'This dataset has no controls wells. Please add controls '
                     'wells (containing cells with no drug) to your data.')
-
-            if df_data.doses is not None:
+            elif df_data.doses is not None:
                 # Check controls are available for all cell lines and plates
                 grps_expt = set(grp for grp, _ in df_data.doses.groupby(
                     ['plate', 'cell_line'], sort=False))
@@ -242,11 +309,56 @@ class PlateFileParser(object):
 
                 missing_ctrls = grps_expt.difference(grps_ctrl)
                 if missing_ctrls:
-                    raise PlateFileParseException(
+                    problems.append(
                         'There are no control wells defined for the following '
                         '(plate, cell line) pairs: {}'.format(missing_ctrls)
                     )
 
+        # Get the plate sizes by the largest well number on each plate
+        plate_sizes = [df.groupby('plate')['well_num'].max()
+                       for df in (df_data.doses, df_data.controls)
+                       if df is not None]
+        if not plate_sizes:
+            problems.append('File contains no wells')
+            raise PlateFileValidationException(problems)
+        plate_sizes = pd.concat(plate_sizes).groupby(level=0).max()
+
+        # Convert the plate sizes to one of (96, 384, 1536)
+        plate_sizes_std = {}
+        for pl_name, max_well_num in plate_sizes.items():
+            try:
+                plate_sizes_std[pl_name] = _plate_size_selector(max_well_num)
+            except ValueError as e:
+                problems.append('Plate "{}": {}'.format(pl_name, e))
+
+        for pl_name in sorted(plate_sizes.index):
+            if pl_name in self._plate_objects:
+                problems.append(
+                    'The plate "{}" already exists in this dataset'.format(
+                        pl_name))
+
+        if problems:
+            raise PlateFileValidationException(problems)
+
+        return pd.Series(plate_sizes_std)
+
+    def _import_thunor(self, df_data):
+        """ Import from a Thunor core dataset with unstacked doses """
+        if settings.DATABASE_SETTING == 'postgres':
+            # This is wrapped in an outer commit block, so we can gain a bit of
+            # speed by not waiting for WAL in this inner transaction
+            Well.objects.raw('SET LOCAL synchronous_commit TO OFF;')
+
+        plate_sizes = self._check_thunor(df_data)
+        if self.validate_only:
+            # Later files in the same batch mustn't reuse these plate names
+            self._plate_objects.update(dict.fromkeys(plate_sizes.index))
+            # Nothing should have been written, but make sure
+            transaction.set_rollback(True)
+            return
+
+        doses_unstacked = df_data.doses
+
         # Work out the max number of drugs in a combination
         drug_no = 1
         drug_nums = []
@@ -286,41 +398,18 @@ class PlateFileParser(object):
             df_wells = doses_unstacked
             df_wells.set_index('well_id', inplace=True)
 
-            # Get the plate sizes by the largest well number on each plate
-            plate_sizes = df_wells.groupby('plate')['well_num'].max()
-
-        if df_data.controls is not None:
-            ctrl_plate_sizes = df_data.controls.groupby(
-                'plate')['well_num'].max()
-            if doses_unstacked is None:
-                plate_sizes = ctrl_plate_sizes
-            else:
-                plate_sizes = plate_sizes.to_frame().join(
-                    ctrl_plate_sizes, rsuffix='ctrl', how='outer').max(axis=1)
-
-        # Convert the plate sizes to one of (96, 384, 1536)
-        plate_sizes = plate_sizes.apply(_plate_size_selector)
         plate_dims = {size: PlateMap.plate_size_from_num_wells(size)
                       for size in plate_sizes.unique()}
 
-        plate_names = set(plate_sizes.index)
-
-        for pl_name in sorted(plate_names):
-            if pl_name not in self._plate_objects.keys():
-                plate_size = plate_sizes.loc[pl_name]
-                plate_width, plate_height = plate_dims[plate_size]
-                plates_to_create[pl_name] = Plate(
-                    dataset=self.dataset,
-                    name=pl_name,
-                    last_annotated=timezone.now(),
-                    width=plate_width,
-                    height=plate_height
-                )
-            else:
-                raise PlateFileParseException(
-                    'The plate "{}" already exists in this dataset'.format(
-                        pl_name)
-                )
+        for pl_name in sorted(plate_sizes.index):
+            plate_width, plate_height = plate_dims[plate_sizes.loc[pl_name]]
+            plates_to_create[pl_name] = Plate(
+                dataset=self.dataset,
+                name=pl_name,
+                last_annotated=timezone.now(),
+                width=plate_width,
+                height=plate_height
+            )
 
         if plates_to_create:
             try:
@@ -367,6 +456,7 @@ class PlateFileParser(object):
                 well_num = row.well_num
                 well_id = self._well_sets[plate.id][well_num]
                 well_measurements_to_create.append(WellMeasurement(
+                  dataset_id=self.dataset.id,
                   well_id=well_id,
                   assay=row.Index[ctrl_assay_idx],
                   timepoint=row.Index[ctrl_timepoint_idx],
@@ -385,6 +475,7 @@ class PlateFileParser(object):
             well_num = row.well_num
             well_id = self._well_sets[plate.id][well_num]
             well_measurements_to_create.append(WellMeasurement(
+              dataset_id=self.dataset.id,
               well_id=well_id,
               assay=row.assay,
               timepoint=row.timepoint,
@@ -527,6 +618,7 @@ class PlateFileParser(object):
                 for row in range(2, len(well_lines)):
                     for val in well_lines[row].split('\t')[1:-1]:
                         well_measurements.append(WellMeasurement(
+                            dataset_id=self.dataset.id,
                             well_id=self._well_sets[plate.id][well_id],
                             timepoint=plate_timepoint,
                             assay=assay_name,
@@ -615,6 +707,7 @@ class PlateFileParser(object):
                         val = None
 
                     well_measurements.append(WellMeasurement(
+                        dataset_id=self.dataset.id,
                         well_id=self._well_sets[plate.id][well_id],
                         timepoint=file_timepoint,
                         assay=assay_name,
@@ -731,15 +824,31 @@ class PlateFileParser(object):
         self._results = []
         while self._has_more_platefiles():
             self._next_platefile()
+            existing = self._existing_platefile()
+            if existing is not None:
+                # Already imported, so there's nothing to parse
+                self._results.append({'success': True,
+                                      'duplicate': True,
+                                      'file_format': existing.file_format,
+                                      'id': existing.id,
+                                      'file_name': self.file_name
+                                      })
+                continue
             try:
                 self.parse_platefile()
                 self._results.append({'success': True,
+                                      'duplicate': False,
                                       'file_format': self.file_format,
                                       'id': self.id,
                                       'file_name': self.file_name
                                       })
             except PlateFileParseException as e:
-                self._results.append({'success': False, 'error': e})
-                self.plate_file.delete()
+                self._results.append({
+                    'success': False, 'error': e,
+                    'problems': getattr(e, 'problems', [str(e)]),
+                    'file_name': self.file_name})
+                # Uploaded and plain Files have no delete(); Django removes
+                # temporary uploads itself
+                self.plate_file.close()
 
         return self._results
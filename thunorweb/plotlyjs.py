@@ -0,0 +1,129 @@
+import functools
+import hashlib
+import struct
+import zlib
+from collections import namedtuple
+
+# Rendered in place of plotly.js in standalone plot templates, then replaced
+# with the library source when the response is streamed
+PLOTLYJS_PLACEHOLDER = '/* plotly.js */'
+CHECKSUM_LENGTH = 16
+CHUNK_SIZE = 256 * 1024
+GZIP_LEVEL = 6
+# Header of a gzip member with no file name or modification time
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+PlotlyJs = namedtuple('PlotlyJs', 'source checksum crc32 deflated')
+
+
+def _deflate(data, mode=zlib.Z_FULL_FLUSH):
+    """
+    Raw deflate data, ending on a byte boundary
+
+    Segments compressed with Z_FULL_FLUSH don't refer back to earlier data,
+    so they can be concatenated, as long as only the last is compressed with
+    Z_FINISH.
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(mode)
+
+
+@functools.lru_cache(maxsize=None)
+def get_plotlyjs():
+    """
+    Get the plotly.js source bundled with the plotly package
+
+    The source is read and compressed once per process.
+
+    Returns
+    -------
+    PlotlyJs
+        The UTF-8 encoded source, a checksum of it for use in URLs, and
+        its CRC-32 and raw deflated form for building gzip responses
+    """
+    from plotly.offline.offline import get_plotlyjs as plotly_get_plotlyjs
+
+    source = plotly_get_plotlyjs().encode('utf-8')
+    return PlotlyJs(
+        source=source,
+        checksum=hashlib.sha256(source).hexdigest()[:CHECKSUM_LENGTH],
+        crc32=zlib.crc32(source),
+        deflated=_deflate(source)
+    )
+
+
+def _gzip_trailer(crc32, size):
+    return struct.pack('<II', crc32 & 0xffffffff, size & 0xffffffff)
+
+
+@functools.lru_cache(maxsize=None)
+def get_plotlyjs_gzip():
+    """ Get plotly.js as a complete gzip file, built once per process """
+    plotlyjs = get_plotlyjs()
+    return GZIP_HEADER + plotlyjs.deflated + _deflate(b'', zlib.Z_FINISH) + \
+        _gzip_trailer(plotlyjs.crc32, len(plotlyjs.source))
+
+
+def _chunks(data):
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield view[start:start + CHUNK_SIZE]
+
+
+def split_standalone(html):
+    """
+    Split a rendered standalone template at the plotly.js placeholder
+
+    Parameters
+    ----------
+    html: str
+        Rendered template containing PLOTLYJS_PLACEHOLDER
+
+    Returns
+    -------
+    tuple
+        Encoded HTML before and after the placeholder
+    """
+    head, tail = html.split(PLOTLYJS_PLACEHOLDER, 1)
+    return head.encode('utf-8'), tail.encode('utf-8')
+
+
+def standalone_parts(head, tail, gzip=False):
+    """
+    Build a standalone HTML file around the cached plotly.js
+
+    Only the (small) head and tail are encoded or compressed per request;
+    the library itself is reused from get_plotlyjs().
+
+    Parameters
+    ----------
+    head: bytes
+        HTML before the plotly.js source
+    tail: bytes
+        HTML after the plotly.js source
+    gzip: bool
+        Return the parts of a gzip file, rather than plain HTML
+
+    Returns
+    -------
+    tuple
+        The total length in bytes, and an iterator over the parts
+    """
+    plotlyjs = get_plotlyjs()
+    if not gzip:
+        parts = [head, plotlyjs.source, tail]
+    else:
+        crc32 = zlib.crc32(tail, zlib.crc32(plotlyjs.source,
+                                            zlib.crc32(head)))
+        size = len(head) + len(plotlyjs.source) + len(tail)
+        parts = [
+            GZIP_HEADER + _deflate(head),
+            plotlyjs.deflated,
+            _deflate(tail, zlib.Z_FINISH) + _gzip_trailer(crc32, size)
+        ]
+
+    def iter_parts():
+        for part in parts:
+            yield from _chunks(part)
+
+    return sum(len(part) for part in parts), iter_parts()
@@ -1,36 +1,58 @@
 import itertools
+import logging
+import os
 import pickle
+import uuid
+import warnings
 from collections import defaultdict
 from collections.abc import Sequence
 from datetime import timedelta
 
-from django.conf import settings
-from django.core.cache import cache
-from django.db import transaction
-from django.db.models import Count, F
+import numpy as np
+from django.core.files import File
+from django.db import connection, transaction
 from django.utils import timezone
-from thunor.curve_fit import HillCurveLL3u, HillCurveLL4, fit_params_minimal
+from thunor.curve_fit import (
+    AAFitWarning,
+    HillCurveLL3u,
+    HillCurveLL4,
+    fit_params_minimal,
+)
 from thunor.dip import _choose_dip_assay, dip_rates
+from thunor.io import PlateFileParseException
 from thunor.viability import viability
 
-from thunorweb.pandas import has_drug_combinations
+from thunorweb.caching import tiered_cache
+from thunorweb.plate_parsers import PlateFileParser
 
 from .models import (
     CellLine,
+    ChunkedUpload,
     CurveFit,
     CurveFitSet,
     Drug,
     HTSDataset,
+    Plate,
     Well,
     WellDrug,
     WellMeasurement,
     WellStatistic,
 )
-from .pandas import NoDataException, df_dip_rates, df_doses_assays_controls
+from .pandas import (
+    STANDARD_FIT_PARAMS,
+    STANDARD_FIT_PARAMS_PROTOCOL,
+    NoDataException,
+    df_dip_rates,
+    df_doses_assays_controls,
+)
+
+logger = logging.getLogger(__name__)
 
 # Increment these versions to indicate a change in calculation protocols
-DIP_PROTOCOL_VER = 1
-VIABILITY_PROTOCOL_VER = 1
+# Version 2: standard fit parameters are stored on each CurveFit
+# Version 3: activity area fit warnings are stored too
+DIP_PROTOCOL_VER = STANDARD_FIT_PARAMS_PROTOCOL
+VIABILITY_PROTOCOL_VER = STANDARD_FIT_PARAMS_PROTOCOL
 
 DEFAULT_VIABILITY_TIME_HRS = 72
 SECONDS_IN_HOUR = 3600
@@ -39,6 +61,65 @@ SECONDS_IN_HOUR = 3600
 MAX_COMBINATIONS_AT_ONCE = 10000
 
 
+def _fit_param_value(value):
+    if value is None or np.isnan(value):
+        return None
+    return float(value)
+
+
+def standard_fit_params(fit_obj, min_dose, max_dose, emax_obs, stat_type):
+    """
+    Calculate the standard fit parameters stored on a CurveFit
+
+    Matches the calculations in thunor.curve_fit.fit_params_from_base.
+    IC50 and EC50 are truncated to the measured dose range. The message of
+    any AAFitWarning raised calculating the activity area is kept, so it can
+    still be shown when AA is plotted.
+
+    Parameters
+    ----------
+    fit_obj: thunor.curve_fit.HillCurve or None
+        Fitted curve, or None if the fit failed
+    min_dose: float
+        Minimum dose measured
+    max_dose: float
+        Maximum dose measured
+    emax_obs: float
+        Observed Emax
+    stat_type: str
+        'dip' or 'viability'
+
+    Returns
+    -------
+    dict
+        Parameter values and aa_warning, keyed by CurveFit field name
+    """
+    params = dict.fromkeys(STANDARD_FIT_PARAMS)
+    if fit_obj is None:
+        return dict(params, aa_warning=None)
+
+    ic50 = fit_obj.ic(ic_num=50)
+    if ic50 is not None:
+        params['ic50'] = min(max(ic50, min_dose), max_dose)
+    if fit_obj.ec50 is not None:
+        params['ec50'] = min(max(fit_obj.ec50, min_dose), max_dose)
+    params['emax'] = fit_obj.fit(max_dose)
+    params['einf'] = fit_obj.emax
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always', AAFitWarning)
+        params['aa'] = fit_obj.aa(min_conc=min_dose, max_conc=max_dose)
+    aa_warnings = [str(i.message) for i in w
+                   if issubclass(i.category, AAFitWarning)]
+    params['hill'] = fit_obj.hill_slope
+    if stat_type == 'dip' and fit_obj.divisor:
+        params['emax_rel'] = params['emax'] / fit_obj.divisor
+        params['emax_obs_rel'] = emax_obs / fit_obj.divisor
+
+    params = {k: _fit_param_value(v) for k, v in params.items()}
+    params['aa_warning'] = aa_warnings[0] if aa_warnings else None
+    return params
+
+
 def precalculate_dip_rates(dataset_or_id, plate_ids=None):
     if isinstance(dataset_or_id, HTSDataset):
         dataset = dataset_or_id
@@ -50,7 +131,7 @@ def precalculate_dip_rates(dataset_or_id, plate_ids=None):
 
     # Auto-select DIP rate assay
     assays_times = WellMeasurement.objects.filter(
-        well__plate__dataset_id=dataset.id
+        dataset_id=dataset.id
     ).values_list('assay', 'timepoint').distinct()
 
     if plate_ids:
@@ -90,16 +171,19 @@ def precalculate_dip_rates(dataset_or_id, plate_ids=None):
 
     well_stats_to_create = [
         (WellStatistic(
+            dataset_id=dataset.id,
             well_id=well_stat.well_id,
             stat_name='dip_rate',
             value=well_stat.dip_rate
         ),
          WellStatistic(
+             dataset_id=dataset.id,
              well_id=well_stat.well_id,
              stat_name='dip_fit_std_err',
              value=well_stat.dip_fit_std_err
          ),
          WellStatistic(
+             dataset_id=dataset.id,
              well_id=well_stat.well_id,
              stat_name='dip_first_timepoint',
              value=well_stat.dip_first_timepoint
@@ -112,11 +196,13 @@ def precalculate_dip_rates(dataset_or_id, plate_ids=None):
         ctrl_dip_data.reset_index('well_id', inplace=True)
         well_stats_to_create.extend([
             (WellStatistic(
+                dataset_id=dataset.id,
                 well_id=well_stat.well_id,
                 stat_name='dip_rate',
                 value=well_stat.dip_rate
             ),
              WellStatistic(
+                dataset_id=dataset.id,
                 well_id=well_stat.well_id,
                 stat_name='dip_fit_std_err',
                 value=well_stat.dip_fit_std_err
@@ -126,10 +212,9 @@ def precalculate_dip_rates(dataset_or_id, plate_ids=None):
         ])
 
     # Delete any existing WellStatistics
+    well_stats = WellStatistic.objects.filter(dataset_id=dataset.id)
     if plate_ids:
-        well_stats = WellStatistic.objects.filter(well__plate_id__in=plate_ids)
-    else:
-        well_stats = WellStatistic.objects.filter(well__plate__dataset=dataset)
+        well_stats = well_stats.filter(well__plate_id__in=plate_ids)
 
     well_stats.filter(stat_name__in=[
         'dip_rate', 'dip_fit_std_err', 'dip_first_timepoint']).delete()
@@ -139,9 +224,33 @@ def precalculate_dip_rates(dataset_or_id, plate_ids=None):
     )
 
 
+def _partial_fit_set(dataset, stat_type, fit_protocol, viability_time,
+                     cell_line_ids):
+    """
+    Get a dataset's current fit set, ready to refit some cell lines
+
+    The existing fits for those cell lines are removed. Fits for other
+    cell lines don't depend on them, so are kept.
+
+    Returns
+    -------
+    CurveFitSet or None
+        The fit set, or None if there's no fit set from the current
+        protocol, in which case all of the cell lines need fitting
+    """
+    cfs = CurveFitSet.objects.filter(
+        dataset=dataset, stat_type=stat_type, fit_protocol=fit_protocol,
+        viability_time=viability_time).first()
+    if cfs is not None:
+        CurveFit.objects.filter(fit_set=cfs,
+                                cell_line_id__in=cell_line_ids).delete()
+        cfs.calculation_start = timezone.now()
+    return cfs
+
+
 @transaction.atomic
 def precalculate_dip_curves(dataset_or_id, verbose=False,
-                            delete_previous=True):
+                            delete_previous=True, cell_line_ids=None):
     if isinstance(dataset_or_id, HTSDataset):
         dataset = dataset_or_id
     elif isinstance(dataset_or_id, int):
@@ -154,31 +263,44 @@ def precalculate_dip_curves(dataset_or_id, verbose=False,
     if groupings['singleTimepoint'] is not False:
         return
 
-    cell_line_ids = Well.objects.filter(
-        plate__dataset=dataset,
-        cell_line__isnull=False
-    ).values_list('cell_line_id', flat=True).distinct()
+    cfs = None
+    if cell_line_ids is not None:
+        if not cell_line_ids:
+            return
+        cfs = _partial_fit_set(dataset, 'dip', DIP_PROTOCOL_VER,
+                               timedelta(0), cell_line_ids)
 
-    if not cell_line_ids:
-        return
+    if cfs is not None:
+        # Refit the given cell lines together
+        cell_line_ids = [sorted(cell_line_ids)]
+    else:
+        cell_line_ids = Well.objects.filter(
+            plate__dataset=dataset,
+            cell_line__isnull=False
+        ).values_list('cell_line_id', flat=True).distinct()
+
+        if not cell_line_ids:
+            return
 
     cell_lines = {cl.name: cl for cl in CellLine.objects.all()}
     drugs = {dr.name: dr for dr in Drug.objects.all()}
 
-    if len(cell_lines) * len(drugs) < MAX_COMBINATIONS_AT_ONCE:
-        cell_line_ids = [None]
+    if cfs is None:
+        if len(cell_lines) * len(drugs) < MAX_COMBINATIONS_AT_ONCE:
+            cell_line_ids = [None]
 
-    # Delete previous if required
-    if delete_previous:
-        CurveFitSet.objects.filter(dataset=dataset, stat_type='dip').delete()
+        # Delete previous if required
+        if delete_previous:
+            CurveFitSet.objects.filter(dataset=dataset,
+                                       stat_type='dip').delete()
 
-    cfs = CurveFitSet.objects.create(
-        dataset=dataset,
-        stat_type='dip',
-        fit_protocol=DIP_PROTOCOL_VER,
-        viability_time=timedelta(0),
-        calculation_start=timezone.now()
-    )
+        cfs = CurveFitSet.objects.create(
+            dataset=dataset,
+            stat_type='dip',
+            fit_protocol=DIP_PROTOCOL_VER,
+            viability_time=timedelta(0),
+            calculation_start=timezone.now()
+        )
 
     for i, cl_id in enumerate(cell_line_ids):
         if verbose:
@@ -222,7 +344,10 @@ def precalculate_dip_curves(dataset_or_id, verbose=False,
                 min_dose=fp.min_dose_measured,
                 max_dose=fp.max_dose_measured,
                 emax_obs=fp.emax_obs,
-                aa_obs=fp.aa_obs
+                aa_obs=fp.aa_obs,
+                **standard_fit_params(fp.fit_obj, fp.min_dose_measured,
+                                      fp.max_dose_measured, fp.emax_obs,
+                                      'dip')
             ))
 
         CurveFit.objects.bulk_create(fits)
@@ -233,7 +358,8 @@ def precalculate_dip_curves(dataset_or_id, verbose=False,
 
 @transaction.atomic
 def precalculate_viability(dataset_or_id, time_hrs=None, assay_name=None,
-                           verbose=False, delete_previous=True):
+                           verbose=False, delete_previous=True,
+                           cell_line_ids=None):
     if isinstance(dataset_or_id, HTSDataset):
         dataset = dataset_or_id
     elif isinstance(dataset_or_id, int):
@@ -242,20 +368,9 @@ def precalculate_viability(dataset_or_id, time_hrs=None, assay_name=None,
         raise ValueError('Argument must be an HTSDataset or an integer '
                          'primary key')
 
-    cell_line_ids = Well.objects.filter(
-        plate__dataset=dataset,
-        cell_line__isnull=False
-    ).values_list('cell_line_id', flat=True).distinct()
-
-    if not cell_line_ids:
+    if cell_line_ids is not None and not cell_line_ids:
         return
 
-    cell_lines = {cl.name: cl for cl in CellLine.objects.all()}
-    drugs = {dr.name: dr for dr in Drug.objects.all()}
-
-    if len(cell_lines) * len(drugs) < MAX_COMBINATIONS_AT_ONCE:
-        cell_line_ids = [None]
-
     if time_hrs is None:
         groupings = dataset_groupings(dataset)
         if groupings['singleTimepoint'] is not False:
@@ -267,18 +382,42 @@ def precalculate_viability(dataset_or_id, time_hrs=None, assay_name=None,
 
     time_hrs = viability_time.total_seconds() / SECONDS_IN_HOUR
 
-    # Delete previous if required
-    if delete_previous:
-        CurveFitSet.objects.filter(dataset=dataset,
-                                   stat_type='viability').delete()
-
-    cfs = CurveFitSet.objects.create(
-        dataset=dataset,
-        stat_type='viability',
-        viability_time=viability_time,
-        fit_protocol=VIABILITY_PROTOCOL_VER,
-        calculation_start=timezone.now()
-    )
+    cfs = None
+    if cell_line_ids is not None:
+        cfs = _partial_fit_set(dataset, 'viability', VIABILITY_PROTOCOL_VER,
+                               viability_time, cell_line_ids)
+
+    if cfs is not None:
+        # Refit the given cell lines together
+        cell_line_ids = [sorted(cell_line_ids)]
+    else:
+        cell_line_ids = Well.objects.filter(
+            plate__dataset=dataset,
+            cell_line__isnull=False
+        ).values_list('cell_line_id', flat=True).distinct()
+
+        if not cell_line_ids:
+            return
+
+    cell_lines = {cl.name: cl for cl in CellLine.objects.all()}
+    drugs = {dr.name: dr for dr in Drug.objects.all()}
+
+    if cfs is None:
+        if len(cell_lines) * len(drugs) < MAX_COMBINATIONS_AT_ONCE:
+            cell_line_ids = [None]
+
+        # Delete previous if required
+        if delete_previous:
+            CurveFitSet.objects.filter(dataset=dataset,
+                                       stat_type='viability').delete()
+
+        cfs = CurveFitSet.objects.create(
+            dataset=dataset,
+            stat_type='viability',
+            viability_time=viability_time,
+            fit_protocol=VIABILITY_PROTOCOL_VER,
+            calculation_start=timezone.now()
+        )
 
     for i, cl_id in enumerate(cell_line_ids):
         if verbose:
@@ -326,7 +465,10 @@ def precalculate_viability(dataset_or_id, time_hrs=None, assay_name=None,
                 min_dose=fp.min_dose_measured,
                 max_dose=fp.max_dose_measured,
                 emax_obs=fp.emax_obs,
-                aa_obs=fp.aa_obs
+                aa_obs=fp.aa_obs,
+                **standard_fit_params(fp.fit_obj, fp.min_dose_measured,
+                                      fp.max_dose_measured, fp.emax_obs,
+                                      'viability')
             ))
 
         CurveFit.objects.bulk_create(fits)
@@ -343,68 +485,199 @@ def dataset_groupings(datasets, regenerate_cache=False):
         return _dataset_groupings(
             datasets, regenerate_cache=regenerate_cache)
 
-    # Multi dataset
-    groups = [_dataset_groupings(d, regenerate_cache=regenerate_cache)
-              for d in datasets]
-    grp_it = range(len(groups))
+    return _multi_dataset_groupings(
+        datasets, regenerate_cache=regenerate_cache)
+
+
+def _groupings_version_cache_key(dataset_id):
+    return 'dataset_{}_groupings_version'.format(dataset_id)
+
+
+def _bump_groupings_version(dataset_id):
+    """ Mark combined groupings which include a dataset as out of date """
+    version = uuid.uuid4().hex
+    tiered_cache.set(_groupings_version_cache_key(dataset_id), version,
+                     timeout=None)
+    return version
+
+
+def _groupings_versions(datasets):
+    return tuple(
+        tiered_cache.get(_groupings_version_cache_key(d.id)) or
+        _bump_groupings_version(d.id) for d in datasets)
+
+
+def _sort_id_name_dicts(entries):
+    """ Sort by name, with single drugs before drug combinations """
+    return sorted((e for e in entries if not isinstance(e['name'], tuple)),
+                  key=lambda e: e['name'].lower()) + \
+        sorted((e for e in entries if isinstance(e['name'], tuple)),
+               key=lambda e: e['name'])
+
+
+def _entity_groupings(dataset_ids):
+    """
+    Cell lines, drugs and missing combinations for one or more datasets
+
+    Each well's drugs are aggregated into a sorted array in the database,
+    so single drugs and drug combinations are handled the same way.
+
+    Cell lines and drugs (or drug combinations) are those present in every
+    dataset. Missing combinations are cell line/drug pairs absent from any
+    one dataset's grid of cell lines and drugs.
+
+    Parameters
+    ----------
+    dataset_ids: list
+        IDs of the datasets
+
+    Returns
+    -------
+    dict
+        The cellLines, drugs and missingCombinations groupings entries
+    """
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'WITH wells AS ('
+            ' SELECT p.dataset_id, w.cell_line_id, '
+            ' array_agg(wd.drug_id ORDER BY wd.drug_id) AS drug_ids '
+            ' FROM {welldrug} wd '
+            ' JOIN {well} w ON w.id = wd.well_id '
+            ' JOIN {plate} p ON p.id = w.plate_id '
+            ' WHERE p.dataset_id = ANY(%(dataset_ids)s) '
+            ' AND wd.drug_id IS NOT NULL AND wd.dose > 0 '
+            ' AND w.cell_line_id IS NOT NULL '
+            ' GROUP BY p.dataset_id, w.id, w.cell_line_id'
+            '), combos AS ('
+            ' SELECT DISTINCT dataset_id, cell_line_id, drug_ids FROM wells'
+            ') '
+            "SELECT 'cell_line', cell_line_id, NULL::integer[] FROM combos "
+            'GROUP BY cell_line_id '
+            'HAVING COUNT(DISTINCT dataset_id) = %(num_datasets)s '
+            'UNION ALL '
+            "SELECT 'drug', NULL, drug_ids FROM combos "
+            'GROUP BY drug_ids '
+            'HAVING COUNT(DISTINCT dataset_id) = %(num_datasets)s '
+            'UNION ALL '
+            "SELECT DISTINCT 'missing', c.cell_line_id, d.drug_ids "
+            'FROM (SELECT DISTINCT dataset_id, cell_line_id FROM combos) c '
+            'JOIN (SELECT DISTINCT dataset_id, drug_ids FROM combos) d '
+            'ON d.dataset_id = c.dataset_id '
+            'LEFT JOIN combos ON combos.dataset_id = c.dataset_id '
+            'AND combos.cell_line_id = c.cell_line_id '
+            'AND combos.drug_ids = d.drug_ids '
+            'WHERE combos.dataset_id IS NULL'.format(
+                welldrug=qn(WellDrug._meta.db_table),
+                well=qn(Well._meta.db_table),
+                plate=qn(Plate._meta.db_table)),
+            {'dataset_ids': list(dataset_ids),
+             'num_datasets': len(dataset_ids)}
+        )
+        rows = cursor.fetchall()
+
+    cell_line_ids = [cl_id for kind, cl_id, _ in rows if kind == 'cell_line']
+    drug_sets = [tuple(drug_ids) for kind, _, drug_ids in rows
+                 if kind == 'drug']
+
+    cell_line_names = dict(CellLine.objects.filter(
+        id__in=cell_line_ids).values_list('id', 'name'))
+    drug_names = dict(Drug.objects.filter(
+        id__in={d_id for ds in rows if ds[2] for d_id in ds[2]}
+    ).values_list('id', 'name'))
+
+    # Drug combinations are listed in name order, which the plots page
+    # also uses to identify them in missingCombinations
+    def drug_entry(drug_ids):
+        if len(drug_ids) == 1:
+            return {'id': drug_ids[0], 'name': drug_names[drug_ids[0]]}
+        drug_ids, names = zip(*sorted(
+            ((d_id, drug_names[d_id]) for d_id in drug_ids),
+            key=lambda d: d[1]))
+        return {'id': drug_ids, 'name': names}
+
+    missing_combos = []
+    for kind, cl_id, drug_ids in rows:
+        if kind == 'missing':
+            entry_ids = drug_entry(drug_ids)['id']
+            if not isinstance(entry_ids, tuple):
+                entry_ids = (entry_ids, )
+            missing_combos.append(
+                (str(cl_id), tuple(str(d_id) for d_id in entry_ids)))
 
-    cell_lines = _combine_id_name_dicts(groups[i]['cellLines'] for i in grp_it)
-    drugs = _combine_id_name_dicts(groups[i]['drugs'] for i in grp_it)
+    return {
+        'cellLines': sorted(
+            ({'id': cl_id, 'name': cell_line_names[cl_id]}
+             for cl_id in cell_line_ids),
+            key=lambda cl: cl['name'].lower()),
+        'drugs': _sort_id_name_dicts(drug_entry(ds) for ds in drug_sets),
+        'missingCombinations': missing_combos
+    }
 
-    missing_combinations = set().union(*(groups[i]['missingCombinations'] for
-                                       i in grp_it))
-    missing_combinations = list(missing_combinations)
+
+def _multi_dataset_groupings(datasets, regenerate_cache=False):
+    """
+    Groupings for comparing datasets, computed for all of them at once
+
+    The result is cached under a key for the combination of datasets,
+    along with the groupings version of each dataset. Regenerating or
+    renaming a dataset's groupings changes its version.
+    """
+    datasets = list(datasets)
+    dataset_ids = [d.id for d in datasets]
+    cache_key = 'datasets_{}_groupings'.format(
+        '_'.join(str(d_id) for d_id in dataset_ids))
+    versions = _groupings_versions(datasets)
+
+    if not regenerate_cache:
+        cache_val = tiered_cache.get(cache_key)
+        if cache_val is not None and cache_val[0] == versions:
+            return cache_val[1]
+
+    entities = _entity_groupings(dataset_ids)
+
+    assays = defaultdict(set)
+    timepoints = defaultdict(set)
+    for row in WellMeasurement.objects.filter(
+            dataset_id__in=dataset_ids).values(
+            'dataset_id', 'assay', 'timepoint').distinct():
+        if row['assay'] is not None:
+            assays[row['dataset_id']].add(row['assay'])
+        timepoints[row['dataset_id']].add(row['timepoint'])
+    assays = [[{'id': a, 'name': a} for a in assays[d_id]]
+              for d_id in dataset_ids]
 
     single_timepoint = False
-    timepoints = list(set(groups[i]['singleTimepoint'] for i in grp_it))
-    if len(timepoints) == 1 and timepoints[0] is not False:
-        single_timepoint = timepoints[0]
+    all_timepoints = set().union(*timepoints.values())
+    if len(all_timepoints) == 1 and all(
+            len(timepoints[d_id]) == 1 for d_id in dataset_ids):
+        single_timepoint = all_timepoints.pop()
 
-    return {
-        'datasets': list(groups[i]['datasets'][0] for i in grp_it),
-        'cellLines': cell_lines,
-        'drugs': drugs,
-        'assays': [groups[i]['assays'][0] for i in grp_it],
-        'dipAssay': [groups[i]['dipAssay'] for i in grp_it],
+    groupings_dict = {
+        'datasets': [{'id': d.id, 'name': d.name} for d in datasets],
+        'cellLines': entities['cellLines'],
+        'drugs': entities['drugs'],
+        'assays': assays,
+        'dipAssay': [_choose_dip_assay(a) for a in assays],
         'singleTimepoint': single_timepoint,
-        'missingCombinations': missing_combinations
+        'missingCombinations': entities['missingCombinations']
     }
 
+    tiered_cache.set(cache_key, (versions, groupings_dict), timeout=None)
 
-def _combine_id_name_dicts(dicts):
-    dicts = list(dicts)
-    combined = {k['id']: k for k in dicts[0]}
-    for d in dicts[1:]:
-        d_ids = set(k['id'] for k in d)
-        for k in combined.keys() - d_ids:
-            del combined[k]
-
-    try:
-        def sort_key(e):
-            return e['name'].lower() if not isinstance(e['name'], tuple) else e['name']
-        return sorted(combined.values(), key=sort_key)
-    except TypeError:
-        # Dataset contains single drugs and combinations, sort them separately
-        return sorted((e for e in combined.values()
-                       if not isinstance(e['name'], tuple)),
-                      key=lambda e: e['name'].lower()) + \
-               sorted((e for e in combined.values()
-                       if isinstance(e['name'], tuple)),
-                      key=lambda e: e['name'])
+    return groupings_dict
 
 
 def _dataset_groupings(dataset, regenerate_cache=False):
     cache_key = 'dataset_{}_groupings'.format(dataset.id)
 
     if not regenerate_cache:
-        cache_val = cache.get(cache_key)
+        cache_val = tiered_cache.get(cache_key)
         if cache_val is not None:
             return cache_val
 
-    cell_line_names = {cl.pk: cl.name for cl in CellLine.objects.all()}
-
     assays_query = WellMeasurement.objects.filter(
-        well__plate__dataset_id=dataset.id
+        dataset_id=dataset.id
     ).values('assay', 'timepoint').distinct()
 
     assays = set(a['assay'] for a in assays_query)
@@ -412,90 +685,98 @@ def _dataset_groupings(dataset, regenerate_cache=False):
 
     timepoints = list(set(a['timepoint'] for a in assays_query))
 
-    has_drug_combos = has_drug_combinations(dataset.id, use_cache=False)
-
-    # Get drug without combinations
-    drug_objs = WellDrug.objects.filter(
-        drug__isnull=False,
-        dose__gt=0,
-        well__plate__dataset_id=dataset.id,
-    ).values('well__cell_line', 'drug_id', 'drug__name')
-
-    if settings.DATABASE_SETTING == 'postgres' and not has_drug_combos:
-        drug_objs = drug_objs.distinct('well__cell_line', 'drug_id')
-    else:
-        drug_objs = drug_objs.distinct()
-
-    if has_drug_combos:
-        drug_objs = drug_objs.annotate(
-            num_drugs=Count('well__welldrug')).filter(num_drugs=1)
-
-    drug_list = set((dr['drug_id'], dr['drug__name']) for dr in
-                    drug_objs)
-    drug_list = sorted(drug_list, key=lambda d: d[1].lower())
-    drug_list = [{'id': d[0], 'name': d[1]} for d in drug_list]
-
-    combos = set((dr['well__cell_line'], dr['drug_id']) for dr in drug_objs)
-    cell_line_ids = set(c[0] for c in combos)
-    drug_ids = set(c[1] for c in combos)
-
-    missing_combos = []
-    for cl in cell_line_ids:
-        for dr in drug_ids:
-            if (cl, dr) not in combos:
-                missing_combos.append((str(cl), (str(dr), )))
-
-    if has_drug_combos:
-        # Get drugs with combinations... this is inefficient but works
-        # for arbitrary numbers of drugs per well
-        drug_objs_combos = WellDrug.objects.filter(
-            drug__isnull=False,
-            dose__isnull=False,
-            well__plate__dataset_id=dataset.id
-        ).annotate(drug2_id=F('well__welldrug__drug_id')
-                   ).exclude(drug_id=F('drug2_id')).values(
-            'well_id', 'well__cell_line', 'drug_id', 'drug__name') \
-            .distinct()
-
-        drug_well_combos = defaultdict(set)
-        for d in drug_objs_combos:
-            cell_line_ids.add(d['well__cell_line'])
-            drug_well_combos[d['well_id']].add((d['drug_id'],
-                                                d['drug__name']))
-
-        # TODO: Add missing_combos for drug combinations
-
-        drug_combos = set(frozenset(d) for d in drug_well_combos.values())
-
-        for dc in drug_combos:
-            drug_ids, drug_names = zip(*sorted(dc, key=lambda d: d[1]))
-            drug_list.append({'id': drug_ids, 'name': drug_names})
-
-    cell_line_dict = [{'id': cl, 'name': cell_line_names[cl]} for cl in
-                      cell_line_ids]
-    cell_line_dict = sorted(cell_line_dict, key=lambda cl: cl['name'].lower())
+    entities = _entity_groupings([dataset.id])
 
     groupings_dict = {
         'datasets': [{'id': dataset.id, 'name': dataset.name}],
-        'cellLines': cell_line_dict,
-        'drugs': drug_list,
+        'cellLines': entities['cellLines'],
+        'drugs': entities['drugs'],
         'assays': [assays],
         'dipAssay': _choose_dip_assay(assays),
         'singleTimepoint': timepoints[0] if len(timepoints) == 1 else False,
-        'missingCombinations': missing_combos
+        'missingCombinations': entities['missingCombinations']
     }
 
-    cache.set(cache_key, groupings_dict, timeout=None)
+    tiered_cache.set(cache_key, groupings_dict, timeout=None)
+    _bump_groupings_version(dataset.id)
 
     return groupings_dict
 
 
 def rename_dataset_in_cache(dataset_id, dataset_name):
+    _bump_groupings_version(dataset_id)
+
     cache_key = 'dataset_{}_groupings'.format(dataset_id)
-    groupings_dict = cache.get(cache_key)
+    groupings_dict = tiered_cache.get(cache_key)
     if groupings_dict is None:
         return
 
-    groupings_dict['datasets'][0]['name'] = dataset_name
+    groupings_dict = dict(groupings_dict, datasets=[
+        dict(groupings_dict['datasets'][0], name=dataset_name)])
+
+    tiered_cache.set(cache_key, groupings_dict, timeout=None)
+
+
+def process_chunked_upload(upload_id):
+    """
+    Parse a finished chunked upload and update the dataset's calculations
+
+    The upload is claimed by changing its status from pending to
+    processing, so it's only processed once even if several workers try.
+    The outcome is stored in the upload's status and result, and the
+    assembled file is removed.
+
+    Parameters
+    ----------
+    upload_id: uuid.UUID
+        ID of the ChunkedUpload
+
+    Returns
+    -------
+    bool
+        True if the upload was claimed and processed by this call
+    """
+    if not ChunkedUpload.objects.filter(
+            id=upload_id, status=ChunkedUpload.STATUS_PENDING).update(
+            status=ChunkedUpload.STATUS_PROCESSING):
+        return False
+
+    upload = ChunkedUpload.objects.select_related('dataset').get(
+        id=upload_id)
+    try:
+        with transaction.atomic(), open(upload.path, 'rb') as f:
+            plate_file = File(f, name=upload.file_name)
+            if upload.result and upload.result.get('sha256'):
+                plate_file.sha256 = upload.result['sha256']
+            res = PlateFileParser(plate_file, dataset=upload.dataset) \
+                .parse_all()[0]
+            if res['success'] and not res['duplicate']:
+                precalculate_dip_rates(upload.dataset)
+                precalculate_dip_curves(upload.dataset)
+                precalculate_viability(upload.dataset)
+                dataset_groupings(upload.dataset, regenerate_cache=True)
+    except PlateFileParseException as e:
+        res = {'success': False, 'error': e}
+    except Exception:
+        logger.exception('Error processing chunked upload %s', upload_id)
+        res = {'success': False,
+               'error': 'An unexpected error occurred while processing the '
+                        'file. Please contact the site administrator.'}
+
+    if res['success']:
+        upload.status = ChunkedUpload.STATUS_COMPLETE
+        upload.result = dict(upload.result or {},
+                             plateFileId=res['id'],
+                             fileFormat=res['file_format'],
+                             duplicate=res['duplicate'])
+    else:
+        upload.status = ChunkedUpload.STATUS_FAILED
+        upload.result = dict(upload.result or {}, error=str(res['error']))
+    upload.save(update_fields=['status', 'result', 'modified_date'])
+
+    try:
+        os.remove(upload.path)
+    except FileNotFoundError:
+        pass
 
-    cache.set(cache_key, groupings_dict, timeout=None)
+    return True
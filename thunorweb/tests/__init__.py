@@ -1,5 +1,60 @@
 import importlib.resources
+import json
+
+from django.contrib.auth import get_user_model
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from thunorweb.models import HTSDataset
+
+HTTP_OK = 200
+HTTP_NOT_FOUND = 404
+HTTP_REDIRECT = 302
 
 
 def get_thunor_test_file(filename):
     return importlib.resources.files('thunor').joinpath(filename)
+
+
+class DatasetTestCase(TestCase):
+    """
+    Tests using a dataset, d, uploaded from thunor's hts007 test file
+
+    The dataset is owned by user. other_user has no access to it.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        UserModel = get_user_model()
+        cls.user = UserModel.objects.create_user(
+            email='test@example.com', password='test')
+        cls.other_user = UserModel.objects.create_user(
+            email='test2@example.com', password='test')
+        c = Client()
+        c.force_login(cls.user)
+
+        resp = c.post(reverse('thunorweb:ajax_create_dataset'),
+                      {'name': 'test'})
+        resp_json = json.loads(resp.content)
+        dataset_id = resp_json['id']
+        cls.d = HTSDataset.objects.get(pk=dataset_id)
+
+        with open(get_thunor_test_file('testdata/hts007.h5'), 'rb') as hts007:
+            response = c.post(reverse('thunorweb:ajax_upload_platefiles'),
+                              {'file_field[]': hts007,
+                               'dataset_id': cls.d.id})
+
+        assert response.status_code == HTTP_OK
+        assert cls.d.plate_set.count() == 16
+
+    def check_view_access_status(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, HTTP_REDIRECT)
+
+        self.client.force_login(self.user)
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, HTTP_OK)
+
+        self.client.force_login(self.other_user)
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, HTTP_NOT_FOUND)
+        self.client.logout()
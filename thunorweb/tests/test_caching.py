@@ -0,0 +1,77 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+
+from thunorweb.caching import (
+    GENERATION_CACHE_KEY,
+    INVALIDATION_LOG_CACHE_KEY,
+    TwoTierCache,
+)
+
+
+class TestTwoTierCache(SimpleTestCase):
+    def test_invalidation_across_processes(self):
+        backend = LocMemCache('thunor-test-two-tier', {})
+        # Each instance stands in for a separate process
+        cache_a = TwoTierCache(backend, max_entries=2, ttl=60,
+                               poll_interval=0)
+        cache_b = TwoTierCache(backend, max_entries=2, ttl=60,
+                               poll_interval=0)
+
+        cache_a.set('key', 1)
+        self.assertEqual(cache_b.get('key'), 1)
+
+        # Served from cache_b's local copy, even if the backend loses it
+        backend.set('key', 2)
+        self.assertEqual(cache_b.get('key'), 1)
+
+        cache_a.set('key', 3)
+        self.assertEqual(cache_b.get('key'), 3)
+
+        cache_a.delete('key')
+        self.assertIsNone(cache_b.get('key'))
+
+    def test_only_written_keys_invalidated(self):
+        backend = LocMemCache('thunor-test-two-tier-keys', {})
+        cache_a = TwoTierCache(backend, max_entries=4, ttl=60,
+                               poll_interval=0)
+        cache_b = TwoTierCache(backend, max_entries=4, ttl=60,
+                               poll_interval=0)
+
+        cache_a.set('a', 1)
+        cache_a.set('b', 2)
+        self.assertEqual(cache_b.get('a'), 1)
+        self.assertEqual(cache_b.get('b'), 2)
+
+        cache_a.set('b', 3)
+        self.assertEqual(cache_b.get('b'), 3)
+        self.assertIn('a', cache_b._entries)
+
+        # A missing log entry means the written key isn't known
+        cache_a.set('b', 4)
+        backend.delete(INVALIDATION_LOG_CACHE_KEY.format(
+            backend.get(GENERATION_CACHE_KEY)))
+        self.assertEqual(cache_b.get('b'), 4)
+        self.assertNotIn('a', cache_b._entries)
+
+    def test_values_copied(self):
+        backend = LocMemCache('thunor-test-two-tier-copy', {})
+        tiered = TwoTierCache(backend, max_entries=2, ttl=60,
+                              poll_interval=60)
+        value = {'drugs': [1, 2]}
+        tiered.set('key', value)
+        value['drugs'].append(3)
+
+        cached = tiered.get('key')
+        self.assertEqual(cached, {'drugs': [1, 2]})
+        cached['drugs'].append(4)
+        cached['drugTags'] = []
+        self.assertEqual(tiered.get('key'), {'drugs': [1, 2]})
+
+    def test_lru_eviction(self):
+        backend = LocMemCache('thunor-test-two-tier-lru', {})
+        tiered = TwoTierCache(backend, max_entries=2, ttl=60,
+                              poll_interval=60)
+        for key in ('a', 'b', 'c'):
+            tiered.set(key, key)
+        self.assertEqual(list(tiered._entries.keys()), ['b', 'c'])
+        self.assertEqual(tiered.get('a'), 'a')
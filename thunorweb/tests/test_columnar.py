@@ -0,0 +1,29 @@
+from importlib.util import find_spec
+from unittest import skipUnless
+
+from django.urls import reverse
+
+from thunorweb.tests import DatasetTestCase
+
+HTTP_OK = 200
+
+
+class TestColumnarDownloads(DatasetTestCase):
+    @skipUnless(find_spec('pyarrow'), 'needs the columnar extra (pyarrow)')
+    def test_download_columnar(self):
+        self.client.force_login(self.user)
+        for table in ('dataset', 'dip_rates'):
+            for file_format, content_type in (
+                    ('parquet', 'application/vnd.apache.parquet'),
+                    ('arrow', 'application/vnd.apache.arrow.file')):
+                resp = self.client.get(reverse(
+                    'thunorweb:download_columnar',
+                    args=[self.d.id, table, file_format]))
+
+                self.assertEqual(resp.status_code, HTTP_OK)
+                self.assertEqual(resp['Content-Type'], content_type)
+
+    def test_download_columnar_access(self):
+        self.check_view_access_status(
+               reverse('thunorweb:download_columnar',
+                       args=[self.d.id, 'dataset', 'parquet']))
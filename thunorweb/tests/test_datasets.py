@@ -1,44 +1,17 @@
 import json
 
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from django.test import Client, TestCase
 from django.urls import reverse
 
 from thunorweb.models import HTSDataset
-from thunorweb.tests import get_thunor_test_file
+from thunorweb.tests import DatasetTestCase
 
 HTTP_OK = 200
 HTTP_NOT_FOUND = 404
 HTTP_UNAUTHORIZED = 401
-HTTP_REDIRECT = 302
-
-
-class TestDatasetViews(TestCase):
-    @classmethod
-    def setUpTestData(cls):
-        UserModel = get_user_model()
-        cls.user = UserModel.objects.create_user(
-            email='test@example.com', password='test')
-        cls.other_user = UserModel.objects.create_user(
-            email='test2@example.com', password='test')
-        c = Client()
-        c.force_login(cls.user)
-
-        resp = c.post(reverse('thunorweb:ajax_create_dataset'),
-                      {'name': 'test'})
-        resp_json = json.loads(resp.content)
-        dataset_id = resp_json['id']
-        cls.d = HTSDataset.objects.get(pk=dataset_id)
-
-        with open(get_thunor_test_file('testdata/hts007.h5'), 'rb') as hts007:
-            response = c.post(reverse('thunorweb:ajax_upload_platefiles'),
-                              {'file_field[]': hts007,
-                               'dataset_id': cls.d.id})
-
-        assert response.status_code == HTTP_OK
-        assert cls.d.plate_set.count() == 16
 
+
+class TestDatasetViews(DatasetTestCase):
     def test_rename_dataset(self):
         self.client.force_login(self.user)
         d = HTSDataset.objects.create(owner=self.user, name='test123')
@@ -195,16 +168,3 @@ class TestDatasetViews(TestCase):
             'thunorweb:ajax_get_datasets_by_group', args=['Public']))
         resp_content = json.loads(resp.content)
         self.assertEqual(len(resp_content['data']), 0)
-
-    def check_view_access_status(self, url):
-        resp = self.client.get(url)
-        self.assertEqual(resp.status_code, HTTP_REDIRECT)
-
-        self.client.force_login(self.user)
-        resp = self.client.get(url)
-        self.assertEqual(resp.status_code, HTTP_OK)
-
-        self.client.force_login(self.other_user)
-        resp = self.client.get(url)
-        self.assertEqual(resp.status_code, HTTP_NOT_FOUND)
-        self.client.logout()
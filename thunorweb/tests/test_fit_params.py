@@ -0,0 +1,125 @@
+import io
+
+import numpy as np
+import pandas as pd
+from django.urls import reverse
+from thunor.curve_fit import fit_params_from_base
+
+from thunorweb.models import CurveFit
+from thunorweb.pandas import (
+    STANDARD_FIT_PARAMS,
+    df_curve_fits,
+)
+from thunorweb.tasks import dataset_groupings
+from thunorweb.tests import DatasetTestCase
+from thunorweb.views.dataset_downloads import (
+    FIT_PARAM_NAMES,
+    _generate_fit_params,
+)
+
+HTTP_OK = 200
+HTTP_INVALID_REQUEST = 400
+
+
+class TestFitParams(DatasetTestCase):
+    def test_precomputed_fit_params(self):
+        base_params = df_curve_fits(self.d.id, 'dip', drug_ids=None,
+                                    cell_line_ids=None,
+                                    include_fit_params=True)
+        self.assertTrue(base_params.attrs['fit_params_precomputed'])
+
+        calculated = fit_params_from_base(
+            base_params.drop(columns=list(STANDARD_FIT_PARAMS)),
+            custom_ic_concentrations={50},
+            custom_ec_concentrations={50},
+            include_aa=True,
+            include_hill=True,
+            include_emax=True,
+            include_einf=True,
+            include_response_values=False
+        )
+        for param in STANDARD_FIT_PARAMS:
+            np.testing.assert_allclose(
+                base_params[param].to_numpy(dtype=float),
+                calculated[param].to_numpy(dtype=float),
+                err_msg=param)
+
+    def _fit_params_from_curves(self, stat_type):
+        """ Fit parameters calculated from the curves, without stored values """
+        fp = fit_params_from_base(
+            df_curve_fits(self.d.id, stat_type, drug_ids=None,
+                          cell_line_ids=None),
+            custom_ic_concentrations={50},
+            custom_ec_concentrations={50},
+            include_aa=True,
+            include_hill=True,
+            include_emax=True,
+            include_einf=True,
+            include_response_values=False
+        )
+        fp.reset_index('dataset_id', drop=True, inplace=True)
+        return fp
+
+    def test_precomputed_fit_params_drpar_csv(self):
+        expected = self._fit_params_from_curves('dip')
+        groupings = dataset_groupings(self.d)
+        self.client.force_login(self.user)
+        for param in ('ic50', 'ec50', 'emax', 'emax_rel', 'einf', 'aa',
+                      'hill'):
+            resp = self.client.get(
+                reverse('thunorweb:ajax_plot', args=['csv']), {
+                    'plotType': 'drpar',
+                    'datasetId': self.d.id,
+                    'c': [c['id'] for c in groupings['cellLines']],
+                    'd': [d['id'] for d in groupings['drugs']],
+                    'drMetric': 'dip',
+                    'drPar': param,
+                    'download': '1'
+                })
+            self.assertEqual(resp.status_code, HTTP_OK)
+            plotted = pd.read_csv(
+                io.StringIO(b''.join(resp.streaming_content).decode()),
+                index_col=['dataset_id', 'cell_line', 'drug'])
+            plotted.reset_index('dataset_id', drop=True, inplace=True)
+            self.assertEqual(len(plotted), len(expected))
+            np.testing.assert_allclose(
+                plotted[param].to_numpy(dtype=float),
+                expected.loc[plotted.index, param].to_numpy(dtype=float),
+                err_msg=param)
+
+    def test_precomputed_fit_params_tsv(self):
+        for stat_type in ('dip', 'viability'):
+            expected = self._fit_params_from_curves(stat_type)
+            expected.loc[expected['aa'] < 0.0, 'aa'] = np.nan
+            with _generate_fit_params(self.d, stat_type,
+                                      regenerate_cache=True).file.open(
+                    'rb') as f:
+                downloaded = pd.read_csv(f, sep='\t',
+                                         index_col=['cell_line', 'drug'])
+            self.assertEqual(tuple(downloaded.columns),
+                             FIT_PARAM_NAMES[stat_type])
+            for param in FIT_PARAM_NAMES[stat_type]:
+                np.testing.assert_allclose(
+                    downloaded[param].to_numpy(dtype=float),
+                    expected.loc[downloaded.index, param].to_numpy(
+                        dtype=float),
+                    err_msg='{} {}'.format(stat_type, param))
+
+    def test_precomputed_aa_fit_warning(self):
+        fit = CurveFit.objects.filter(fit_set__dataset=self.d,
+                                      fit_set__stat_type='dip').first()
+        fit.aa_warning = 'AA may be unreliable'
+        fit.save(update_fields=['aa_warning'])
+
+        self.client.force_login(self.user)
+        resp = self.client.get(
+            reverse('thunorweb:ajax_plot', args=['json']), {
+                'plotType': 'drpar',
+                'datasetId': self.d.id,
+                'c': fit.cell_line_id,
+                'd': fit.drug_id,
+                'drMetric': 'dip',
+                'drPar': 'aa'
+            })
+        self.assertEqual(resp.status_code, HTTP_INVALID_REQUEST)
+        self.assertEqual(resp.content.decode(), 'AA may be unreliable')
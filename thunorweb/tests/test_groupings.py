@@ -0,0 +1,77 @@
+from django.test import override_settings
+
+from thunorweb.caching import tiered_cache
+from thunorweb.models import (
+    CellLine,
+    Drug,
+    HTSDataset,
+    Plate,
+    Well,
+    WellDrug,
+)
+from thunorweb.tasks import (
+    _multi_dataset_groupings,
+    dataset_groupings,
+    rename_dataset_in_cache,
+)
+from thunorweb.tests import DatasetTestCase
+
+
+class TestGroupings(DatasetTestCase):
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'thunor-test-groupings'}})
+    def test_multi_dataset_groupings(self):
+        tiered_cache.clear_local()
+        single = dataset_groupings(self.d)
+        # All datasets are computed in one pass, so a single dataset should
+        # give the same cell lines, drugs and missing combinations
+        multi = _multi_dataset_groupings([self.d])
+        for key in ('cellLines', 'drugs', 'singleTimepoint'):
+            self.assertEqual(multi[key], single[key])
+        self.assertEqual(sorted(multi['missingCombinations']),
+                         sorted(single['missingCombinations']))
+
+        empty = HTSDataset.objects.create(owner=self.user, name='empty')
+        groupings = dataset_groupings([self.d, empty])
+        self.assertEqual(groupings['cellLines'], [])
+        self.assertEqual(groupings['drugs'], [])
+        self.assertEqual(groupings['datasets'][1]['name'], 'empty')
+
+        # Renaming a dataset invalidates the combined entry
+        empty.name = 'renamed'
+        HTSDataset.objects.filter(id=empty.id).update(name=empty.name)
+        rename_dataset_in_cache(empty.id, empty.name)
+        with self.assertNumQueries(2):
+            groupings = dataset_groupings([self.d, empty])
+        self.assertEqual(groupings['datasets'][1]['name'], 'renamed')
+        with self.assertNumQueries(0):
+            dataset_groupings([self.d, empty])
+
+    def test_drug_combination_groupings(self):
+        dataset = HTSDataset.objects.create(owner=self.user, name='combos')
+        plate = Plate.objects.create(dataset=dataset, name='plate',
+                                     width=2, height=2)
+        cl1, cl2 = (CellLine.objects.create(name=n)
+                    for n in ('combo-cl1', 'combo-cl2'))
+        dr_b, dr_a = (Drug.objects.create(name=n)
+                      for n in ('combo-drug-b', 'combo-drug-a'))
+        well_drugs = [(cl1, [dr_a]), (cl1, [dr_a, dr_b]), (cl2, [dr_a]),
+                      (cl2, [])]
+        for well_num, (cl, drugs) in enumerate(well_drugs):
+            well = Well.objects.create(plate=plate, well_num=well_num,
+                                       cell_line=cl)
+            for order, drug in enumerate(drugs):
+                WellDrug.objects.create(well=well, drug=drug, order=order,
+                                        dose=1e-6)
+
+        groupings = dataset_groupings(dataset, regenerate_cache=True)
+        self.assertEqual([cl['id'] for cl in groupings['cellLines']],
+                         [cl1.id, cl2.id])
+        # Combinations follow single drugs, with drugs in name order
+        self.assertEqual(groupings['drugs'], [
+            {'id': dr_a.id, 'name': dr_a.name},
+            {'id': (dr_a.id, dr_b.id), 'name': (dr_a.name, dr_b.name)}
+        ])
+        self.assertEqual(groupings['missingCombinations'],
+                         [(str(cl2.id), (str(dr_a.id), str(dr_b.id)))])
@@ -0,0 +1,51 @@
+import json
+
+from django.db import connection
+from django.urls import reverse
+
+from thunorweb.models import (
+    WellMeasurement,
+    WellStatistic,
+)
+from thunorweb.partitions import (
+    PARTITIONED_MODELS,
+    create_dataset_partitions,
+    drop_dataset_partitions,
+    partition_name,
+)
+from thunorweb.tests import DatasetTestCase
+
+HTTP_OK = 200
+
+
+class TestPartitions(DatasetTestCase):
+    def test_create_dataset_partitions(self):
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.post(reverse('thunorweb:ajax_create_dataset'),
+                                    {'name': 'partitioned'})
+        self.assertEqual(resp.status_code, HTTP_OK)
+
+        dataset_id = json.loads(resp.content)['id']
+        with connection.cursor() as cursor:
+            for model in PARTITIONED_MODELS:
+                cursor.execute('SELECT to_regclass(%s)', [partition_name(
+                    model._meta.db_table, dataset_id)])
+                self.assertIsNotNone(cursor.fetchone()[0])
+
+    def test_dataset_partitions(self):
+        # Uploaded before the partitions were created, so rows are moved
+        # out of the default partition
+        self.assertEqual(len(create_dataset_partitions(self.d.id)), 2)
+        self.assertTrue(WellMeasurement.objects.filter(
+            dataset_id=self.d.id).exists())
+        self.assertTrue(WellStatistic.objects.filter(
+            dataset_id=self.d.id).exists())
+
+        dropped = drop_dataset_partitions(self.d.id)
+        self.assertEqual(len(dropped), 2)
+
+        self.assertFalse(WellMeasurement.objects.filter(
+            dataset_id=self.d.id).exists())
+        self.assertFalse(WellStatistic.objects.filter(
+            dataset_id=self.d.id).exists())
@@ -0,0 +1,35 @@
+from django.contrib.auth.models import Group
+from django.test import RequestFactory
+from django.urls import reverse
+
+from thunorweb.permissions import has_dataset_perm
+from thunorweb.tests import DatasetTestCase
+
+HTTP_OK = 200
+
+
+class TestPermissionCache(DatasetTestCase):
+    def test_permissions_cached_per_request(self):
+        request = RequestFactory().get('/')
+        request.user = self.other_user
+        with self.assertNumQueries(1):
+            self.assertFalse(has_dataset_perm(request, self.d, 'view_plots'))
+            self.assertFalse(
+                has_dataset_perm(request, self.d, 'download_data'))
+
+        self.client.force_login(self.user)
+        resp = self.client.post(
+            reverse('thunorweb:ajax_set_dataset_group_permission'),
+            {'dataset_id': self.d.id,
+             'group_id': Group.objects.get(name='Public').id,
+             'perm_id': 'view_plots',
+             'state': 'true'
+             }
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+
+        # A new request sees the change, even if permissions were cached
+        request = RequestFactory().get('/')
+        request.user = self.other_user
+        self.assertTrue(has_dataset_perm(request, self.d, 'view_plots'))
+        self.assertFalse(has_dataset_perm(request, self.d, 'download_data'))
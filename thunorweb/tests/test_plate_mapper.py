@@ -4,9 +4,19 @@ from django.contrib.auth import get_user_model
 from django.test import TestCase
 from django.urls import reverse
 
-from thunorweb.models import CellLine, Drug, HTSDataset
+from thunorweb.models import (
+    CellLine,
+    CurveFit,
+    Drug,
+    HTSDataset,
+    Plate,
+    WellDrug,
+)
+from thunorweb.tasks import precalculate_dip_curves
 
 HTTP_OK = 200
+HTTP_BAD_REQUEST = 400
+HTTP_NOT_FOUND = 404
 
 
 class TestPlateMapper(TestCase):
@@ -18,6 +28,9 @@ class TestPlateMapper(TestCase):
         cls.user = UserModel.objects.get(
             email='test@example.com')
 
+        cls.other_user = UserModel.objects.create_user(
+            email='other@example.com', password='test')
+
         cls.d = HTSDataset.objects.get(owner=cls.user, name='test')
 
     def test_load_save_plate(self):
@@ -34,6 +47,7 @@ class TestPlateMapper(TestCase):
             'wells': content['plateMap']['wells']
         }
 
+        modified_date = self.d.modified_date
         resp = self.client.post(
             reverse('thunorweb:ajax_save_plate'),
             json.dumps(plate_data),
@@ -41,6 +55,125 @@ class TestPlateMapper(TestCase):
         )
         self.assertEqual(resp.status_code, HTTP_OK)
 
+        # Saving an unchanged plate shouldn't modify the dataset
+        self.assertEqual(json.loads(resp.content)['changes'], {
+            'cellLineWells': 0, 'drugWells': 0, 'controlChangedPlates': []})
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.modified_date, modified_date)
+
+    def _load_plate(self, plate_id):
+        resp = self.client.get(reverse('thunorweb:ajax_load_plate',
+                                       args=[plate_id]))
+        self.assertEqual(resp.status_code, HTTP_OK)
+        return json.loads(resp.content)['plateMap']['wells']
+
+    def test_save_plate_changes(self):
+        plate_id = self.d.plate_set.first().id
+        self.client.force_login(self.user)
+        wells = self._load_plate(plate_id)
+
+        expt_wells = [i for i, w in enumerate(wells)
+                      if any(dose for dose in w['doses'])]
+        drug_well, cleared_well = expt_wells[:2]
+        new_cell_line = CellLine.objects.create(name='test_save_cell_line')
+        new_drug = Drug.objects.create(name='test_save_drug')
+
+        wells[drug_well]['cellLine'] = new_cell_line.id
+        wells[drug_well]['drugs'] = [new_drug.id]
+        wells[drug_well]['doses'] = [1e-6]
+        wells[cleared_well]['drugs'] = []
+        wells[cleared_well]['doses'] = []
+
+        resp = self.client.post(
+            reverse('thunorweb:ajax_save_plate'),
+            json.dumps({'plateId': plate_id, 'wells': wells}),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+        changes = json.loads(resp.content)['changes']
+        self.assertEqual(changes['cellLineWells'], 1)
+        self.assertEqual(changes['drugWells'], 2)
+        self.assertEqual(changes['controlChangedPlates'], [plate_id])
+
+        def annotations(plate_wells):
+            return [(w['cellLine'], w['drugs'], w['doses'])
+                    for w in plate_wells]
+
+        self.assertEqual(annotations(self._load_plate(plate_id)),
+                         annotations(wells))
+
+    def test_save_plate_refits_changed_cell_lines(self):
+        precalculate_dip_curves(self.d)
+        dip_fits = CurveFit.objects.filter(fit_set__dataset=self.d,
+                                           fit_set__stat_type='dip')
+        fit_ids = set(dip_fits.values_list('id', flat=True))
+        self.assertTrue(fit_ids)
+
+        plate_id = self.d.plate_set.first().id
+        self.client.force_login(self.user)
+        wells = self._load_plate(plate_id)
+        empty_well = next(i for i, w in enumerate(wells)
+                          if w['cellLine'] is None and not w['drugs'])
+        wells[empty_well]['cellLine'] = CellLine.objects.create(
+            name='test_refit_cell_line').id
+
+        resp = self.client.post(
+            reverse('thunorweb:ajax_save_plate'),
+            json.dumps({'plateId': plate_id, 'wells': wells}),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertEqual(json.loads(resp.content)['changes']['cellLineWells'],
+                         1)
+
+        # The other cell line's fits weren't affected, so they're kept
+        self.assertEqual(set(dip_fits.values_list('id', flat=True)), fit_ids)
+
+    def test_apply_template_missing_wells(self):
+        # A plate whose wells haven't been created yet
+        plate = Plate.objects.create(dataset=self.d, name='empty_plate',
+                                     width=24, height=16)
+        drug = Drug.objects.create(name='test_template_drug')
+        wells = [{'cellLine': None, 'drugs': [], 'doses': []}
+                 for _ in range(plate.width * plate.height)]
+        wells[0]['drugs'] = [drug.id]
+        self.client.force_login(self.user)
+
+        resp = self.client.post(
+            reverse('thunorweb:ajax_save_plate'),
+            json.dumps({'applyTemplateTo': [plate.id],
+                        'applyTemplateMode': 'drugs',
+                        'wells': wells}),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, HTTP_BAD_REQUEST)
+        self.assertFalse(WellDrug.objects.filter(drug=drug).exists())
+        plate.refresh_from_db()
+        self.assertIsNone(plate.last_annotated)
+
+    def test_load_plates(self):
+        plate_ids = list(self.d.plate_set.values_list('id', flat=True)[:2])
+        self.client.force_login(self.user)
+        resp = self.client.get(reverse('thunorweb:ajax_load_plates'),
+                               {'plateId': plate_ids})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        plates = json.loads(resp.content)['plates']
+        self.assertEqual([p['plateId'] for p in plates], plate_ids)
+
+        for plate in plates:
+            wells = self._load_plate(plate['plateId'])
+            self.assertEqual(plate['cellLines'],
+                             [w['cellLine'] for w in wells])
+            self.assertEqual(plate['drugs'], [w['drugs'] for w in wells])
+            self.assertEqual(plate['doses'], [w['doses'] for w in wells])
+            self.assertEqual(plate['dipRates'],
+                             [w['dipRate'] for w in wells])
+
+        self.client.force_login(self.other_user)
+        resp = self.client.get(reverse('thunorweb:ajax_load_plates'),
+                               {'plateId': plate_ids})
+        self.assertEqual(resp.status_code, HTTP_NOT_FOUND)
+
     def test_create_cell_line(self):
         self.client.force_login(self.user)
         resp = self.client.post(reverse('thunorweb:ajax_create_cellline'),
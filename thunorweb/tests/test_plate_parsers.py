@@ -5,7 +5,7 @@ from django.contrib.auth import get_user_model
 from django.core.files import File
 from django.test import TestCase
 
-from thunorweb.models import HTSDataset
+from thunorweb.models import HTSDataset, Plate, PlateFile
 from thunorweb.plate_parsers import PlateFileParser
 from thunorweb.tests import get_thunor_test_file
 
@@ -50,3 +50,66 @@ class TestPlateParsers(TestCase):
         assert len(results) == 1
         assert results[0]['success']
         assert results[0]['file_format'] == 'IncuCyte Zoom'
+
+    def test_reupload_deduplicated(self):
+        with open(get_thunor_test_file('testdata/test_incucyte_minimal.txt'),
+                  'rb') as testfile:
+            contents = testfile.read()
+
+        def parse(dataset):
+            pfp = PlateFileParser(File(io.BytesIO(contents), name='test.txt'),
+                                  dataset=dataset)
+            return pfp.parse_all()[0]
+
+        first = parse(self.d)
+        assert first['success'] and not first['duplicate']
+
+        # Uploading the same contents to the same dataset is a no-op
+        second = parse(self.d)
+        assert second['success'] and second['duplicate']
+        assert second['id'] == first['id']
+        assert PlateFile.objects.filter(dataset=self.d).count() == 1
+
+        # Another dataset gets its own record, but shares the stored file
+        other = HTSDataset.objects.create(name='other', owner=self.user)
+        third = parse(other)
+        assert third['success'] and not third['duplicate']
+        pf1, pf3 = (PlateFile.objects.get(id=r['id']) for r in (first, third))
+        assert pf1.file.name == pf3.file.name
+        assert pf1.sha256 == pf3.sha256
+        assert pf3.file_name == 'test.txt'
+
+    def test_validate_only(self):
+        with open(get_thunor_test_file('testdata/test_incucyte_minimal.txt'),
+                  'rb') as testfile:
+            contents = testfile.read()
+
+        def validate(n_copies, dataset):
+            pfp = PlateFileParser(
+                [File(io.BytesIO(contents), name='test{}.txt'.format(i))
+                 for i in range(n_copies)],
+                dataset=dataset, validate_only=True)
+            return pfp.parse_all()
+
+        results = validate(1, None)
+        assert results[0]['success']
+        assert results[0]['file_format'] == 'IncuCyte Zoom'
+        assert not Plate.objects.filter(dataset=self.d).exists()
+        assert not PlateFile.objects.filter(dataset=self.d).exists()
+
+        # Plate names must be unique within a batch
+        results = validate(2, self.d)
+        assert results[0]['success']
+        assert not results[1]['success']
+        assert 'already exists' in results[1]['problems'][0]
+
+        assert not Plate.objects.filter(dataset=self.d).exists()
+
+        # Files already imported would be skipped
+        pfp = PlateFileParser(File(io.BytesIO(contents), name='test.txt'),
+                              dataset=self.d)
+        assert pfp.parse_all()[0]['success']
+        n_plates = Plate.objects.filter(dataset=self.d).count()
+        results = validate(1, self.d)
+        assert results[0]['success'] and results[0]['duplicate']
+        assert Plate.objects.filter(dataset=self.d).count() == n_plates
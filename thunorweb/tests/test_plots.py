@@ -1,13 +1,20 @@
+import gzip
 import json
+from importlib.util import find_spec
+from unittest import skipUnless
+from urllib.parse import urlencode
 
 from django.contrib.auth import get_user_model
 from django.test import Client, TestCase
 from django.urls import reverse
 
 from thunorweb.models import CellLine, CellLineTag, Drug, DrugTag, HTSDataset
+from thunorweb.plotlyjs import PLOTLYJS_PLACEHOLDER, get_plotlyjs
+from thunorweb.views.plots import plot_to_json
 
 HTTP_OK = 200
 HTTP_INVALID_REQUEST = 400
+HTTP_NOT_FOUND = 404
 
 
 class TestPlots(TestCase):
@@ -78,6 +85,40 @@ class TestPlots(TestCase):
         )
         self.assertEqual(resp.status_code, HTTP_OK)
 
+    def test_time_course_downsampled_aggregated(self):
+        self.client.force_login(self.user)
+        url = reverse('thunorweb:ajax_plot', args=['json'])
+        for method in ('lttb', 'minmax'):
+            resp = self.client.get(
+                url,
+                {'plotType': 'tc',
+                 'datasetId': self.d.id,
+                 'c': self.groupings['cellLines'][0]['id'],
+                 'd': self.groupings['drugs'][0]['id'],
+                 'logTransform': 'log2',
+                 'downsamplePoints': 5,
+                 'downsampleMethod': method,
+                 'aggregateWells': 'true'
+                 }
+            )
+            self.assertEqual(resp.status_code, HTTP_OK)
+
+    def test_time_course_downsampled_dip_fit(self):
+        self.client.force_login(self.user)
+        url = reverse('thunorweb:ajax_plot', args=['json'])
+        resp = self.client.get(
+            url,
+            {'plotType': 'tc',
+             'datasetId': self.d.id,
+             'c': self.groupings['cellLines'][0]['id'],
+             'd': self.groupings['drugs'][0]['id'],
+             'overlayDipFit': 'true',
+             'logTransform': 'log2',
+             'downsamplePoints': 5
+             }
+        )
+        self.assertEqual(resp.status_code, HTTP_INVALID_REQUEST)
+
     def test_time_course_csv(self):
         self.client.force_login(self.user)
         url = reverse('thunorweb:ajax_plot', args=['csv'])
@@ -126,6 +167,74 @@ class TestPlots(TestCase):
              }
         )
         self.assertEqual(resp.status_code, HTTP_OK)
+        html = b''.join(resp.streaming_content)
+        self.assertEqual(len(html), int(resp['Content-Length']))
+        self.assertIn(get_plotlyjs().source, html)
+        self.assertNotIn(PLOTLYJS_PLACEHOLDER.encode(), html)
+
+    def test_time_course_html_standalone_gzip(self):
+        self.client.force_login(self.user)
+        url = reverse('thunorweb:ajax_plot', args=['html'])
+        params = {'plotType': 'tc',
+                  'datasetId': self.d.id,
+                  'c': self.groupings['cellLines'][0]['id'],
+                  'd': self.groupings['drugs'][0]['id'],
+                  'assay': self.groupings['dipAssay'] or '',
+                  'download': '1'
+                  }
+        plain = b''.join(self.client.get(url, params).streaming_content)
+
+        resp = self.client.get(url, params, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        compressed = b''.join(resp.streaming_content)
+        self.assertEqual(len(compressed), int(resp['Content-Length']))
+        # Only the generation time may differ
+        self.assertEqual(len(gzip.decompress(compressed)), len(plain))
+
+    @skipUnless(find_spec('brotli'), 'needs the speedups extra (brotli)')
+    def test_plotlyjs_brotli(self):
+        import brotli
+
+        plotlyjs = get_plotlyjs()
+        resp = self.client.get(
+            reverse('thunorweb:ajax_plotlyjs', args=[plotlyjs.checksum]),
+            headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertEqual(resp['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.content), plotlyjs.source)
+
+    def test_time_course_html_standalone_linked_plotlyjs(self):
+        self.client.force_login(self.user)
+        url = reverse('thunorweb:ajax_plot', args=['html'])
+        resp = self.client.get(
+            url,
+            {'plotType': 'tc',
+             'datasetId': self.d.id,
+             'c': self.groupings['cellLines'][0]['id'],
+             'd': self.groupings['drugs'][0]['id'],
+             'assay': self.groupings['dipAssay'] or '',
+             'download': '1',
+             'plotlyJs': 'link'
+             }
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+        plotlyjs = get_plotlyjs()
+        plotlyjs_url = reverse('thunorweb:ajax_plotlyjs',
+                               args=[plotlyjs.checksum])
+        self.assertContains(resp, plotlyjs_url)
+        self.assertNotIn(plotlyjs.source, resp.content)
+
+        # The library is public, so shared files work without a login
+        self.client.logout()
+        resp = self.client.get(plotlyjs_url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertIn('immutable', resp['Cache-Control'])
+        self.assertEqual(gzip.decompress(resp.content), plotlyjs.source)
+
+        resp = self.client.get(reverse('thunorweb:ajax_plotlyjs',
+                                       args=['0' * len(plotlyjs.checksum)]))
+        self.assertEqual(resp.status_code, HTTP_NOT_FOUND)
 
     def test_invalid_format(self):
         self.client.force_login(self.user)
@@ -204,6 +313,71 @@ class TestPlots(TestCase):
         )
         self.assertEqual(resp.status_code, HTTP_OK)
 
+    def test_time_course_typed_arrays_gzip(self):
+        self.client.force_login(self.user)
+        url = reverse('thunorweb:ajax_plot', args=['json'])
+        resp = self.client.get(
+            url,
+            {'plotType': 'tc',
+             'datasetId': self.d.id,
+             'c': self.groupings['cellLines'][0]['id'],
+             'd': self.groupings['drugs'][0]['id'],
+             'typedArrays': 'true'
+             },
+            headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        fig = json.loads(gzip.decompress(resp.content))
+        self.assertIn('data', fig)
+
+    def test_plot_batch(self):
+        self.client.force_login(self.user)
+        drc = {
+            'plotType': 'drc',
+            'datasetId': self.d.id,
+            'c': self.groupings['cellLines'][0]['id'],
+            'd': self.groupings['drugs'][0]['id'],
+            'drMetric': 'dip'
+        }
+        ic50 = dict(drc, plotType='drpar', drPar='ic50')
+        invalid = dict(drc, plotType='invalid')
+        resp = self.client.post(
+            reverse('thunorweb:ajax_plots'),
+            {'plot': [urlencode(drc), urlencode(ic50), urlencode(invalid)]}
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+        plots = json.loads(resp.content)['plots']
+        self.assertEqual(len(plots), 3)
+        self.assertIn('data', plots[0])
+        self.assertIn('data', plots[1])
+        self.assertEqual(plots[2]['status'], HTTP_INVALID_REQUEST)
+
+    def test_plot_batch_access(self):
+        self.client.force_login(self.other_user)
+        resp = self.client.post(
+            reverse('thunorweb:ajax_plots'),
+            {'plot': urlencode({'plotType': 'qc', 'qcView': 'ctrldipbox',
+                                'datasetId': self.d.id})}
+        )
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertEqual(json.loads(resp.content)['plots'][0]['status'],
+                         HTTP_NOT_FOUND)
+
+    def test_plot_to_json_typed_arrays(self):
+        fig = {'data': [{'x': list(range(100)),
+                         'y': [0.5] * 99 + [None],
+                         'text': ['a'] * 100}],
+               'layout': {'xaxis': {'range': [0, 100]}}}
+        j = json.loads(plot_to_json(fig, typed_arrays=True))
+        trace = j['data'][0]
+        self.assertEqual(trace['x']['dtype'], 'i4')
+        self.assertEqual(trace['y']['dtype'], 'f8')
+        self.assertEqual(trace['text'], ['a'] * 100)
+        self.assertEqual(j['layout']['xaxis']['range'], [0, 100])
+        # The original figure is unchanged
+        self.assertEqual(fig['data'][0]['x'], list(range(100)))
+
     def test_ic50_ec50_scatter_plot_all_cell_lines(self):
         self.client.force_login(self.user)
         url = reverse('thunorweb:ajax_plot', args=['json'])
@@ -223,6 +397,33 @@ class TestPlots(TestCase):
         )
         self.assertEqual(resp.status_code, HTTP_OK)
 
+    def test_ic50_ec50_csv_all_cell_lines(self):
+        self.client.force_login(self.user)
+        url = reverse('thunorweb:ajax_plot', args=['csv'])
+        argdict = {
+            'plotType': 'drpar',
+            'datasetId': self.d.id,
+            'c': [c['id'] for c in self.groupings['cellLines']],
+            'd': self.groupings['drugs'][0]['id'],
+            'drMetric': 'dip',
+            'drPar': 'ic50',
+            'drParTwo': 'ec50',
+            'download': '1'
+        }
+        resp = self.client.get(url, argdict)
+        self.assertEqual(resp.status_code, HTTP_OK)
+        self.assertTrue(resp.streaming)
+        rows = b''.join(resp.streaming_content).decode().splitlines()
+        self.assertTrue(rows[0].endswith('ic50,ec50'))
+        self.assertEqual(len(rows) - 1, len(self.groupings['cellLines']))
+
+        resp = self.client.get(url, argdict,
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.decompress(b''.join(resp.streaming_content)).decode(),
+            '\n'.join(rows) + '\n')
+
     def test_ic50_ec50_box_plot_tags(self):
         self.client.force_login(self.user)
         url = reverse('thunorweb:ajax_plot', args=['json'])
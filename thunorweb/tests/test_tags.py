@@ -3,12 +3,14 @@ import json
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
 from django.urls import reverse
 
 from thunorweb.models import CellLine, CellLineTag, Drug, DrugTag
+from thunorweb.views.tags import get_tag_index, tags_for_entities
 
 HTTP_OK = 200
+HTTP_INVALID_REQUEST = 400
 
 CSV = """tag_name,tag_category,cell_line
 tag1,tagcat,1321N1
@@ -183,6 +185,53 @@ class TestTags(TestCase):
         self.assertEqual(resp.status_code, HTTP_OK)
         self.assertFalse(DrugTag.objects.filter(id=tag_id).exists())
 
+    def test_tag_index(self):
+        cl_a = CellLine.objects.create(name='index_cl_a')
+        cl_b = CellLine.objects.create(name='index_cl_b')
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.post(reverse('thunorweb:ajax_create_tag'),
+                                    {'tagsName': 'indexTag',
+                                     'tagCategory': 'indexCat',
+                                     'tagType': 'cl',
+                                     'entityId': [cl_a.id]})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        tag_id = json.loads(resp.content)['tagId']
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        tag = get_tag_index(request, 'cell_lines').tags[tag_id]
+        self.assertEqual(tag.entity_ids.tolist(), [cl_a.id])
+        self.assertEqual(
+            [t.id for t in tags_for_entities(request, 'cell_lines',
+                                             [cl_a.id])], [tag_id])
+        self.assertEqual(
+            tags_for_entities(request, 'cell_lines', [cl_b.id]), [])
+
+        # Modifying the tag invalidates the index
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.post(reverse('thunorweb:ajax_assign_tag'),
+                                    {'tagId': tag_id,
+                                     'tagType': 'cl',
+                                     'entityId': [cl_a.id, cl_b.id]})
+        self.assertEqual(resp.status_code, HTTP_OK)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        tag_index = get_tag_index(request, 'cell_lines')
+        self.assertEqual(tag_index.tags[tag_id].entity_ids.tolist(),
+                         sorted([cl_a.id, cl_b.id]))
+        self.assertEqual(tag_index.names[cl_b.id], 'index_cl_b')
+
+        # So does renaming one of its entities
+        with self.captureOnCommitCallbacks(execute=True):
+            cl_b.name = 'index_cl_b_renamed'
+            cl_b.save()
+        tag_index = get_tag_index(request, 'cell_lines')
+        self.assertEqual(tag_index.names[cl_b.id], 'index_cl_b_renamed')
+        self.assertEqual(
+            [t.id for t in tags_for_entities(request, 'cell_lines',
+                                             [cl_b.id, 0])], [tag_id])
+
     def test_upload_cell_line_tags(self):
         CellLine.objects.create(name='1321N1')
         CellLine.objects.create(name='2004')
@@ -197,6 +246,54 @@ class TestTags(TestCase):
         self.assertEqual(CellLineTag.objects.filter(
             tag_category='tagcat').count(), 1)
 
+    def test_upload_tag_memberships(self):
+        cl_a = CellLine.objects.create(name='1321N1')
+        cl_b = CellLine.objects.create(name='2004')
+
+        csv_bytes = io.BytesIO((CSV + 'tag2,tagcat,2004\n'
+                                      'tag0,othercat,1321n1\n').encode())
+        csv_bytes.name = 'test.csv'
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('thunorweb:ajax_upload_tagfile',
+                                            args=['cell_lines']),
+                                    {'tagfiles[]': csv_bytes})
+        self.assertEqual(response.status_code, HTTP_OK)
+
+        memberships = {
+            (tag.tag_category, tag.tag_name):
+                set(tag.cell_lines.values_list('id', flat=True))
+            for tag in CellLineTag.objects.filter(owner=self.user)
+        }
+        self.assertEqual(memberships, {
+            ('tagcat', 'tag1'): {cl_a.id, cl_b.id},
+            ('tagcat', 'tag2'): {cl_b.id},
+            ('othercat', 'tag0'): {cl_a.id}
+        })
+
+    def test_upload_tags_blank_cell(self):
+        CellLine.objects.create(name='1321N1')
+        CellLine.objects.create(name='2004')
+
+        csv_bytes = io.BytesIO((CSV + ',,\n,tagcat,2004\n').encode())
+        csv_bytes.name = 'test.csv'
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('thunorweb:ajax_upload_tagfile',
+                                            args=['cell_lines']),
+                                    {'tagfiles[]': csv_bytes})
+        self.assertEqual(response.status_code, HTTP_INVALID_REQUEST)
+        self.assertIn('line 5', json.loads(response.content)['error'])
+        self.assertFalse(CellLineTag.objects.filter(owner=self.user).exists())
+
+        # Completely empty rows are skipped
+        csv_bytes = io.BytesIO((CSV + ',,\n').encode())
+        csv_bytes.name = 'test.csv'
+        response = self.client.post(reverse('thunorweb:ajax_upload_tagfile',
+                                            args=['cell_lines']),
+                                    {'tagfiles[]': csv_bytes})
+        self.assertEqual(response.status_code, HTTP_OK)
+        self.assertEqual(CellLineTag.objects.filter(
+            owner=self.user).count(), 1)
+
     def test_upload_drug_tags(self):
         Drug.objects.create(name='1321N1')
         Drug.objects.create(name='2004')
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from thunorweb.models import ChunkedUpload, HTSDataset
+from thunorweb.tasks import process_chunked_upload
+from thunorweb.tests import DatasetTestCase, get_thunor_test_file
+
+HTTP_OK = 200
+HTTP_NOT_FOUND = 404
+HTTP_ACCEPTED = 202
+HTTP_CONFLICT = 409
+
+
+class TestUploads(DatasetTestCase):
+    def test_chunked_upload(self):
+        with open(get_thunor_test_file('testdata/test_incucyte_minimal.txt'),
+                  'rb') as testfile:
+            contents = testfile.read()
+        chunk_size = len(contents) // 3 + 1
+        dataset = HTSDataset.objects.create(owner=self.user, name='chunked')
+        self.client.force_login(self.user)
+
+        with tempfile.TemporaryDirectory() as upload_dir, override_settings(
+                CHUNKED_UPLOAD_DIR=upload_dir,
+                CHUNKED_UPLOAD_MAX_CHUNK_SIZE=chunk_size,
+                CHUNKED_UPLOAD_BACKGROUND_THREAD=False):
+            resp = self.client.post(reverse('thunorweb:ajax_upload_init'), {
+                'dataset_id': dataset.id, 'file_name': 'test.txt',
+                'size': len(contents)})
+            self.assertEqual(resp.status_code, HTTP_OK)
+            upload_id = resp.json()['uploadId']
+
+            def append(offset, data):
+                return self.client.post(
+                    reverse('thunorweb:ajax_upload_append',
+                            args=[upload_id]) + '?offset={}'.format(offset),
+                    data, content_type='application/octet-stream')
+
+            self.assertEqual(append(0, contents[:chunk_size]).status_code,
+                             HTTP_OK)
+            # Resending a chunk (e.g. after a lost response) is rejected,
+            # with the offset to resume from
+            resp = append(0, contents[:chunk_size])
+            self.assertEqual(resp.status_code, HTTP_CONFLICT)
+            offset = resp.json()['offset']
+            self.assertEqual(offset, chunk_size)
+
+            finalize_url = reverse('thunorweb:ajax_upload_finalize',
+                                   args=[upload_id])
+            self.assertEqual(self.client.post(finalize_url).status_code,
+                             HTTP_CONFLICT)
+
+            while offset < len(contents):
+                resp = append(offset, contents[offset:offset + chunk_size])
+                self.assertEqual(resp.status_code, HTTP_OK)
+                offset = resp.json()['offset']
+
+            resp = self.client.post(finalize_url, {
+                'sha256': hashlib.sha256(contents).hexdigest()})
+            self.assertEqual(resp.status_code, HTTP_ACCEPTED)
+            self.assertEqual(resp.json()['status'], 'pending')
+
+            self.assertTrue(process_chunked_upload(upload_id))
+            self.assertFalse(os.listdir(upload_dir))
+
+        resp = self.client.get(reverse('thunorweb:ajax_upload_status',
+                                       args=[upload_id]))
+        result = resp.json()
+        self.assertEqual(result['status'], 'complete')
+        self.assertEqual(result['result']['fileFormat'], 'IncuCyte Zoom')
+        self.assertTrue(dataset.plate_set.exists())
+
+        # Other users can't see the upload
+        self.client.force_login(self.other_user)
+        resp = self.client.get(reverse('thunorweb:ajax_upload_status',
+                                       args=[upload_id]))
+        self.assertEqual(resp.status_code, HTTP_NOT_FOUND)
+
+    def test_requeue_stalled_upload(self):
+        dataset = HTSDataset.objects.create(owner=self.user, name='stalled')
+        upload = ChunkedUpload.objects.create(
+            dataset=dataset, file_name='test.txt', size=1, offset=1,
+            status=ChunkedUpload.STATUS_PROCESSING)
+
+        with tempfile.TemporaryDirectory() as upload_dir, override_settings(
+                CHUNKED_UPLOAD_DIR=upload_dir,
+                CHUNKED_UPLOAD_REQUEUE_HOURS=1):
+            # Not stalled for long enough yet
+            call_command('thunor_process_uploads', stdout=StringIO())
+            upload.refresh_from_db()
+            self.assertEqual(upload.status, ChunkedUpload.STATUS_PROCESSING)
+
+            # Requeued by default once stalled. The assembled file was lost,
+            # which is logged, but isn't shown to the user as-is
+            ChunkedUpload.objects.filter(id=upload.id).update(
+                modified_date=timezone.now() - timedelta(hours=2))
+            with self.assertLogs('thunorweb.tasks', 'ERROR'):
+                call_command('thunor_process_uploads', stdout=StringIO())
+            upload.refresh_from_db()
+            self.assertEqual(upload.status, ChunkedUpload.STATUS_FAILED)
+            self.assertNotIn(upload.path, upload.result['error'])
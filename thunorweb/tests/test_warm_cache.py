@@ -0,0 +1,46 @@
+import io
+
+import pandas as pd
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+
+from thunorweb.models import HTSDataset
+from thunorweb.pandas import (
+    dataset_curve_fits,
+    df_curve_fits,
+)
+from thunorweb.tests import DatasetTestCase
+
+HTTP_OK = 200
+
+
+class TestWarmCache(DatasetTestCase):
+    def test_view_dataset_last_viewed(self):
+        self.client.force_login(self.user)
+        d = HTSDataset.objects.create(owner=self.user, name='test_viewed')
+        self.assertIsNone(d.last_viewed)
+
+        resp = self.client.get(reverse('thunorweb:view_dataset',
+                                       args=[d.id]))
+        self.assertEqual(resp.status_code, HTTP_OK)
+        d.refresh_from_db()
+        self.assertIsNotNone(d.last_viewed)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'thunor-test-warm-cache'}})
+    def test_warm_cache(self):
+        out = io.StringIO()
+        call_command('thunor_warm_cache', datasets=[self.d.id], restart=True,
+                     verbosity=2, stdout=out)
+        self.assertIn('viability_curve_fits', out.getvalue())
+        self.assertIn('dip_curve_fits', out.getvalue())
+
+        base_params = dataset_curve_fits(self.d, 'dip')
+        expected = df_curve_fits(self.d.id, 'dip', drug_ids=None,
+                                 cell_line_ids=None, include_fit_params=True,
+                                 include_ids=True)
+        pd.testing.assert_frame_equal(
+            base_params.drop(columns='fit_obj'),
+            expected.drop(columns='fit_obj'))
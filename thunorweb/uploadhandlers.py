@@ -0,0 +1,61 @@
+import hashlib
+
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+class _HashingMixin(object):
+    """
+    Compute the SHA-256 of each uploaded file while it's received
+
+    The digest is stored on the uploaded file as its sha256 attribute, so
+    it doesn't need to be read again afterwards.
+    """
+    def new_file(self, *args, **kwargs):
+        self._sha256 = hashlib.sha256()
+        return super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self._sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self._sha256.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(_HashingMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(_HashingMixin,
+                                        TemporaryFileUploadHandler):
+    pass
+
+
+def file_sha256(f):
+    """
+    Get the SHA-256 hex digest of a file's contents
+
+    Uses the digest computed on upload if there is one, otherwise the file
+    is read in chunks and rewound.
+    """
+    sha256 = getattr(f, 'sha256', None)
+    if sha256 is not None:
+        return sha256
+
+    h = hashlib.sha256()
+    f.seek(0)
+    for chunk in f.chunks(HASH_CHUNK_SIZE):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        h.update(chunk)
+    f.seek(0)
+    f.sha256 = h.hexdigest()
+    return f.sha256
@@ -6,6 +6,7 @@ import thunorweb.views.datasets as datasets
 import thunorweb.views.plate_mapper as plate_mapper
 import thunorweb.views.plots as plots
 import thunorweb.views.tags as tags
+import thunorweb.views.uploads as uploads
 
 app_name = 'thunorweb'
 urlpatterns = [
@@ -63,11 +64,17 @@ urlpatterns = [
             downloads.download_fit_params, name='download_fit_params'),
     re_path(r'^dataset/(?P<dataset_id>\d+)/download/dip_rates$',
             downloads.download_dip_rates, name='download_dip_rates'),
+    re_path(r'^dataset/(?P<dataset_id>\d+)/download/(?P<table>dataset|dip_rates)'
+            r'\.(?P<file_format>parquet|arrow)$',
+            downloads.download_columnar, name='download_columnar'),
 
     path('plots', plots.plots, name='plots'),
 
+    path('ajax/plots.json', plots.ajax_get_plots, name='ajax_plots'),
     re_path(r'^ajax/plot\.(?P<file_type>\w+)$', plots.ajax_get_plot,
             name='ajax_plot'),
+    re_path(r'^ajax/plotly-(?P<checksum>[0-9a-f]+)\.js$', plots.ajax_plotlyjs,
+            name='ajax_plotlyjs'),
 
     re_path(r'^ajax/dataset/(?P<dataset_id>\d+)(,(?P<dataset2_id>\d+))?/groupings$',
             datasets.ajax_get_dataset_groupings, name='ajax_dataset_groupings'),
@@ -83,11 +90,23 @@ urlpatterns = [
 
     path('ajax/platefile/upload', datasets.ajax_upload_platefiles,
          name='ajax_upload_platefiles'),
+    path('ajax/platefile/validate', datasets.ajax_validate_platefiles,
+         name='ajax_validate_platefiles'),
+    path('ajax/platefile/upload/init', uploads.ajax_upload_init,
+         name='ajax_upload_init'),
+    path('ajax/platefile/upload/<uuid:upload_id>', uploads.ajax_upload_status,
+         name='ajax_upload_status'),
+    path('ajax/platefile/upload/<uuid:upload_id>/append',
+         uploads.ajax_upload_append, name='ajax_upload_append'),
+    path('ajax/platefile/upload/<uuid:upload_id>/finalize',
+         uploads.ajax_upload_finalize, name='ajax_upload_finalize'),
     path('ajax/platefile/delete', datasets.ajax_delete_platefile,
          name='ajax_delete_platefile'),
 
     re_path(r'^ajax/plate/load/(?P<plate_id>\d+)', plate_mapper.ajax_load_plate,
             name='ajax_load_plate'),
+    path('ajax/plates/load', plate_mapper.ajax_load_plates,
+         name='ajax_load_plates'),
     path('ajax/plate/save', plate_mapper.ajax_save_plate,
          name='ajax_save_plate'),
 
@@ -2,12 +2,11 @@ from allauth.account.views import password_reset
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import Group
 from django.http import JsonResponse
 from django.shortcuts import Http404, redirect, render
-from guardian.shortcuts import ObjectPermissionChecker
 
 from thunorweb.models import HTSDataset
+from thunorweb.permissions import has_dataset_perm
 
 
 def is_ajax(request):
@@ -17,15 +16,7 @@ def is_ajax(request):
 def _assert_has_perm(request, dataset, perm_required):
     if dataset.deleted_date is not None:
         raise Http404()
-    if not settings.LOGIN_REQUIRED and not \
-            request.user.is_authenticated:
-        anon_group = Group.objects.get(name='Public')
-        anon_perm_checker = ObjectPermissionChecker(anon_group)
-        if not anon_perm_checker.has_perm(perm_required, dataset):
-            raise Http404()
-    elif dataset.owner_id != request.user.id and not \
-            request.user.has_perm(
-                perm_required, dataset):
+    if not has_dataset_perm(request, dataset, perm_required):
         raise Http404()
 
 
@@ -1,10 +1,10 @@
 import os
-from io import BytesIO
+import tempfile
 
 import numpy as np
 import pandas as pd
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files import File
 from django.core.files.storage import default_storage
 from django.http import HttpResponse
 from django.shortcuts import Http404, redirect
@@ -22,7 +22,15 @@ from thunorweb.pandas import (
 )
 from thunorweb.serve_file import serve_file
 from thunorweb.views import _assert_has_perm, login_required_unless_public
-from thunorweb.views.datasets import license_accepted
+from thunorweb.views.datasets import COLUMNAR_DOWNLOADS, license_accepted
+
+# Columnar export formats: file extension and content type
+COLUMNAR_FORMATS = {
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+}
+# Maximum rows per Parquet row group/Arrow record batch
+COLUMNAR_BATCH_ROWS = 65536
 
 
 def _cached_file(dataset, file_type, protocol):
@@ -42,6 +50,64 @@ def _cached_file(dataset, file_type, protocol):
     return file
 
 
+def _save_export(file_name, write_fn, write_to_path=False):
+    """
+    Write an export file and save it to default storage
+
+    The output goes to a temporary file, which is then copied to storage in
+    chunks (or uploaded using S3 multipart upload), so the file contents are
+    never held in memory in full.
+
+    Parameters
+    ----------
+    file_name: str
+        File name, without the downloads prefix
+    write_fn: callable
+        Function which writes the file. Called with a binary file object,
+        or a file name if write_to_path is True.
+    write_to_path: bool
+        Pass write_fn a file name instead of a file object, for writers
+        which need to open the file themselves (e.g. HDF5)
+
+    Returns
+    -------
+    str
+        Name of the stored file
+    """
+    fn_prefixed = os.path.join(settings.DOWNLOADS_PREFIX, file_name)
+    if write_to_path:
+        tmp = tempfile.NamedTemporaryFile(suffix=os.path.splitext(
+            file_name)[1])
+    else:
+        # Small exports stay in memory, larger ones spill to disk
+        tmp = tempfile.SpooledTemporaryFile(
+            max_size=settings.DOWNLOADS_SPOOL_MAX_SIZE)
+
+    with tmp:
+        write_fn(tmp.name if write_to_path else tmp)
+        tmp.seek(0)
+        return default_storage.save(fn_prefixed, File(tmp, name=file_name))
+
+
+def _save_dataset_file(dataset, file_type, file_type_protocol, stored_file,
+                       mod_date):
+    df, created = HTSDatasetFile.objects.get_or_create(
+        dataset=dataset,
+        file_type=file_type,
+        defaults={
+            'file_type_protocol': file_type_protocol,
+            'file': stored_file
+        }
+    )
+    if not created:
+        df.file_type_protocol = file_type_protocol
+        df.file = stored_file
+        df.creation_date = mod_date
+        df.save()
+
+    return df
+
+
 def _plain_response(response_text):
     response = HttpResponse(response_text, content_type='text/plain')
     response['Content-Disposition'] = \
@@ -49,29 +115,18 @@ def _plain_response(response_text):
     return response
 
 
-@login_required_unless_public
-@xframe_options_sameorigin
-def download_fit_params(request, dataset_id, stat_type):
-    file_type = 'fit_params_{}_tsv'.format(stat_type)
-    file_name = 'fit_params_{}_{}.tsv'.format(stat_type, dataset_id)
-    file_type_protocol = 1
-    param_names = {
-        'dip': ('aa', 'aa_obs', 'emax', 'emax_rel', 'emax_obs', 'emax_obs_rel',
-                'einf', 'ec50', 'ic50', 'hill'),
-        'viability': ('aa', 'aa_obs', 'emax', 'emax_obs', 'einf', 'ec50',
-                      'ic50', 'hill')
-    }
+FIT_PARAM_NAMES = {
+    'dip': ('aa', 'aa_obs', 'emax', 'emax_rel', 'emax_obs', 'emax_obs_rel',
+            'einf', 'ec50', 'ic50', 'hill'),
+    'viability': ('aa', 'aa_obs', 'emax', 'emax_obs', 'einf', 'ec50',
+                  'ic50', 'hill')
+}
 
-    try:
-        dataset = HTSDataset.objects.get(pk=dataset_id, deleted_date=None)
-    except (HTSDataset.DoesNotExist, ValueError):
-        return _plain_response('This dataset does not exist, or you do not '
-                               'have permission to access it.')
 
-    _assert_has_perm(request, dataset, 'download_data')
-    if not license_accepted(request, dataset):
-        return _plain_response('You must accept the dataset license to '
-                               'download this file')
+def _generate_fit_params(dataset, stat_type, regenerate_cache=False):
+    file_type = 'fit_params_{}_tsv'.format(stat_type)
+    file_name = 'fit_params_{}_{}.tsv'.format(stat_type, dataset.id)
+    file_type_protocol = 1
 
     mod_date = timezone.now()
     file = _cached_file(dataset, file_type, file_type_protocol)
@@ -80,24 +135,22 @@ def download_fit_params(request, dataset_id, stat_type):
     # cached file
     if file:
         if file.creation_date < CurveFitSet.objects.get(
-                    dataset_id=dataset_id, stat_type=stat_type
+                    dataset_id=dataset.id, stat_type=stat_type
                 ).calculation_end:
             file = None
 
-    if file:
-        df = file
+    if file and not regenerate_cache:
+        return file
+
+    # Fetch the curve fits from the DB
+    base_params = df_curve_fits(dataset.id, stat_type,
+                                drug_ids=None, cell_line_ids=None,
+                                include_fit_params=True)
+
+    if base_params.attrs['fit_params_precomputed']:
+        fp = base_params
     else:
-        try:
-            # Fetch the DIP rates from the DB
-            base_params = df_curve_fits(dataset.id, stat_type,
-                                        drug_ids=None, cell_line_ids=None)
-        except NoDataException:
-            return _plain_response(
-                'The requested parameter set does not exist for the '
-                'specified dataset'
-            )
-
-        # Fit Hill curves and compute parameters
+        # Compute parameters from the fitted Hill curves
         fp = fit_params_from_base(
             base_params,
             custom_ic_concentrations={50},
@@ -109,32 +162,41 @@ def download_fit_params(request, dataset_id, stat_type):
             include_einf=True,
             include_response_values=False
         )
-        fp.reset_index('dataset_id', drop=True, inplace=True)
-        # Remove -ve AA values
-        fp.loc[fp['aa'] < 0.0, 'aa'] = np.nan
+    fp.reset_index('dataset_id', drop=True, inplace=True)
+    # Remove -ve AA values
+    fp.loc[fp['aa'] < 0.0, 'aa'] = np.nan
 
-        # Filter for the default list of parameters only
-        fp = fp.filter(items=param_names[stat_type])
+    # Filter for the default list of parameters only
+    fp = fp.filter(items=FIT_PARAM_NAMES[stat_type])
 
-        buf = BytesIO()
-        fp.to_csv(buf, sep='\t')
-        buf.seek(0)
-        fn_prefixed = os.path.join(settings.DOWNLOADS_PREFIX, file_name)
-        stored_file = default_storage.save(fn_prefixed, ContentFile(buf.read()))
+    stored_file = _save_export(
+        file_name, lambda f: fp.to_csv(
+            f, sep='\t', chunksize=settings.DOWNLOADS_CSV_CHUNK_ROWS))
+    return _save_dataset_file(dataset, file_type, file_type_protocol,
+                              stored_file, mod_date)
 
-        df, created = HTSDatasetFile.objects.get_or_create(
-            dataset=dataset,
-            file_type=file_type,
-            defaults={
-                'file_type_protocol': file_type_protocol,
-                'file': stored_file
-            }
+
+@login_required_unless_public
+@xframe_options_sameorigin
+def download_fit_params(request, dataset_id, stat_type):
+    try:
+        dataset = HTSDataset.objects.get(pk=dataset_id, deleted_date=None)
+    except (HTSDataset.DoesNotExist, ValueError):
+        return _plain_response('This dataset does not exist, or you do not '
+                               'have permission to access it.')
+
+    _assert_has_perm(request, dataset, 'download_data')
+    if not license_accepted(request, dataset):
+        return _plain_response('You must accept the dataset license to '
+                               'download this file')
+
+    try:
+        df = _generate_fit_params(dataset, stat_type)
+    except NoDataException:
+        return _plain_response(
+            'The requested parameter set does not exist for the '
+            'specified dataset'
         )
-        if not created:
-            df.file_type_protocol = file_type_protocol
-            df.file = stored_file
-            df.creation_date = mod_date
-            df.save()
 
     if default_storage.__class__.__name__ == "S3Storage":
         return redirect(df.file.url)
@@ -165,24 +227,11 @@ def _generate_dataset_hdf5(dataset, regenerate_cache=False):
             for_export=True
         )
 
-        buf = BytesIO()
-        write_hdf(df_data, buf)
-        buf.seek(0)
-        fn_prefixed = os.path.join(settings.DOWNLOADS_PREFIX, file_name)
-        stored_file = default_storage.save(fn_prefixed, ContentFile(buf.read()))
-        df, created = HTSDatasetFile.objects.get_or_create(
-            dataset=dataset,
-            file_type=file_type,
-            defaults={
-                'file_type_protocol': file_type_protocol,
-                'file': stored_file
-            }
-        )
-        if not created:
-            df.file_type_protocol = file_type_protocol
-            df.file = stored_file
-            df.creation_date = mod_date
-            df.save()
+        stored_file = _save_export(
+            file_name, lambda path: write_hdf(df_data, path),
+            write_to_path=True)
+        df = _save_dataset_file(dataset, file_type, file_type_protocol,
+                                stored_file, mod_date)
 
     return df
 
@@ -226,66 +275,58 @@ def _generate_dip_rates(dataset, regenerate_cache=False):
     if file and not regenerate_cache:
         df = file
     else:
-        ctrl, expt = df_dip_rates(dataset, cell_line_id=None, drug_id=None)
+        df_data = _dip_rates_frame(dataset)
 
-        expt = expt.reset_index()
-        n_drugs = expt['drug'].apply(len).max()
-        expt = _unstack_doses(expt).reset_index()
+        stored_file = _save_export(
+            file_name, lambda f: df_data.to_csv(
+                f, sep='\t', index=False,
+                chunksize=settings.DOWNLOADS_CSV_CHUNK_ROWS))
+        df = _save_dataset_file(dataset, file_type, file_type_protocol,
+                                stored_file, mod_date)
 
-        wells = Well.objects.filter(plate__dataset_id=dataset.id
-                                    ).select_related('plate')
+    return df
 
-        if ctrl is None:
-            df_data = expt
-        else:
-            ctrl = ctrl.reset_index()
-            df_data = pd.concat([ctrl, expt], ignore_index=True, sort=False)
 
-        df_data.drop(columns=['plate', 'dataset'], inplace=True)
+def _dip_rates_frame(dataset):
+    """ DIP rates for all wells in a dataset, one row per well """
+    ctrl, expt = df_dip_rates(dataset, cell_line_id=None, drug_id=None)
 
-        well_df = pd.DataFrame({
-            'well_id': well.id,
-            'plate': well.plate.name,
-            'well_num': well.well_num,
-            'well': well.plate.well_id_to_name(well.well_num)
-        } for well in wells)
+    expt = expt.reset_index()
+    n_drugs = expt['drug'].apply(len).max()
+    expt = _unstack_doses(expt).reset_index()
 
-        df_data = df_data.merge(well_df, on='well_id')
+    wells = Well.objects.filter(plate__dataset_id=dataset.id
+                                ).select_related('plate')
 
-        df_data.rename(columns={f'dose{n+1}': f'drug{n+1}.conc'
-                                for n in range(n_drugs)},
-                       inplace=True)
-        df_data.rename(columns={'cell_line': 'cell.line'}, inplace=True)
+    if ctrl is None:
+        df_data = expt
+    else:
+        ctrl = ctrl.reset_index()
+        df_data = pd.concat([ctrl, expt], ignore_index=True, sort=False)
 
-        df_data.sort_values(['plate', 'well_num'], inplace=True)
+    df_data.drop(columns=['plate', 'dataset'], inplace=True)
 
-        columns = ['plate', 'well', 'cell.line'] + \
-            [f'drug{n+1}' for n in range(n_drugs)] + \
-            [f'drug{n+1}.conc' for n in range(n_drugs)] + \
-            ['dip_rate', 'dip_fit_std_err']
-        df_data = df_data[columns]
+    well_df = pd.DataFrame({
+        'well_id': well.id,
+        'plate': well.plate.name,
+        'well_num': well.well_num,
+        'well': well.plate.well_id_to_name(well.well_num)
+    } for well in wells)
 
-        buf = BytesIO()
-        df_data.to_csv(buf, sep='\t', index=False)
-        buf.seek(0)
-        fn_prefixed = os.path.join(settings.DOWNLOADS_PREFIX, file_name)
-        stored_file = default_storage.save(fn_prefixed, ContentFile(buf.read()))
+    df_data = df_data.merge(well_df, on='well_id')
 
-        df, created = HTSDatasetFile.objects.get_or_create(
-            dataset=dataset,
-            file_type=file_type,
-            defaults={
-                'file_type_protocol': file_type_protocol,
-                'file': stored_file
-            }
-        )
-        if not created:
-            df.file_type_protocol = file_type_protocol
-            df.file = stored_file
-            df.creation_date = mod_date
-            df.save()
+    df_data.rename(columns={f'dose{n+1}': f'drug{n+1}.conc'
+                            for n in range(n_drugs)},
+                   inplace=True)
+    df_data.rename(columns={'cell_line': 'cell.line'}, inplace=True)
 
-    return df
+    df_data.sort_values(['plate', 'well_num'], inplace=True)
+
+    columns = ['plate', 'well', 'cell.line'] + \
+        [f'drug{n+1}' for n in range(n_drugs)] + \
+        [f'drug{n+1}.conc' for n in range(n_drugs)] + \
+        ['dip_rate', 'dip_fit_std_err']
+    return df_data[columns]
 
 
 @login_required_unless_public
@@ -314,3 +355,103 @@ def download_dip_rates(request, dataset_id):
 
     return serve_file(request, full_path, rename_to=output_filename,
                       content_type='text/tab-separated-values')
+
+
+def _dataset_frame(dataset):
+    """
+    Dose, assay and control data for a dataset as a single long table
+
+    Each row is one measurement. Control wells have no drug or dose values.
+    """
+    df_data = df_doses_assays_controls(
+        dataset=dataset,
+        drug_id=None,
+        cell_line_id=None,
+        assay=None,
+        for_export=True
+    )
+
+    doses = df_data.doses_unstacked().reset_index()
+    df = df_data.assays.reset_index().merge(
+        doses.drop(columns='dataset', errors='ignore'), on='well_id')
+
+    if df_data.controls is not None:
+        controls = df_data.controls.reset_index().drop(
+            columns='dataset', errors='ignore')
+        df = pd.concat([df, controls], ignore_index=True, sort=False)
+
+    return df
+
+
+def _write_columnar(df_data, file_format, f):
+    # pyarrow is optional, and slow to import
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    table = pyarrow.Table.from_pandas(df_data, preserve_index=False)
+    if file_format == 'parquet':
+        pyarrow.parquet.write_table(table, f,
+                                    row_group_size=COLUMNAR_BATCH_ROWS)
+    else:
+        with pyarrow.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table, max_chunksize=COLUMNAR_BATCH_ROWS)
+
+
+def _generate_columnar(dataset, table, file_format, regenerate_cache=False):
+    extension = COLUMNAR_FORMATS[file_format][0]
+    file_name = '{}_{}.{}'.format(table, dataset.id, extension)
+    file_type = '{}_{}'.format(table, file_format)
+    file_type_protocol = 1
+
+    mod_date = timezone.now()
+    file = _cached_file(dataset, file_type, file_type_protocol)
+
+    if file and not regenerate_cache:
+        return file
+
+    if table == 'dataset':
+        df_data = _dataset_frame(dataset)
+    else:
+        df_data = _dip_rates_frame(dataset)
+
+    stored_file = _save_export(
+        file_name, lambda f: _write_columnar(df_data, file_format, f))
+    return _save_dataset_file(dataset, file_type, file_type_protocol,
+                              stored_file, mod_date)
+
+
+@login_required_unless_public
+@xframe_options_sameorigin
+def download_columnar(request, dataset_id, table, file_format):
+    try:
+        dataset = HTSDataset.objects.get(pk=dataset_id, deleted_date=None)
+    except HTSDataset.DoesNotExist:
+        raise Http404()
+
+    _assert_has_perm(request, dataset, 'download_data')
+    if not license_accepted(request, dataset):
+        return _plain_response('You must accept the dataset license to '
+                               'download this file')
+
+    if not COLUMNAR_DOWNLOADS:
+        return _plain_response('{} downloads are not available on this '
+                               'server'.format(file_format.capitalize()))
+
+    try:
+        df = _generate_columnar(dataset, table, file_format)
+    except NoDataException:
+        return _plain_response('No data found for this request')
+
+    if default_storage.__class__.__name__ == "S3Storage":
+        return redirect(df.file.url)
+
+    extension, content_type = COLUMNAR_FORMATS[file_format]
+    full_path = os.path.join(settings.MEDIA_ROOT, df.file.name)
+    if table == 'dataset':
+        output_filename = '{}.{}'.format(dataset.name, extension)
+    else:
+        output_filename = '{}_{}.{}'.format(dataset.name, table, extension)
+
+    return serve_file(request, full_path, rename_to=output_filename,
+                      content_type=content_type)
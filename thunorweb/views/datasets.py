@@ -1,4 +1,7 @@
 import logging
+from datetime import timedelta
+from functools import partial
+from importlib.util import find_spec
 
 from django.conf import settings
 from django.contrib import messages
@@ -18,11 +21,15 @@ from guardian.shortcuts import (
     assign_perm,
     get_groups_with_perms,
     get_objects_for_group,
-    get_perms,
     remove_perm,
 )
 
-from thunorweb.models import CellLineTag, DrugTag, HTSDataset, Plate, PlateFile
+from thunorweb.models import HTSDataset, Plate, PlateFile
+from thunorweb.partitions import create_dataset_partitions
+from thunorweb.permissions import (
+    get_dataset_perms,
+    invalidate_permissions,
+)
 from thunorweb.plate_parsers import PlateFileParser
 from thunorweb.tasks import (
     dataset_groupings,
@@ -32,10 +39,17 @@ from thunorweb.tasks import (
     rename_dataset_in_cache,
 )
 from thunorweb.views import _assert_has_perm, login_required_unless_public
-from thunorweb.views.tags import TAG_EVERYTHING_ELSE
+from thunorweb.views.tags import TAG_EVERYTHING_ELSE, tags_for_entities
 
 logger = logging.getLogger(__name__)
 
+# Parquet/Arrow downloads need pyarrow, from the optional "columnar" extra
+COLUMNAR_DOWNLOADS = find_spec('pyarrow') is not None
+
+# HTSDataset.last_viewed is only updated if it's older than this, so most
+# page views don't write to the database
+LAST_VIEWED_RESOLUTION = timedelta(hours=1)
+
 
 LICENSE_UNSIGNED = 'The dataset "{}" has usage terms which much be accepted ' \
                    'before it can be accessed. Please access the dataset ' \
@@ -64,18 +78,21 @@ def view_dataset(request, dataset_id):
     if dataset.owner_id == request.user.id:
         perms = perms_base
     else:
-        if not settings.LOGIN_REQUIRED and not request.user.is_authenticated:
-            perms = get_perms(Group.objects.get(name='Public'), dataset)
-        else:
-            perms = get_perms(request.user, dataset)
+        perms = get_dataset_perms(request, dataset)
         if not (set(perms_base) & set(perms)):
             raise Http404()
 
     dataset.single_timepoint = dataset_groupings(dataset)['singleTimepoint']
     dataset.license_accepted = license_accepted(request, dataset)
 
+    now = timezone.now()
+    HTSDataset.objects.filter(id=dataset.id).filter(
+        Q(last_viewed=None) | Q(last_viewed__lt=now - LAST_VIEWED_RESOLUTION)
+    ).update(last_viewed=now)
+
     response = render(request, 'dataset.html',
                       {'dataset': dataset, 'perms': perms,
+                       'columnar_downloads': COLUMNAR_DOWNLOADS,
                        'back_link': ["home page", reverse('thunorweb:home')]})
     return response
 
@@ -126,10 +143,7 @@ def accept_license(request, dataset_id):
         # No license, or owner has already accepted license
         return JsonResponse({'success': True})
     else:
-        if not settings.LOGIN_REQUIRED and not request.user.is_authenticated:
-            perms = get_perms(Group.objects.get(name='Public'), dataset)
-        else:
-            perms = get_perms(request.user, dataset)
+        perms = get_dataset_perms(request, dataset)
         if not (set(perms_base) & set(perms)):
             raise Http404()
 
@@ -165,43 +179,14 @@ def ajax_set_dataset_group_permission(request):
     # Assign or remove the permission as requested
     permission_fn = assign_perm if state else remove_perm
     permission_fn(perm_id, group, dataset)
+    invalidate_permissions(request)
 
     return JsonResponse({'success': True})
 
 
-def _get_drugtag_permfilter(request):
-    if request.user.is_authenticated:
-        # These queries assume we only have one permission (view) for tags
-        return Q(owner=request.user) | Q(
-            drugtaggroupobjectpermission__group__user=request.user
-        )
-    else:
-        return Q(drugtaggroupobjectpermission__group__name='Public')
-
-
-def _get_celllinetag_permfilter(request):
-    if request.user.is_authenticated:
-        # These queries assume we only have one permission (view) for tags
-        return Q(owner=request.user) | Q(
-            celllinetaggroupobjectpermission__group__user=request.user
-        )
-    else:
-        return Q(celllinetaggroupobjectpermission__group__name='Public')
-
-
 def _get_tags(request, cell_line_ids, drug_ids):
-    ct_perm_filter = _get_celllinetag_permfilter(request)
-    dt_perm_filter = _get_drugtag_permfilter(request)
-
-    cell_line_tags = CellLineTag.objects.filter(ct_perm_filter).filter(
-        cell_lines__id__in=cell_line_ids
-    ).distinct().order_by('tag_category', 'tag_name')
-
-    drug_tags = DrugTag.objects.filter(dt_perm_filter).filter(
-        drugs__id__in=drug_ids
-    ).distinct().order_by('tag_category', 'tag_name')
-
-    return cell_line_tags, drug_tags
+    return (tags_for_entities(request, 'cell_lines', cell_line_ids),
+            tags_for_entities(request, 'drugs', drug_ids))
 
 
 @login_required_unless_public
@@ -234,7 +219,8 @@ def ajax_get_dataset_groupings(request, dataset_id, dataset2_id=None):
             'This dataset has no plate files. Data will need to be added '
             'before plots can be used on this dataset.', status=400)
 
-    groupings_dict = dataset_groupings(list(datasets))
+    # Tags and plates depend on the user, so they're added to a copy
+    groupings_dict = dict(dataset_groupings(list(datasets)))
 
     cell_line_ids = [cl['id'] for cl in groupings_dict['cellLines']]
     drug_ids = []
@@ -346,6 +332,9 @@ def ajax_create_dataset(request):
     if not name:
         return HttpResponseBadRequest()
     dset = HTSDataset.objects.create(owner=request.user, name=name)
+    # Partitioning locks the measurement tables, so happens after (rather
+    # than during) any transaction creating the dataset
+    transaction.on_commit(partial(create_dataset_partitions, dset.id))
     return JsonResponse({'name': dset.name, 'id': dset.id})
 
 
@@ -471,7 +460,9 @@ def ajax_upload_platefiles(request):
     some_success = False
     for f_idx, res in enumerate(results):
         if res['success']:
-            some_success = True
+            # Files already in the dataset are skipped, so don't need
+            # anything recalculating
+            some_success = some_success or not res['duplicate']
             initial_previews.append(preview_template.render({
                 'plate_file_format': res['file_format']}))
             initial_preview_config.append({'key': res['id'], 'caption':
@@ -502,3 +493,44 @@ def ajax_upload_platefiles(request):
         response['errorkeys'] = list(errors.keys())
 
     return JsonResponse(response)
+
+
+def ajax_validate_platefiles(request):
+    """
+    Check plate files can be imported, without saving anything
+
+    Every problem found in each file is reported. If a dataset_id is given,
+    plate names are also checked against those already in the dataset.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST request required'}, status=405)
+
+    dataset_id = request.POST.get('dataset_id')
+    files = request.FILES.getlist('file_field[]')
+    if not files:
+        return JsonResponse({'error': 'No files supplied'}, status=400)
+
+    dataset = None
+    if dataset_id:
+        try:
+            dataset = HTSDataset.objects.get(owner=request.user,
+                                             id=dataset_id,
+                                             deleted_date=None)
+        except (ValueError, HTSDataset.DoesNotExist):
+            raise Http404()
+
+    results = PlateFileParser(files, dataset=dataset,
+                              validate_only=True).parse_all()
+
+    return JsonResponse({
+        'valid': all(res['success'] for res in results),
+        'files': [{
+            'fileName': res['file_name'],
+            'valid': res['success'],
+            'fileFormat': res.get('file_format'),
+            'duplicate': res.get('duplicate', False),
+            'problems': res.get('problems', [])
+        } for res in results]
+    })
@@ -1,10 +1,9 @@
 import json
 import math
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 
-import numpy as np
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models import Count, Q
 from django.http import HttpResponseBadRequest, JsonResponse
 from django.shortcuts import Http404, render
@@ -32,6 +31,9 @@ from thunorweb.tasks import (
 from thunorweb.views import _assert_has_perm, login_required_unless_public
 from thunorweb.views.datasets import LICENSE_UNSIGNED, license_accepted
 
+# Maximum number of plates which can be fetched by ajax_load_plates
+MAX_LOAD_PLATES = 50
+
 
 @login_required_unless_public
 def plate_mapper(request, dataset_id, num_wells=None):
@@ -113,6 +115,188 @@ def ajax_create_drug(request):
     return JsonResponse({'drugs': list(drugs)})
 
 
+def _expt_wells(plate_ids):
+    """ Get the plate IDs of non-control wells, keyed by well ID """
+    return dict(WellDrug.objects.filter(
+        well__plate_id__in=plate_ids, dose__gt=0
+    ).values_list('well_id', 'well__plate_id').distinct())
+
+
+def _int_or_none(val):
+    return None if val is None else int(val)
+
+
+def _float_or_none(val):
+    return None if val is None else float(val)
+
+
+def _save_cell_lines(plate_ids, cell_line_ids):
+    """
+    Set the cell line of each well on a set of plates
+
+    Wells are inserted or updated in a single statement, and wells whose
+    cell line is unchanged are left alone.
+
+    Parameters
+    ----------
+    plate_ids: list
+        IDs of the plates to update
+    cell_line_ids: list
+        Cell line ID (or None) for each well, in well number order
+
+    Returns
+    -------
+    dict
+        Plate IDs of the wells which were inserted or changed, keyed by
+        well ID
+    """
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {table} AS w (plate_id, well_num, cell_line_id) '
+            'SELECT p.plate_id, v.well_num, v.cell_line_id '
+            'FROM unnest(%(plate_ids)s::integer[]) AS p(plate_id) '
+            'CROSS JOIN unnest(%(well_nums)s::integer[], '
+            '%(cell_line_ids)s::integer[]) AS v(well_num, cell_line_id) '
+            'ON CONFLICT (plate_id, well_num) DO UPDATE '
+            'SET cell_line_id = EXCLUDED.cell_line_id '
+            'WHERE w.cell_line_id IS DISTINCT FROM EXCLUDED.cell_line_id '
+            'RETURNING w.id, w.plate_id'.format(
+                table=qn(Well._meta.db_table)),
+            {'plate_ids': plate_ids,
+             'well_nums': list(range(len(cell_line_ids))),
+             'cell_line_ids': [_int_or_none(cl) for cl in cell_line_ids]}
+        )
+        return dict(cursor.fetchall())
+
+
+def _save_well_drugs(plate_ids, wells, apply_mode='normal'):
+    """
+    Set the drugs and doses of each well on a set of plates
+
+    Rather than deleting and reinserting all of the plates' well drugs,
+    the existing rows are diffed against the new ones in the database:
+    obsolete rows are removed with one DELETE, then new and changed rows
+    are written with one INSERT ... ON CONFLICT. Rows which are unchanged
+    aren't touched.
+
+    Parameters
+    ----------
+    plate_ids: list
+        IDs of the plates to update. Wells must already exist.
+    wells: list
+        Well dicts from the plate mapper, with "drugs" and "doses" lists
+    apply_mode: str
+        'drugs' or 'doses' to only set that field (keeping the other),
+        otherwise both are replaced
+
+    Returns
+    -------
+    set
+        IDs of the wells with well drugs which were removed, added or
+        changed
+
+    Raises
+    ------
+    ValueError
+        If any of the wells to be annotated don't exist. Nothing is saved
+        in that case.
+    """
+    well_nums = []
+    orders = []
+    drug_ids = []
+    doses = []
+    for well_num, well in enumerate(wells):
+        well_drugs = well.get('drugs') or []
+        well_doses = well.get('doses') or []
+        for drug_order in range(max(len(well_drugs), len(well_doses))):
+            drug_id = well_drugs[drug_order] \
+                if drug_order < len(well_drugs) else None
+            dose = well_doses[drug_order] \
+                if drug_order < len(well_doses) else None
+            if apply_mode == 'drugs':
+                dose = None
+                if drug_id is None:
+                    continue
+            elif apply_mode == 'doses':
+                drug_id = None
+                if dose is None:
+                    continue
+            elif drug_id is None and dose is None:
+                continue
+            well_nums.append(well_num)
+            orders.append(drug_order)
+            drug_ids.append(_int_or_none(drug_id))
+            doses.append(_float_or_none(dose))
+
+    params = {'plate_ids': plate_ids, 'well_nums': well_nums,
+              'orders': orders, 'drug_ids': drug_ids, 'doses': doses}
+    tables = {'well': connection.ops.quote_name(Well._meta.db_table),
+              'welldrug': connection.ops.quote_name(WellDrug._meta.db_table)}
+    values = 'unnest(%(well_nums)s::integer[], %(orders)s::integer[], ' \
+             '%(drug_ids)s::integer[], %(doses)s::double precision[]) ' \
+             'AS v(well_num, drug_order, drug_id, dose)'
+
+    if apply_mode == 'drugs':
+        update_cols = ['drug_id']
+    elif apply_mode == 'doses':
+        update_cols = ['dose']
+    else:
+        update_cols = ['drug_id', 'dose']
+
+    changed_wells = set()
+    with connection.cursor() as cursor:
+        # The upsert below only writes rows for wells which exist, so check
+        # first that none of the requested rows would be dropped
+        cursor.execute(
+            'SELECT count(*) FROM {values} '
+            'JOIN {well} AS w ON w.well_num = v.well_num '
+            'AND w.plate_id = ANY(%(plate_ids)s::integer[])'.format(
+                values=values, **tables),
+            params
+        )
+        if cursor.fetchone()[0] != len(well_nums) * len(plate_ids):
+            raise ValueError('Wells must exist before drugs and doses can '
+                             'be added to them')
+
+        if apply_mode not in ('drugs', 'doses'):
+            # Remove well drugs which aren't in the new plate map. Rows with
+            # a different drug in the same position are removed too, so the
+            # upsert below can't violate the unique (well, drug) constraint.
+            cursor.execute(
+                'DELETE FROM {welldrug} AS wd USING {well} AS w '
+                'WHERE wd.well_id = w.id '
+                'AND w.plate_id = ANY(%(plate_ids)s::integer[]) '
+                'AND NOT EXISTS (SELECT 1 FROM {values} '
+                'WHERE v.well_num = w.well_num '
+                'AND v.drug_order = wd."order" '
+                'AND v.drug_id IS NOT DISTINCT FROM wd.drug_id) '
+                'RETURNING wd.well_id'.format(values=values, **tables),
+                params
+            )
+            changed_wells.update(row[0] for row in cursor.fetchall())
+
+        cursor.execute(
+            'INSERT INTO {welldrug} AS wd (well_id, "order", drug_id, dose) '
+            'SELECT w.id, v.drug_order, v.drug_id, v.dose FROM {values} '
+            'JOIN {well} AS w ON w.well_num = v.well_num '
+            'AND w.plate_id = ANY(%(plate_ids)s::integer[]) '
+            'ON CONFLICT (well_id, "order") DO UPDATE SET {set_cols} '
+            'WHERE ({cur_cols}) IS DISTINCT FROM ({new_cols}) '
+            'RETURNING wd.well_id'.format(
+                values=values,
+                set_cols=', '.join('{0} = EXCLUDED.{0}'.format(c)
+                                   for c in update_cols),
+                cur_cols=', '.join('wd.' + c for c in update_cols),
+                new_cols=', '.join('EXCLUDED.' + c for c in update_cols),
+                **tables),
+            params
+        )
+        changed_wells.update(row[0] for row in cursor.fetchall())
+
+    return changed_wells
+
+
 @transaction.atomic
 def ajax_save_plate(request):
     if not request.user.is_authenticated:
@@ -190,106 +374,130 @@ def ajax_save_plate(request):
 
     # TODO: Validate supplied cell line and drug IDs?
 
+    # Curve fits are per cell line, so note which cell lines the wells had
+    # before the save, to find the fits it affects
+    cell_lines_before = dict(Well.objects.filter(
+        plate_id__in=plate_ids).values_list('id', 'cell_line_id'))
+
     # Add the cell lines
+    cell_line_wells = {}
     if apply_mode not in ['drugs', 'doses']:
-        cell_line_ids = [well['cellLine'] for well in wells]
-        existing_wells = set(Well.objects.filter(
-            plate_id__in=plate_ids).values_list('plate_id', 'well_num'))
-        # Update existing wells
-        for cl_id in set(cell_line_ids):
-            Well.objects.filter(
-                plate_id__in=plate_ids,
-                well_num__in=np.where([this_id == cl_id for this_id in
-                                   cell_line_ids])[0]).update(
-                                                        cell_line_id=cl_id)
-        # Insert new wells
-        wells_to_insert = []
-        for plate in plate_ids:
-            for well_num, cell_line_id in enumerate(cell_line_ids):
-                if (plate, well_num) not in existing_wells:
-                    wells_to_insert.append(Well(
-                        well_num=well_num,
-                        plate_id=plate,
-                        cell_line_id=cell_line_id
-                    ))
-        Well.objects.bulk_create(wells_to_insert)
-
-    # Since we don't know how many drugs in each well there were previously
-    # in the case of an update, the easy
-    # solution is just to delete/reinsert. The alternative would be select
-    # for update, then delete/update/insert as appropriate, which would
-    # probably be slower anyway due to the extra queries.
-    if apply_mode != 'celllines':
-        well_drugs_to_create = defaultdict(AutoExtendList)
-
-        if apply_mode in ['drugs', 'doses']:
-            # If this is applying a template to multiple plates,
-            # we'll need to get the existing well information before the
-            # delete
-            for wd in WellDrug.objects.filter(well__plate_id__in=plate_ids):
-                if apply_mode == 'drugs' and wd.dose is not None:
-                    well_drugs_to_create[(wd.well_id, wd.order)] = \
-                        [None, wd.dose]
-                elif apply_mode == 'doses' and wd.drug_id is not None:
-                    well_drugs_to_create[(wd.well_id, wd.order)] = \
-                        [wd.drug_id, None]
-
-        WellDrug.objects.filter(well__plate_id__in=plate_ids).delete()
-
-        well_dict = {}
-        for w in Well.objects.filter(plate_id__in=plate_ids):
-            well_dict[(w.plate_id, w.well_num)] = w.id
-
-        for i, well in enumerate(wells):
-            drugs = well.get('drugs', [])
-            if drugs is None:
-                drugs = []
-            doses = well.get('doses', [])
-            if doses is None:
-                doses = []
-            if len(drugs) == 0 and len(doses) == 0:
-                continue
-            for drug_order in range(max(len(drugs), len(doses))):
-                drug_id = drugs[drug_order] if drug_order < len(drugs) else None
-                dose = doses[drug_order] if drug_order < len(doses) else None
-                if drug_id is None and dose is None:
-                    continue
+        cell_line_wells = _save_cell_lines(
+            plate_ids, [well['cellLine'] for well in wells])
 
-                for p_id in plate_ids:
-                    if apply_mode != 'doses' and drug_id is not None:
-                        well_drugs_to_create[(well_dict[(p_id, i)],
-                                              drug_order)][0] = drug_id
-                    if apply_mode != 'drugs' and dose is not None:
-                        well_drugs_to_create[(well_dict[(p_id, i)],
-                                              drug_order)][1] = dose
-
-        WellDrug.objects.bulk_create([
-            WellDrug(well_id=k[0], order=k[1], drug_id=v[0], dose=v[1] if
-                     len(v) > 1 else None) for k, v in
-                     well_drugs_to_create.items()])
-
-    dataset = pl_objs[0].dataset
-    # Update modified_date
-    dataset.save()
-
-    # TODO: Hand off for asynchronous processing with celery
-    dataset_groupings(dataset, regenerate_cache=True)
-    # Need to recalculate DIP rate in case wells have changed from control to
-    # expt or vice versa
-    precalculate_dip_rates(dataset, plate_ids=plate_ids)
-    precalculate_dip_curves(dataset)
-    precalculate_viability(dataset)
+    drug_wells = set()
+    control_plates = set()
+    if apply_mode != 'celllines':
+        expt_wells_before = _expt_wells(plate_ids)
+        try:
+            drug_wells = _save_well_drugs(plate_ids, wells, apply_mode)
+        except ValueError as e:
+            transaction.set_rollback(True)
+            return JsonResponse({'error': 'missing_wells',
+                                 'message': str(e)}, status=400)
+        if drug_wells:
+            # Plates with wells which changed from control to expt or vice
+            # versa
+            control_plates = set(
+                pl_id for _, pl_id in
+                expt_wells_before.items() ^ _expt_wells(plate_ids).items())
+
+    # Returned to the client, and used to decide what needs recalculating
+    changes = {'cellLineWells': len(cell_line_wells),
+               'drugWells': len(drug_wells),
+               'controlChangedPlates': sorted(control_plates)}
+
+    if cell_line_wells or drug_wells:
+        dataset = pl_objs[0].dataset
+        # Update modified_date
+        dataset.save()
+
+        # TODO: Hand off for asynchronous processing with celery
+        dataset_groupings(dataset, regenerate_cache=True)
+        # DIP rates only need recalculating for wells which have newly
+        # annotated cell lines, or have changed from control to expt or
+        # vice versa
+        dip_plate_ids = set(cell_line_wells.values()) | control_plates
+        if dip_plate_ids:
+            precalculate_dip_rates(dataset, plate_ids=sorted(dip_plate_ids))
+        # Only the fits for cell lines which the changed wells had before or
+        # have now need recalculating
+        changed_wells = set(cell_line_wells) | drug_wells
+        fit_cell_line_ids = set(Well.objects.filter(
+            id__in=changed_wells, cell_line__isnull=False
+        ).values_list('cell_line_id', flat=True))
+        fit_cell_line_ids.update(
+            cell_lines_before[well_id] for well_id in changed_wells
+            if cell_lines_before.get(well_id) is not None)
+        precalculate_dip_curves(dataset, cell_line_ids=fit_cell_line_ids)
+        precalculate_viability(dataset, cell_line_ids=fit_cell_line_ids)
 
     if apply_mode != 'normal':
         # If this was a template-based update...
-        return JsonResponse({'success': True, 'templateAppliedTo': plate_ids})
+        return JsonResponse({'success': True, 'templateAppliedTo': plate_ids,
+                             'changes': changes})
 
     if plate_data.get('loadNext', None):
         next_plate_id = plate_data['loadNext']
         return ajax_load_plate(request, plate_id=next_plate_id,
-                               extra_return_args={'savedPlateId': plate_id})
+                               extra_return_args={
+                                   'savedPlateId': plate_id,
+                                   'changes': changes})
     else:
-        return JsonResponse({'success': True, 'savedPlateId': plate_id})
+        return JsonResponse({'success': True, 'savedPlateId': plate_id,
+                             'changes': changes})
+
+
+def _plate_columns(plates, use_names=False):
+    """
+    Load the annotations and DIP rates for a set of plates
+
+    Each type of data is fetched for all of the plates with a single query.
+
+    Parameters
+    ----------
+    plates: list
+        Plate objects
+    use_names: bool
+        Return cell line and drug names rather than IDs
+
+    Returns
+    -------
+    dict
+        Keyed by plate ID, each value is a dict of arrays with one entry
+        per well: cellLines, drugs and doses (lists, in drug order) and
+        dipRates
+    """
+    field_ext = '__name' if use_names else '_id'
+    plate_ids = [p.id for p in plates]
+    columns = {p.id: {'cellLines': [None] * p.num_wells,
+                      'drugs': [AutoExtendList() for _ in range(p.num_wells)],
+                      'doses': [AutoExtendList() for _ in range(p.num_wells)],
+                      'dipRates': [None] * p.num_wells}
+               for p in plates}
+
+    for plate_id, well_num, cell_line in Well.objects.filter(
+            plate_id__in=plate_ids).values_list(
+            'plate_id', 'well_num', 'cell_line' + field_ext):
+        columns[plate_id]['cellLines'][well_num] = cell_line
+
+    for plate_id, well_num, order, drug, dose in WellDrug.objects.filter(
+            well__plate_id__in=plate_ids).values_list(
+            'well__plate_id', 'well__well_num', 'order', 'drug' + field_ext,
+            'dose'):
+        columns[plate_id]['drugs'][well_num][order] = drug
+        columns[plate_id]['doses'][well_num][order] = dose
+
+    # The dataset filter allows partition pruning
+    for plate_id, well_num, value in WellStatistic.objects.filter(
+            dataset_id__in=set(p.dataset_id for p in plates),
+            well__plate_id__in=plate_ids, stat_name='dip_rate'
+    ).values_list('well__plate_id', 'well__well_num', 'value'):
+        # Need to remove NaNs for proper JSON support
+        columns[plate_id]['dipRates'][well_num] = value if \
+            value is not None and not math.isnan(value) else None
+
+    return columns
 
 
 def ajax_load_plate(request, plate_id, extra_return_args=None,
@@ -307,37 +515,12 @@ def ajax_load_plate(request, plate_id, extra_return_args=None,
         return HttpResponse(LICENSE_UNSIGNED.format(escape(p.dataset.name)),
                             status=400)
 
-    field_ext = '__name' if use_names else '_id'
-
-    # Blank well data
-    wells = []
-    for cl in range(p.num_wells):
-        wells.append({'cellLine': None,
-                      'drugs': AutoExtendList(),
-                      'doses': AutoExtendList(),
-                      'dipRate': None})
-
-    # Populate cell lines
-    cl_query = Well.objects.filter(plate_id=plate_id).values(
-        'well_num', 'cell_line' + field_ext)
-    for w in cl_query:
-        wells[w['well_num']]['cellLine'] = w['cell_line' + field_ext]
-
-    # Populate drugs
-    drugs = WellDrug.objects.filter(well__plate_id=plate_id).values(
-        'well__well_num', 'drug' + field_ext, 'order', 'dose')
-    for dr in drugs:  # prefetched above
-        wells[dr['well__well_num']]['drugs'][dr['order']] = dr['drug' +
-                                                               field_ext]
-        wells[dr['well__well_num']]['doses'][dr['order']] = dr['dose']
-
-    # Populate DIP rates
-    for ws in WellStatistic.objects.filter(
-            well__plate_id=plate_id, stat_name='dip_rate'
-    ).values('well__well_num', 'value'):
-        # Need to remove NaNs for proper JSON support
-        wells[ws['well__well_num']]['dipRate'] = ws['value'] if \
-            ws['value'] is not None and not math.isnan(ws['value']) else None
+    columns = _plate_columns([p], use_names=use_names)[p.id]
+    wells = [{'cellLine': cell_line, 'drugs': drugs, 'doses': doses,
+              'dipRate': dip_rate}
+             for cell_line, drugs, doses, dip_rate in zip(
+                columns['cellLines'], columns['drugs'], columns['doses'],
+                columns['dipRates'])]
 
     plate = {'datasetName': p.dataset.name,
              'plateId': p.id,
@@ -354,3 +537,50 @@ def ajax_load_plate(request, plate_id, extra_return_args=None,
         return_dict.update(extra_return_args)
 
     return JsonResponse(return_dict)
+
+
+def ajax_load_plates(request):
+    """
+    Load several plates at once, for prefetching
+
+    Plates are given by repeated plateId query parameters. Well data is
+    returned as arrays (see _plate_columns), rather than a dict per well.
+    """
+    if not request.user.is_authenticated and settings.LOGIN_REQUIRED:
+        return JsonResponse({}, status=401)
+
+    try:
+        plate_ids = [int(p_id) for p_id in request.GET.getlist('plateId')]
+    except ValueError:
+        return JsonResponse({'error': 'Plate IDs must be integers'},
+                            status=400)
+    if not plate_ids:
+        return JsonResponse({'error': 'No plate IDs supplied'}, status=400)
+    if len(plate_ids) > MAX_LOAD_PLATES:
+        return JsonResponse({'error': 'A maximum of {} plates can be loaded '
+                                      'at once'.format(MAX_LOAD_PLATES)},
+                            status=400)
+
+    plates = {p.id: p for p in Plate.objects.filter(
+        id__in=plate_ids).select_related('dataset')}
+    if len(plates) != len(set(plate_ids)):
+        raise Http404()
+
+    datasets = {p.dataset_id: p.dataset for p in plates.values()}
+    for dataset in datasets.values():
+        _assert_has_perm(request, dataset, 'view_plate_layout')
+        if not license_accepted(request, dataset):
+            return HttpResponse(LICENSE_UNSIGNED.format(escape(dataset.name)),
+                                status=400)
+
+    columns = _plate_columns(list(plates.values()))
+
+    return JsonResponse({'success': True, 'plates': [
+        dict(columns[p_id],
+             datasetName=plates[p_id].dataset.name,
+             plateId=p_id,
+             plateName=plates[p_id].name,
+             numCols=plates[p_id].width,
+             numRows=plates[p_id].height)
+        for p_id in plate_ids
+    ]})
@@ -1,80 +1,334 @@
+import base64
 import collections
+import copy
 import json
+import numbers
+import re
 import warnings
 
-from django.core.cache import cache
-from django.http import HttpResponse
+import numpy as np
+import pandas as pd
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
 from django.shortcuts import Http404, render
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.html import escape, strip_tags
+from django.utils.text import compress_sequence, compress_string
 from django.views.decorators.csrf import ensure_csrf_cookie
-from plotly.offline.offline import get_plotlyjs
-from plotly.utils import PlotlyJSONEncoder
 from thunor.config import plotly_template as default_plotly_template
 from thunor.curve_fit import AAFitWarning, fit_params_from_base
-from thunor.helpers import plotly_to_dataframe
-from thunor.plots import (
-    E_REGEX,
-    E_REL_REGEX,
-    EC_REGEX,
-    IC_REGEX,
-    CannotPlotError,
-    plot_ctrl_cell_counts_by_plate,
-    plot_ctrl_dip_by_plate,
-    plot_drc,
-    plot_drc_params,
-    plot_drug_combination_heatmap,
-    plot_plate_map,
-    plot_time_course,
-)
+from thunor.helpers import format_dose, plotly_to_dataframe
+from thunor.io import HtsPandas
 from thunor.viability import viability
 
-from thunorweb.models import CellLine, CellLineTag, Drug, DrugTag, HTSDataset
+from thunorweb.caching import tiered_cache
+from thunorweb.models import CellLine, Drug, HTSDataset
 from thunorweb.pandas import (
+    TIMECOURSE_DOWNSAMPLE_METHODS,
     NoDataException,
+    aggregate_timecourses,
+    dataset_curve_fits,
     df_control_wells,
     df_ctrl_dip_rates,
     df_curve_fits,
     df_dip_rates,
     df_doses_assays_controls,
+    downsample_timecourses,
+)
+from thunorweb.plotlyjs import (
+    PLOTLYJS_PLACEHOLDER,
+    get_plotlyjs,
+    get_plotlyjs_gzip,
+    split_standalone,
+    standalone_parts,
 )
 from thunorweb.views import _assert_has_perm, login_required_unless_public
 from thunorweb.views.datasets import (
     LICENSE_UNSIGNED,
-    _get_celllinetag_permfilter,
-    _get_drugtag_permfilter,
     dataset_groupings,
     license_accepted,
 )
 from thunorweb.views.plate_mapper import ajax_load_plate
-from thunorweb.views.tags import TAG_EVERYTHING_ELSE
+from thunorweb.views.tags import TAG_EVERYTHING_ELSE, get_tag_index
+
+# brotli and orjson come from the optional "speedups" extra
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# plotly and thunor.plots (which imports seaborn and matplotlib) are slow to
+# import, so they're imported in the functions which use them. This keeps
+# worker startup fast (see test_import_time). pandas, scipy and
+# thunor.curve_fit are still imported at startup: Plate subclasses
+# thunor.io.PlateMap, which needs pandas and scipy, and thunor.curve_fit
+# adds little on top of those.
 
 SECONDS_TO_HOURS = 3600
 MAX_COLOR_GROUPS = 10
 TAG_EVERYTHING_ELSE_LABEL = 'Everything else'
 ALLOWED_TEMPLATES = ('none', 'plotly_white', 'plotly_dark', 'presentation')
+MIN_DOWNSAMPLE_POINTS = 4
+# Opacity of the standard deviation bands on aggregated time courses
+RIBBON_OPACITY = 0.2
+# Maximum number of plots in a single batch request
+MAX_BATCH_PLOTS = 20
+# Responses smaller than this (in bytes) aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+CSV_CHUNK_ROWS = 5000
+BROTLI_QUALITY = 5
+# plotly.js URLs include a checksum, so can be cached for a year
+PLOTLYJS_MAX_AGE = 365 * 24 * 3600
+# Shorter numeric arrays are left as plain JSON lists
+TYPED_ARRAY_MIN_LENGTH = 16
+# Plotly attributes which must not be converted to typed arrays
+TYPED_ARRAY_SKIP_KEYS = frozenset(('range', 'geojson', 'layer', 'layers'))
+INT32_MIN, INT32_MAX = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+re_accepts_brotli = re.compile(r'\bbr\b')
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def _typed_array(values):
+    """
+    Plotly.js typed array (base64 binary) spec for a numeric list
+
+    Returns None if the list isn't purely numeric. Missing values (None)
+    are encoded as NaN.
+    """
+    if len(values) < TYPED_ARRAY_MIN_LENGTH:
+        return None
+
+    is_int = True
+    for v in values:
+        if v is None:
+            is_int = False
+        elif isinstance(v, bool) or not isinstance(v, numbers.Real):
+            return None
+        elif is_int and not isinstance(v, numbers.Integral):
+            is_int = False
 
+    if is_int and INT32_MIN <= min(values) and max(values) <= INT32_MAX:
+        arr = np.asarray(values, dtype='<i4')
+        dtype = 'i4'
+    else:
+        arr = np.asarray(values, dtype='<f8')
+        dtype = 'f8'
 
-@login_required_unless_public
-def ajax_get_plot(request, file_type='json'):
-    if file_type == 'csv':
-        permission_required = 'download_data'
+    return {'dtype': dtype, 'bdata': base64.b64encode(arr).decode('ascii')}
+
+
+def _convert_typed_arrays(obj):
+    """ Convert numeric lists in plotly trace data to typed arrays in place """
+    items = obj.items() if isinstance(obj, dict) else enumerate(obj)
+    for key, value in items:
+        if key in TYPED_ARRAY_SKIP_KEYS:
+            continue
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        if isinstance(value, (list, tuple)):
+            typed_array = _typed_array(value)
+            if typed_array is not None:
+                obj[key] = typed_array
+                continue
+        if isinstance(value, (dict, list)):
+            _convert_typed_arrays(value)
+
+
+def plot_to_json(plot_fig, typed_arrays=False):
+    """
+    Serialize a plotly figure to JSON
+
+    Uses orjson when it's installed (from the "speedups" extra), otherwise
+    the standard library encoder with PlotlyJSONEncoder.
+
+    Parameters
+    ----------
+    plot_fig: plotly.graph_objects.Figure or dict
+        Figure to serialize
+    typed_arrays: bool
+        Encode numeric trace arrays in Plotly's typed array (base64 binary)
+        format, which is much more compact for large figures
+
+    Returns
+    -------
+    str
+        Figure as JSON
+    """
+    from plotly.io.json import to_json_plotly
+
+    if typed_arrays:
+        if isinstance(plot_fig, dict):
+            plot_fig = copy.deepcopy(plot_fig)
+        else:
+            plot_fig = plot_fig.to_plotly_json()
+        _convert_typed_arrays(plot_fig.get('data', []))
+
+    return to_json_plotly(plot_fig, engine='auto')
+
+
+def _csv_streaming_response(df):
+    """
+    Stream a DataFrame as CSV, a chunk of rows at a time
+
+    Only one chunk is formatted at once, so large tables don't need to be
+    held in memory as a single string.
+    """
+    def rows():
+        for start in range(0, max(len(df), 1), CSV_CHUNK_ROWS):
+            yield df.iloc[start:start + CSV_CHUNK_ROWS].to_csv(
+                header=start == 0)
+
+    return StreamingHttpResponse(rows(), content_type='text/csv')
+
+
+def _brotli_compress_sequence(sequence):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    for item in sequence:
+        data = compressor.process(item)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def _compress_streaming_response(request, response):
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    if brotli is not None and re_accepts_brotli.search(accept_encoding):
+        response.streaming_content = _brotli_compress_sequence(
+            response.streaming_content)
+        encoding = 'br'
+    elif re_accepts_gzip.search(accept_encoding):
+        response.streaming_content = compress_sequence(
+            response.streaming_content)
+        encoding = 'gzip'
     else:
-        permission_required = 'view_plots'
+        return response
+
+    if response.has_header('Content-Length'):
+        del response['Content-Length']
+    response['Content-Encoding'] = encoding
+    return response
+
+
+def _compress_response(request, response):
+    """ Compress a response with brotli or gzip, if the client accepts it """
+    if response.has_header('Content-Encoding'):
+        return response
+
+    if response.streaming:
+        patch_vary_headers(response, ('Accept-Encoding', ))
+        return _compress_streaming_response(request, response)
+
+    if len(response.content) < COMPRESS_MIN_SIZE:
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding', ))
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    if brotli is not None and re_accepts_brotli.search(accept_encoding):
+        content = brotli.compress(response.content, quality=BROTLI_QUALITY)
+        encoding = 'br'
+    elif re_accepts_gzip.search(accept_encoding):
+        content = compress_string(response.content)
+        encoding = 'gzip'
+    else:
+        return response
+
+    if len(content) >= len(response.content):
+        return response
+
+    response.content = content
+    response['Content-Length'] = str(len(content))
+    response['Content-Encoding'] = encoding
+    return response
+
+
+class _PlotData(object):
+    """
+    Datasets and curve fits loaded while building plots
+
+    A batch request shares one instance between all its plots, so each
+    dataset is fetched and permission checked once, and identical curve fit
+    queries only hit the database once.
+    """
+    def __init__(self, request, permission_required):
+        self.request = request
+        self.permission_required = permission_required
+        self._datasets = {}
+        self._curve_fits = {}
+
+    def dataset(self, dataset_id):
+        try:
+            return self._datasets[dataset_id]
+        except KeyError:
+            pass
+
+        try:
+            dataset = HTSDataset.objects.get(pk=dataset_id)
+        except HTSDataset.DoesNotExist:
+            raise Http404()
+
+        _assert_has_perm(self.request, dataset, self.permission_required)
+        self._datasets[dataset_id] = dataset
+        return dataset
+
+    def _dataset_curve_fits(self, dataset_id, stat_type, drug_id,
+                            cell_line_id):
+        """ A single dataset's curve fits, filtered from its cached frame """
+        base_params = dataset_curve_fits(self.dataset(dataset_id), stat_type)
+        base_params = base_params[
+            base_params['drug_id'].isin(drug_id) &
+            base_params['cell_line_id'].isin(cell_line_id)].drop(
+            columns=['cell_line_id', 'drug_id'])
+        if base_params.empty:
+            raise NoDataException()
+        return base_params
+
+    def curve_fits(self, dataset_ids, stat_type, drug_id, cell_line_id):
+        key = (dataset_ids if isinstance(dataset_ids, int)
+               else tuple(dataset_ids),
+               stat_type, frozenset(drug_id), frozenset(cell_line_id))
+        if key not in self._curve_fits:
+            if isinstance(dataset_ids, int):
+                self._curve_fits[key] = self._dataset_curve_fits(
+                    dataset_ids, stat_type, drug_id, cell_line_id)
+            else:
+                self._curve_fits[key] = df_curve_fits(
+                    dataset_ids, stat_type, drug_id, cell_line_id,
+                    include_fit_params=True)
+
+        # Copy, in case a plot modifies its parameters in place
+        return self._curve_fits[key].copy()
+
+
+def _plot_figure(request, params, plot_data, table=False):
+    """
+    Build the figure described by a set of plot parameters
+
+    Returns the plotly figure, or an HttpResponse describing an error. With
+    table=True, plots whose data is already a table (currently dose response
+    parameter plots without aggregation) return that DataFrame instead, so
+    the figure doesn't need building just to be converted back.
+    """
+    from thunor.plots import (
+        plot_ctrl_dip_by_plate,
+        plot_plate_map,
+        plot_time_course,
+    )
 
     try:
-        plot_type = request.GET['plotType']
-        template = request.GET.get('theme', default_plotly_template)
+        plot_type = params['plotType']
+        template = params.get('theme', default_plotly_template)
         if template not in ALLOWED_TEMPLATES:
             return HttpResponse('Please select an allowed template', status=400)
 
-        dataset_id = int(request.GET['datasetId'])
-        dataset2_id = request.GET.get('dataset2Id', None)
+        dataset_id = int(params['datasetId'])
+        dataset2_id = params.get('dataset2Id', None)
         if dataset2_id == "":
             dataset2_id = None
         if dataset2_id is not None:
             dataset2_id = int(dataset2_id)
-        cell_line_id = request.GET.getlist('c')
-        drug_id = request.GET.getlist('d')
+        cell_line_id = params.getlist('c')
+        drug_id = params.getlist('d')
 
         cell_line_id = [int(cl) for cl in cell_line_id]
         drug_ids = []
@@ -85,18 +339,13 @@ def ajax_get_plot(request, file_type='json'):
                 drug_ids.append([int(d) for d in dr.split(",")])
         drug_id = drug_ids
 
-        assay = request.GET.get('assayId')
-        yaxis = request.GET.get('logTransform', 'None')
+        assay = params.get('assayId')
+        yaxis = params.get('logTransform', 'None')
 
     except (KeyError, ValueError):
         raise Http404()
 
-    try:
-        dataset = HTSDataset.objects.get(pk=dataset_id)
-    except HTSDataset.DoesNotExist:
-        raise Http404()
-
-    _assert_has_perm(request, dataset, permission_required)
+    dataset = plot_data.dataset(dataset_id)
     if not license_accepted(request, dataset):
         return HttpResponse(LICENSE_UNSIGNED.format(escape(dataset.name)),
                             status=400)
@@ -120,12 +369,46 @@ def ajax_get_plot(request, file_type='json'):
         if assay is None:
             assay = df_data.assays.index.get_level_values('assay')[0]
 
-        overlay_dip_fit = request.GET.get('overlayDipFit', 'false') == 'true'
+        overlay_dip_fit = params.get('overlayDipFit', 'false') == 'true'
 
         if overlay_dip_fit and assay != df_data.dip_assay_name:
             return HttpResponse('Can only overlay DIP rate on cell '
                                 'proliferation assays', status=400)
 
+        try:
+            downsample_points = int(params.get('downsamplePoints', 0))
+        except ValueError:
+            return HttpResponse('Number of points to downsample to must be '
+                                'an integer', status=400)
+        downsample_method = params.get('downsampleMethod', 'lttb')
+        if downsample_method not in TIMECOURSE_DOWNSAMPLE_METHODS:
+            return HttpResponse('Unknown downsampling method', status=400)
+        aggregate_wells = params.get('aggregateWells', 'false') == 'true'
+
+        if overlay_dip_fit and (downsample_points or aggregate_wells):
+            return HttpResponse('DIP rate overlay is calculated from all '
+                                'time points, so is not available with '
+                                'downsampling or aggregated wells',
+                                status=400)
+
+        ribbons = None
+        if aggregate_wells:
+            df_data, ribbons = aggregate_timecourses(
+                df_data, assay, log_transform=yaxis == 'log2')
+
+        if downsample_points:
+            if downsample_points < MIN_DOWNSAMPLE_POINTS:
+                return HttpResponse('Number of points to downsample to must '
+                                    'be at least {}'.format(
+                                        MIN_DOWNSAMPLE_POINTS), status=400)
+            df_data = HtsPandas(
+                df_data.doses,
+                downsample_timecourses(df_data.assays, downsample_points,
+                                       downsample_method),
+                None if df_data.controls is None else downsample_timecourses(
+                    df_data.controls, downsample_points, downsample_method)
+            )
+
         plot_fig = plot_time_course(
             df_data,
             log_yaxis=yaxis == 'log2',
@@ -134,25 +417,29 @@ def ajax_get_plot(request, file_type='json'):
             subtitle=dataset.name,
             template=template
         )
+
+        if ribbons is not None:
+            plot_fig = _add_sd_ribbons(plot_fig, ribbons)
     elif plot_type in ('drc', 'drpar'):
         if all(isinstance(d, int) for d in drug_id):
-            plot_fig = _dose_response_plot(request, dataset, dataset2_id,
-                                           permission_required, drug_id,
-                                           cell_line_id, plot_type, template)
+            plot_fig = _dose_response_plot(request, params, plot_data,
+                                           dataset, dataset2_id, drug_id,
+                                           cell_line_id, plot_type, template,
+                                           table=table)
         else:
             if dataset2_id is not None:
                 return HttpResponse(
                     'Please select a single dataset at a time to view drug '
                     'combination heat plots', status=400)
 
-            plot_fig = _drug_combination_heatmap(request, dataset,
+            plot_fig = _drug_combination_heatmap(params, dataset,
                                                  drug_id, cell_line_id,
                                                  template)
 
         if isinstance(plot_fig, HttpResponse):
             return plot_fig
     elif plot_type == 'qc':
-        qc_view = request.GET.get('qcView', None)
+        qc_view = params.get('qcView', None)
         if qc_view == 'ctrldipbox':
             ctrl_dip_data = df_ctrl_dip_rates(dataset_id)
             if ctrl_dip_data is None:
@@ -161,47 +448,10 @@ def ajax_get_plot(request, file_type='json'):
                                     'dataset.', status=400)
             plot_fig = plot_ctrl_dip_by_plate(ctrl_dip_data, template=template)
         elif qc_view == 'ctrlcellbox':
-            # Try to fetch from cache
-            cache_key = f'dataset_{dataset_id}_plot_ctrlcellbox'
-            cur_plotver = 1
-            plot_cached = cache.get(cache_key)
-            if plot_cached:
-                plot_fig = plot_cached['plot_fig']
-            cache_stale = (
-                plot_cached is None
-                or plot_cached['dataset_last_modified'] < dataset.modified_date
-                or plot_cached['plot_version'] < cur_plotver
-            )
-            if cache_stale:
-                # Create plot
-                groupings = dataset_groupings(dataset)
-                if not groupings['singleTimepoint']:
-                    return HttpResponse('This plot type is only available for '
-                                        'single time-point datasets', status=400)
-                try:
-                    df_data = df_control_wells(
-                        dataset_id=dataset,
-                        assay=assay
-                    )
-                except NoDataException:
-                    return HttpResponse('No data found for this request.',
-                                        status=400)
-                if (df_data['value'] == 100.0).all():
-                    return HttpResponse(
-                        'The raw data for this dataset is given as relative '
-                        'viability, so no control wells are available',
-                        status=400)
-
-                plot_fig = plot_ctrl_cell_counts_by_plate(
-                    df_data, subtitle=dataset.name, template=template)
-
-                # Push to cache
-                cache.set(cache_key, {'dataset_last_modified': dataset.modified_date,
-                                      'plot_version': cur_plotver,
-                                      'plot_fig': plot_fig})
+            plot_fig = ctrl_cell_counts_plot(dataset, assay, template)
 
         elif qc_view == 'dipplatemap':
-            plate_id = request.GET.get('plateId', None)
+            plate_id = params.get('plateId', None)
             try:
                 plate_id = int(plate_id)
             except ValueError:
@@ -219,82 +469,294 @@ def ajax_get_plot(request, file_type='json'):
                             escape(plot_type),
                             status=400)
 
+    return plot_fig
+
+
+def _standalone_html_response(request, context):
+    """
+    Render a standalone HTML plot, which works without Thunor's own assets
+
+    By default, plotly.js is included in the file. The template is rendered
+    with a placeholder in its place, and the cached library is streamed in
+    between the two halves, already compressed if the client accepts gzip.
+    With plotlyJs=link, the file instead loads plotly.js from
+    ajax_plotlyjs, which browsers can cache across downloads.
+    """
+    plotlyjs = get_plotlyjs()
+    if request.GET.get('plotlyJs', 'inline') == 'link':
+        context['plotlyjs_url'] = request.build_absolute_uri(reverse(
+            'thunorweb:ajax_plotlyjs', args=[plotlyjs.checksum]))
+        return render(request, 'plotly_plot_standalone.html', context)
+
+    context['plotlyjs'] = PLOTLYJS_PLACEHOLDER
+    head, tail = split_standalone(render_to_string(
+        'plotly_plot_standalone.html', context, request=request))
+    use_gzip = re_accepts_gzip.search(
+        request.headers.get('Accept-Encoding', '')) is not None
+    length, parts = standalone_parts(head, tail, gzip=use_gzip)
+    response = StreamingHttpResponse(parts,
+                                     content_type='text/html; charset=utf-8')
+    response['Content-Length'] = str(length)
+    patch_vary_headers(response, ('Accept-Encoding', ))
+    if use_gzip:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+
+@login_required_unless_public
+def ajax_get_plot(request, file_type='json'):
+    if file_type == 'csv':
+        permission_required = 'download_data'
+    else:
+        permission_required = 'view_plots'
+
+    plot_fig = _plot_figure(request, request.GET,
+                            _PlotData(request, permission_required),
+                            table=file_type == 'csv')
+    if isinstance(plot_fig, HttpResponse):
+        return plot_fig
+
     as_attachment = request.GET.get('download', '0') == '1'
 
     if file_type == 'json':
-        j = json.dumps(plot_fig, cls=PlotlyJSONEncoder)
+        typed_arrays = not as_attachment and \
+            request.GET.get('typedArrays', 'false') == 'true'
+        j = plot_to_json(plot_fig, typed_arrays=typed_arrays)
         response = HttpResponse(j, content_type='application/json')
     elif file_type == 'csv':
-        response = HttpResponse(plotly_to_dataframe(plot_fig).to_csv(),
-                                content_type='text/csv')
+        if isinstance(plot_fig, pd.DataFrame):
+            response = _csv_streaming_response(plot_fig)
+        else:
+            response = _csv_streaming_response(plotly_to_dataframe(plot_fig))
     elif file_type == 'html':
-        template = 'plotly_plot{}.html'.format('_standalone' if
-                                               as_attachment else '')
         context = {
-            'data': json.dumps(plot_fig, cls=PlotlyJSONEncoder),
+            'data': plot_to_json(plot_fig),
             'page_title': strip_tags(plot_fig['layout']['title']['text'])
         }
         if as_attachment:
-            context['plotlyjs'] = get_plotlyjs()
-        response = render(request, template, context)
+            response = _standalone_html_response(request, context)
+        else:
+            response = render(request, 'plotly_plot.html', context)
     else:
         return HttpResponse('Unknown file type: %s' % escape(file_type), status=400)
 
     if as_attachment:
-        try:
-            title = plot_fig['layout']['title']['text']
-        except KeyError:
-            title = 'Plot'
+        if isinstance(plot_fig, pd.DataFrame):
+            title = plot_fig.attrs.get('title', 'Plot')
+        else:
+            try:
+                title = plot_fig['layout']['title']['text']
+            except KeyError:
+                title = 'Plot'
         response['Content-Disposition'] = \
             'attachment; filename="{}.{}"'.format(strip_tags(title), file_type)
 
-    return response
+    return _compress_response(request, response)
 
 
-def _process_aggreate(request, tag_type, tag_ids, aggregation, dataset_ids):
-    if tag_type == 'cell_lines':
-        TagClass = CellLineTag
-        perm_filter = _get_celllinetag_permfilter(request)
+def ajax_plotlyjs(request, checksum):
+    """
+    Serve the plotly.js used by standalone HTML plots
+
+    The checksum in the URL changes with the library, so responses can be
+    cached indefinitely. No login is needed, so downloaded plots keep
+    working when shared.
+    """
+    plotlyjs = get_plotlyjs()
+    if checksum != plotlyjs.checksum:
+        raise Http404()
+
+    if re_accepts_gzip.search(request.headers.get('Accept-Encoding', '')):
+        response = HttpResponse(get_plotlyjs_gzip(),
+                                content_type='text/javascript')
+        response['Content-Encoding'] = 'gzip'
     else:
-        TagClass = DrugTag
-        perm_filter = _get_drugtag_permfilter(request)
+        response = HttpResponse(plotlyjs.source,
+                                content_type='text/javascript')
+    patch_vary_headers(response, ('Accept-Encoding', ))
+    patch_cache_control(response, public=True, immutable=True,
+                        max_age=PLOTLYJS_MAX_AGE)
+    return response
 
-    tag_base_query = TagClass.objects.filter(perm_filter).filter(
-        id__in=tag_ids).distinct()
+
+@login_required_unless_public
+def ajax_get_plots(request):
+    """
+    Build several plots in one request
+
+    Each "plot" POST value holds the query string for one plot, as used by
+    ajax_get_plot. Datasets and curve fits are shared between the plots.
+    The response holds a list of figures, in the same order; plots which
+    couldn't be built are replaced by an object with an "error" key.
+    """
+    if request.method != 'POST':
+        return HttpResponse('POST request required', status=405)
+
+    plot_specs = request.POST.getlist('plot')
+    if not plot_specs:
+        return HttpResponse('At least one plot is required', status=400)
+    if len(plot_specs) > MAX_BATCH_PLOTS:
+        return HttpResponse('A maximum of {} plots can be requested at '
+                            'once'.format(MAX_BATCH_PLOTS), status=400)
+
+    typed_arrays = request.POST.get('typedArrays', 'false') == 'true'
+    plot_data = _PlotData(request, 'view_plots')
+    plots_json = []
+    for plot_spec in plot_specs:
+        try:
+            plot_fig = _plot_figure(request, QueryDict(plot_spec), plot_data)
+        except Http404:
+            plot_fig = HttpResponse('Invalid plot parameters, or dataset '
+                                    'not found', status=404)
+
+        if isinstance(plot_fig, HttpResponse):
+            plots_json.append(json.dumps({
+                'error': plot_fig.content.decode(plot_fig.charset),
+                'status': plot_fig.status_code
+            }))
+        else:
+            plots_json.append(plot_to_json(plot_fig,
+                                           typed_arrays=typed_arrays))
+
+    response = HttpResponse('{{"plots":[{}]}}'.format(','.join(plots_json)),
+                            content_type='application/json')
+    return _compress_response(request, response)
+
+
+def ctrl_cell_counts_plot(dataset, assay=None,
+                          template=default_plotly_template,
+                          regenerate_cache=False):
+    """
+    Control well cell counts by plate, for single time point datasets
+
+    The plot is cached until the dataset is modified. Returns the plotly
+    figure, or an HttpResponse describing an error.
+    """
+    from thunor.plots import plot_ctrl_cell_counts_by_plate
+
+    # Try to fetch from cache
+    cache_key = f'dataset_{dataset.id}_plot_ctrlcellbox'
+    cur_plotver = 1
+    plot_cached = None if regenerate_cache else tiered_cache.get(cache_key)
+    cache_stale = (
+        plot_cached is None
+        or plot_cached['dataset_last_modified'] < dataset.modified_date
+        or plot_cached['plot_version'] < cur_plotver
+    )
+    if not cache_stale:
+        return plot_cached['plot_fig']
+
+    # Create plot
+    groupings = dataset_groupings(dataset)
+    if not groupings['singleTimepoint']:
+        return HttpResponse('This plot type is only available for '
+                            'single time-point datasets', status=400)
+    try:
+        df_data = df_control_wells(
+            dataset_id=dataset,
+            assay=assay
+        )
+    except NoDataException:
+        return HttpResponse('No data found for this request.',
+                            status=400)
+    if (df_data['value'] == 100.0).all():
+        return HttpResponse(
+            'The raw data for this dataset is given as relative '
+            'viability, so no control wells are available',
+            status=400)
+
+    plot_fig = plot_ctrl_cell_counts_by_plate(
+        df_data, subtitle=dataset.name, template=template)
+
+    # Push to cache
+    tiered_cache.set(cache_key, {
+        'dataset_last_modified': dataset.modified_date,
+        'plot_version': cur_plotver,
+        'plot_fig': plot_fig
+    })
+
+    return plot_fig
+
+
+def _add_sd_ribbons(plot_fig, ribbons):
+    """
+    Add mean ± standard deviation bands to an aggregated time course plot
+
+    Parameters
+    ----------
+    plot_fig: plotly.graph_objects.Figure
+        Time course plot of aggregated wells, from plot_time_course
+    ribbons: dict
+        Mean and standard deviation by time point, keyed by dose (or None
+        for controls), from aggregate_timecourses
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        Figure with a band behind each trace
+    """
+    from plotly import graph_objects as go
+
+    ribbons = {
+        '__Control' if dose is None else
+        format_dose(dose, array_as_string=' &amp; '): stats
+        for dose, stats in ribbons.items()
+    }
+
+    bands = []
+    for trace in plot_fig.data:
+        stats = ribbons.get(trace.legendgroup)
+        if stats is None:
+            continue
+        hours = stats.index / pd.Timedelta(hours=1)
+        # Only use time points in the trace, which may be downsampled
+        stats = stats[np.isin(hours, trace.x)]
+        hours = list(stats.index / pd.Timedelta(hours=1))
+        sd = stats['std'].fillna(0)
+        bands.append(go.Scatter(
+            x=hours + hours[::-1],
+            y=list(stats['mean'] + sd) + list(stats['mean'] - sd)[::-1],
+            fill='toself',
+            fillcolor=trace.line.color,
+            opacity=RIBBON_OPACITY,
+            line={'width': 0},
+            hoverinfo='skip',
+            legendgroup=trace.legendgroup,
+            showlegend=False
+        ))
+
+    return go.Figure(data=bands + list(plot_fig.data), layout=plot_fig.layout)
+
+
+def _process_aggreate(request, tag_type, tag_ids, aggregation, dataset_ids):
+    tag_index = get_tag_index(request, tag_type)
+    tags = [tag_index.tags[t] for t in set(tag_ids) if t in tag_index.tags]
+    entity_ids = np.unique(np.concatenate(
+        [tag.entity_ids for tag in tags] + [np.empty(0, dtype=np.int64)]))
     if not aggregation and TAG_EVERYTHING_ELSE not in tag_ids:
-        return tag_base_query.values_list('{}__id'.format(tag_type),
-                                          flat=True), aggregation
-
-    tag_objs = tag_base_query.values_list(
-        'tag_category', 'tag_name', '{}__id'.format(tag_type),
-        '{}__name'.format(tag_type))
-    entity_ids = [tag[2] for tag in tag_objs]
-    cats = set(tag[0] for tag in tag_objs)
-    use_cats = len(cats) > 1
-    # if not use_cats:
-    #     (aggregate_cell_lines_group, ) = cats
-
-    agg = collections.defaultdict(list)
-    for tag in tag_objs:
-        tag_name = '{} [{}]'.format(tag[1], tag[0]) if use_cats \
-            else tag[1]
-        agg[tag_name].append(tag[3])
+        return entity_ids.tolist(), aggregation
+
+    use_cats = len(set(tag.tag_category for tag in tags)) > 1
 
     aggregation = {}
 
     if TAG_EVERYTHING_ELSE in tag_ids:
         groupings = dataset_groupings(dataset_ids)
-        ent_dict = {e['id']: e['name'] for e in groupings[
-            'cellLines' if tag_type == 'cell_lines' else 'drugs']}
-        all_ent_ids = set(ent_dict.keys())
-        everything_else_ids = all_ent_ids.difference(entity_ids)
-        everything_else_names = [name for eid, name in ent_dict.items() if
-                                 eid in everything_else_ids]
-        aggregation[TAG_EVERYTHING_ELSE_LABEL] = everything_else_names
-        entity_ids = all_ent_ids
-
-    for tag_name, vals in agg.items():
-        aggregation[tag_name] = set(vals)
+        entities = groupings['cellLines' if tag_type == 'cell_lines'
+                             else 'drugs']
+        # Drug combinations have tuple IDs, so are never tagged
+        tagged = set(entity_ids.tolist())
+        aggregation[TAG_EVERYTHING_ELSE_LABEL] = [
+            e['name'] for e in entities if e['id'] not in tagged]
+        entity_ids = [e['id'] for e in entities]
+    else:
+        entity_ids = entity_ids.tolist()
+
+    for tag in tags:
+        tag_name = '{} [{}]'.format(tag.tag_name, tag.tag_category) \
+            if use_cats else tag.tag_name
+        aggregation.setdefault(tag_name, set()).update(
+            tag_index.names[e] for e in tag.entity_ids.tolist())
 
     return entity_ids, aggregation
 
@@ -326,8 +788,10 @@ def _make_tags_unique(tags):
     return new_tags
 
 
-def _drug_combination_heatmap(request, dataset, drug_id, cell_line_id,
+def _drug_combination_heatmap(params, dataset, drug_id, cell_line_id,
                               template):
+    from thunor.plots import plot_drug_combination_heatmap
+
     if not all(isinstance(d, collections.Sequence) for d in drug_id):
         return HttpResponse(
             'Please select either one or more individual drugs, or a '
@@ -341,17 +805,17 @@ def _drug_combination_heatmap(request, dataset, drug_id, cell_line_id,
         return HttpResponse('Please select a single cell line for drug '
                             'combination plots', status=400)
 
-    color_by = request.GET.get('colorBy', 'off')
+    color_by = params.get('colorBy', 'off')
     if color_by != 'off':
         return HttpResponse('Color overlay must be set to default for drug '
                             'combination heat plots', status=400)
 
-    response_metric = request.GET.get('drMetric', 'dip')
+    response_metric = params.get('drMetric', 'dip')
     if response_metric != 'dip':
         return HttpResponse('Viability drug combination plots are not '
                             'supported', status=400)
 
-    dip_absolute = request.GET.get('drcType', 'rel') == 'abs'
+    dip_absolute = params.get('drcType', 'rel') == 'abs'
     if dip_absolute:
         return HttpResponse('Must use relative DIP rate for drug combination '
                             'heat plots', status=400)
@@ -373,16 +837,21 @@ def _drug_combination_heatmap(request, dataset, drug_id, cell_line_id,
     )
 
 
-def _dose_response_plot(request, dataset, dataset2_id,
-                        permission_required, drug_id, cell_line_id,
-                        plot_type, template=default_plotly_template):
-    if dataset2_id is not None:
-        try:
-            dataset2 = HTSDataset.objects.get(pk=dataset2_id)
-        except HTSDataset.DoesNotExist:
-            raise Http404()
+def _dose_response_plot(request, params, plot_data, dataset, dataset2_id,
+                        drug_id, cell_line_id, plot_type,
+                        template=default_plotly_template, table=False):
+    from thunor.plots import (
+        E_REGEX,
+        E_REL_REGEX,
+        EC_REGEX,
+        IC_REGEX,
+        CannotPlotError,
+        plot_drc,
+        plot_drc_params,
+    )
 
-        _assert_has_perm(request, dataset2, permission_required)
+    if dataset2_id is not None:
+        dataset2 = plot_data.dataset(dataset2_id)
 
         if dataset.name == dataset2.name:
             return HttpResponse(
@@ -393,13 +862,13 @@ def _dose_response_plot(request, dataset, dataset2_id,
     datasets = dataset if not dataset2_id else [dataset,
                                                 dataset2]
 
-    color_by = request.GET.get('colorBy', 'off')
+    color_by = params.get('colorBy', 'off')
     if color_by == 'off':
         color_by = None
 
-    drug_tag_ids = [int(dt) for dt in request.GET.getlist('dT')]
+    drug_tag_ids = [int(dt) for dt in params.getlist('dT')]
     color_groups = None
-    aggregate_drugs = request.GET.get('aggregateDrugs', False) == "true"
+    aggregate_drugs = params.get('aggregateDrugs', False) == "true"
     if not drug_id and drug_tag_ids:
         drug_id, drug_groups = _process_aggreate(
             request, 'drugs', drug_tag_ids,
@@ -411,8 +880,8 @@ def _dose_response_plot(request, dataset, dataset2_id,
         if color_by == 'dr':
             color_groups = drug_groups
 
-    cell_line_tag_ids = [int(ct) for ct in request.GET.getlist('cT')]
-    aggregate_cell_lines = request.GET.get('aggregateCellLines', False) \
+    cell_line_tag_ids = [int(ct) for ct in params.getlist('cT')]
+    aggregate_cell_lines = params.get('aggregateCellLines', False) \
                            == "true"
     if not cell_line_id and cell_line_tag_ids:
         cell_line_id, cell_line_groups = _process_aggreate(
@@ -451,18 +920,18 @@ def _dose_response_plot(request, dataset, dataset2_id,
         return HttpResponse('Please enter at least one drug',
                             status=400)
 
-    response_metric = request.GET.get('drMetric', 'dip')
+    response_metric = params.get('drMetric', 'dip')
     if response_metric not in ('dip', 'viability', 'compare'):
         return HttpResponse('Unknown metric. Supported values: dip, '
                             'viability, compare.', status=400)
 
     def _setup_dr_par(name, needs_toggle=False):
         if needs_toggle and \
-                request.GET.get(name + 'Toggle', 'off') != 'on':
+                params.get(name + 'Toggle', 'off') != 'on':
             return None
-        par_name = request.GET.get(name, None)
+        par_name = params.get(name, None)
         if par_name is not None and '_custom' in par_name:
-            rep_value = request.GET.get(name + 'Custom', None)
+            rep_value = params.get(name + 'Custom', None)
             if int(rep_value) < 0:
                 raise ValueError()
             par_name = par_name.replace('_custom', rep_value)
@@ -567,7 +1036,7 @@ def _dose_response_plot(request, dataset, dataset2_id,
         all_metrics = (response_metric, )
 
     try:
-        base_params = [df_curve_fits(
+        base_params = [plot_data.curve_fits(
             dataset_ids, metric, drug_id, cell_line_id)
             for metric in all_metrics]
     except NoDataException:
@@ -575,6 +1044,19 @@ def _dose_response_plot(request, dataset, dataset2_id,
             'No data found for this request. This drug/cell '
             'line/assay combination may not exist.', status=400)
 
+    if all(bp.attrs['fit_params_precomputed'] for bp in base_params):
+        # The standard parameters were stored when the curves were fitted,
+        # so only custom values need calculating
+        need_aa = need_hill = need_emax = need_einf = False
+        ic_concentrations.discard(50)
+        ec_concentrations.discard(50)
+        # As below, but with AA warnings recorded at fit time
+        if plot_type == 'drpar' and (dr_par == 'aa' or dr_par_two == 'aa'):
+            for bp in base_params:
+                aa_warnings = bp['aa_warning'].dropna()
+                if not aa_warnings.empty:
+                    return HttpResponse(aa_warnings.iloc[0], status=400)
+
     include_response_values = False
 
     ctrl_resp_data = None
@@ -634,7 +1116,6 @@ def _dose_response_plot(request, dataset, dataset2_id,
 
     if response_metric == 'compare':
         # Create new dataframe
-        import pandas as pd
         fit_params = pd.concat(
             [fit_params[0]['label'],
              fit_params[0][dr_par], fit_params[1][dr_par]],
@@ -655,6 +1136,15 @@ def _dose_response_plot(request, dataset, dataset2_id,
             return HttpResponse('Dose response parameter is a required field',
                                 status=400)
 
+        if table and not aggregate_cell_lines and not aggregate_drugs:
+            columns = [dr_par]
+            for par in (dr_par_two, dr_par_order):
+                if par is not None and par != 'label' and par not in columns:
+                    columns.append(par)
+            fit_params = fit_params[columns]
+            fit_params.attrs['title'] = 'Dose response parameters'
+            return fit_params
+
         try:
             plot_fig = plot_drc_params(
                 fit_params,
@@ -671,7 +1161,7 @@ def _dose_response_plot(request, dataset, dataset2_id,
         except CannotPlotError as e:
             return HttpResponse(str(e), status=400)
     else:
-        dip_absolute = request.GET.get('drcType', 'rel') == 'abs'
+        dip_absolute = params.get('drcType', 'rel') == 'abs'
         plot_fig = plot_drc(
             fit_params,
             is_absolute=dip_absolute,
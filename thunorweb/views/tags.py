@@ -1,6 +1,8 @@
 import collections
 import logging
+import uuid
 
+import numpy as np
 import pandas as pd
 from django.contrib.auth.models import Group
 from django.db import transaction
@@ -15,11 +17,141 @@ from guardian.shortcuts import (
     remove_perm,
 )
 
+from thunorweb.caching import tiered_cache
 from thunorweb.models import CellLine, CellLineTag, Drug, DrugTag
+from thunorweb.permissions import get_permissions, invalidate_permissions
 from thunorweb.views import login_required_unless_public
 
 logger = logging.getLogger(__name__)
 TAG_EVERYTHING_ELSE = -1
+# Rows per INSERT statement when importing tag memberships
+TAG_MEMBERSHIP_BATCH_SIZE = 5000
+# Changed whenever any tag is modified, invalidating all tag indexes
+TAG_INDEX_VERSION_CACHE_KEY = 'thunor_tag_index_version'
+TAG_INDEX_CACHE_TIMEOUT = 86400
+
+# A tag in a TagIndex, with the IDs of its entities as a sorted numpy array
+IndexedTag = collections.namedtuple(
+    'IndexedTag', 'id tag_category tag_name entity_ids')
+# The tags of one type visible to a user (owned, or shared with them). tags
+# maps tag IDs to IndexedTags, names maps entity IDs to names. version and
+# shared_tags record what the index was built from.
+#
+# entity_ids, entity_offsets and entity_tag_ids are the inverse mapping, from
+# entities to tags, as numpy arrays: the tags of entity entity_ids[i] are
+# entity_tag_ids[entity_offsets[i]:entity_offsets[i + 1]]. entity_ids is
+# sorted.
+TagIndex = collections.namedtuple(
+    'TagIndex', 'version shared_tags tags names entity_ids entity_offsets '
+                'entity_tag_ids')
+
+
+def invalidate_tag_index():
+    """ Discard the cached tag indexes for all users """
+    tiered_cache.set(TAG_INDEX_VERSION_CACHE_KEY, uuid.uuid4().hex,
+                     timeout=None)
+
+
+def get_tag_index(request, tag_type):
+    """
+    Get the tags visible to the user making a request, with their entities
+
+    The index is cached per user until a tag is modified, or the tags
+    shared with the user change.
+
+    Parameters
+    ----------
+    request: django.http.HttpRequest
+        The request
+    tag_type: str
+        'cell_lines' or 'drugs'
+
+    Returns
+    -------
+    TagIndex
+        The user's tag index
+    """
+    if tag_type == 'cell_lines':
+        tag_cls = CellLineTag
+        shared_tags = get_permissions(request).cell_line_tags
+    else:
+        tag_cls = DrugTag
+        shared_tags = get_permissions(request).drug_tags
+
+    cache_key = 'tag_index_{}_{}'.format(
+        tag_type,
+        request.user.id if request.user.is_authenticated else 'public')
+    version = tiered_cache.get(TAG_INDEX_VERSION_CACHE_KEY)
+    tag_index = tiered_cache.get(cache_key)
+    if tag_index is not None and tag_index.version == version and \
+            tag_index.shared_tags == shared_tags:
+        return tag_index
+
+    perm_filter = Q(id__in=shared_tags)
+    if request.user.is_authenticated:
+        perm_filter |= Q(owner=request.user)
+
+    tag_info = {}
+    entity_ids = collections.defaultdict(list)
+    names = {}
+    member_tag_ids = []
+    member_ent_ids = []
+    for tag_id, tag_category, tag_name, ent_id, ent_name in \
+            tag_cls.objects.filter(perm_filter).values_list(
+                'id', 'tag_category', 'tag_name', tag_type + '__id',
+                tag_type + '__name'):
+        tag_info[tag_id] = (tag_category, tag_name)
+        if ent_id is not None:
+            entity_ids[tag_id].append(ent_id)
+            names[ent_id] = ent_name
+            member_tag_ids.append(tag_id)
+            member_ent_ids.append(ent_id)
+
+    # Group the memberships by entity for the inverse mapping
+    member_tag_ids = np.array(member_tag_ids, dtype=np.int64)
+    member_ent_ids = np.array(member_ent_ids, dtype=np.int64)
+    order = np.lexsort((member_tag_ids, member_ent_ids))
+    index_ent_ids, ent_counts = np.unique(member_ent_ids[order],
+                                          return_counts=True)
+
+    tag_index = TagIndex(
+        version=version,
+        shared_tags=shared_tags,
+        tags={tag_id: IndexedTag(tag_id, tag_category, tag_name, np.unique(
+                  np.array(entity_ids[tag_id], dtype=np.int64)))
+              for tag_id, (tag_category, tag_name) in tag_info.items()},
+        names=names,
+        entity_ids=index_ent_ids,
+        entity_offsets=np.concatenate(([0], np.cumsum(ent_counts))),
+        entity_tag_ids=member_tag_ids[order]
+    )
+    tiered_cache.set(cache_key, tag_index, timeout=TAG_INDEX_CACHE_TIMEOUT)
+
+    return tag_index
+
+
+def tags_for_entities(request, tag_type, entity_ids):
+    """
+    Get the user's visible tags which contain any of the given entities
+
+    Tags are sorted by category, then name.
+    """
+    tag_index = get_tag_index(request, tag_type)
+    entity_ids = np.asarray(entity_ids, dtype=np.int64)
+
+    # Find the entities in the index, then gather their slices of tag IDs
+    positions = np.searchsorted(tag_index.entity_ids, entity_ids)
+    found = positions < len(tag_index.entity_ids)
+    found[found] = tag_index.entity_ids[positions[found]] == entity_ids[found]
+    positions = positions[found]
+    starts = tag_index.entity_offsets[positions]
+    lengths = tag_index.entity_offsets[positions + 1] - starts
+    member_idx = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) \
+        + np.arange(lengths.sum())
+    tag_ids = np.unique(tag_index.entity_tag_ids[member_idx])
+
+    tags = [tag_index.tags[tag_id] for tag_id in tag_ids.tolist()]
+    return sorted(tags, key=lambda tag: (tag.tag_category, tag.tag_name))
 
 
 @login_required_unless_public
@@ -212,6 +344,8 @@ def ajax_create_tag(request):
         else:
             tag.cell_lines.set(entity_ids)
 
+    transaction.on_commit(invalidate_tag_index)
+
     return JsonResponse({
         'success': True,
         'tagId': tag.id,
@@ -247,6 +381,8 @@ def ajax_rename_tag(request):
     if n_updated == 0:
         return JsonResponse({'error': 'Tag not found'}, status=404)
 
+    transaction.on_commit(invalidate_tag_index)
+
     return JsonResponse({
         'success': True,
         'tagId': tag_id,
@@ -290,6 +426,8 @@ def ajax_delete_tag(request):
                                       'don\'t have permission to delete (some '
                                       'of) them'}, status=400)
 
+    transaction.on_commit(invalidate_tag_index)
+
     return JsonResponse({'success': True, 'tagId': tag_id})
 
 
@@ -349,6 +487,18 @@ def ajax_upload_tagfile(request, tag_type):
             return JsonResponse({'error': 'Column cell_line not found'},
                                 status=400)
 
+        # Skip empty rows, but reject rows with some of these cells blank,
+        # which would otherwise be left out of the tag groups
+        key_cols = ['tag_name', 'tag_category', ent_col]
+        csv = csv.dropna(subset=key_cols, how='all')
+        blank_rows = csv[key_cols].isna().any(axis=1)
+        if blank_rows.any():
+            transaction.set_rollback(True)
+            return JsonResponse({
+                'error': 'Blank tag_name, tag_category or {} on line {}'
+                         .format(ent_col, blank_rows.idxmax() + 2)
+            }, status=400)
+
         csv['ent_lower'] = csv[ent_col].str.lower()
         orig_name_mapping = csv[['ent_lower', ent_col]]
 
@@ -410,16 +560,22 @@ def ajax_upload_tagfile(request, tag_type):
             ))
         TagClass.objects.bulk_create(tags)
 
-        for idx, x in enumerate(grpby):
-            grp, entities = x
-
-            tag = tags[idx]
-            entity_ids = [ent_mapping[e] for e in entities['ent_lower']]
+        # Insert the tag memberships for all of the tags at once. Groups are
+        # numbered in the same (sorted) order as they were iterated above.
+        m2m_field = TagClass._meta.get_field(tag_type)
+        Through = m2m_field.remote_field.through
+        tag_col = m2m_field.m2m_column_name()
+        ent_id_col = m2m_field.m2m_reverse_name()
+        Through.objects.bulk_create(
+            (Through(**{tag_col: tags[tag_idx].id, ent_id_col: ent_id})
+             for tag_idx, ent_id in zip(
+                grpby.ngroup().astype(int).tolist(),
+                csv['ent_lower'].map(ent_mapping).tolist())),
+            batch_size=TAG_MEMBERSHIP_BATCH_SIZE,
+            ignore_conflicts=True
+        )
 
-            if tag_type == 'drugs':
-                tag.drugs.set(entity_ids)
-            else:
-                tag.cell_lines.set(entity_ids)
+    transaction.on_commit(invalidate_tag_index)
 
     return JsonResponse({'success': True, 'entitiesCreated': ents_created})
 
@@ -453,6 +609,8 @@ def ajax_assign_tag(request):
     else:
         tag.cell_lines.set(entity_ids)
 
+    transaction.on_commit(invalidate_tag_index)
+
     logger.info('Tag modified', extra={'request': request})
 
     return JsonResponse({
@@ -497,6 +655,8 @@ def ajax_set_tag_group_permission(request):
     # Assign or remove the permission as requested
     permission_fn = assign_perm if state else remove_perm
     permission_fn('view', group, tags)
+    invalidate_permissions(request)
+    transaction.on_commit(invalidate_tag_index)
 
     return JsonResponse({'success': True})
 
@@ -583,4 +743,6 @@ def ajax_copy_tags(request):
             }, status=409)
         getattr(new_tag, entity_lbl).set(entity_ids)
 
+    transaction.on_commit(invalidate_tag_index)
+
     return JsonResponse({'success': True})
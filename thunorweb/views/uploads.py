@@ -0,0 +1,228 @@
+"""
+Resumable, chunked plate file uploads
+
+Large files are uploaded in a series of requests, each small enough to get
+past proxy body size limits and timeouts:
+
+1. ``ajax_upload_init`` creates an upload for a dataset, given the file's
+   name and size.
+2. ``ajax_upload_append`` writes the request body at the given offset.
+   After a dropped connection, ``ajax_upload_status`` gives the offset to
+   resume from; appends at any other offset are rejected.
+3. ``ajax_upload_finalize`` checks the file is complete (and optionally its
+   SHA-256), then hands it off to be parsed in the background. Progress is
+   polled with ``ajax_upload_status``.
+"""
+import hmac
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.http import JsonResponse
+from django.shortcuts import Http404
+from django.urls import reverse
+
+from thunorweb.models import ChunkedUpload, HTSDataset
+from thunorweb.tasks import process_chunked_upload
+from thunorweb.uploadhandlers import HASH_CHUNK_SIZE, file_sha256
+
+logger = logging.getLogger(__name__)
+
+HTTP_CONFLICT = 409
+HTTP_ACCEPTED = 202
+HTTP_REQUEST_TOO_LARGE = 413
+
+
+def _upload_json(upload):
+    return {
+        'uploadId': str(upload.id),
+        'fileName': upload.file_name,
+        'size': upload.size,
+        'offset': upload.offset,
+        'status': upload.status,
+        'result': upload.result,
+        'maxChunkSize': settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE,
+        'statusUrl': reverse('thunorweb:ajax_upload_status',
+                             args=[upload.id])
+    }
+
+
+def _get_upload(request, upload_id):
+    try:
+        return ChunkedUpload.objects.get(
+            id=upload_id, dataset__owner_id=request.user.id,
+            dataset__deleted_date=None)
+    except ChunkedUpload.DoesNotExist:
+        raise Http404()
+
+
+def _locked_upload(request, upload_id):
+    """ Get an upload still receiving data, locked until the transaction ends """
+    try:
+        return ChunkedUpload.objects.select_for_update(of=('self', )).get(
+            id=upload_id, dataset__owner_id=request.user.id,
+            dataset__deleted_date=None,
+            status=ChunkedUpload.STATUS_UPLOADING)
+    except ChunkedUpload.DoesNotExist:
+        raise Http404()
+
+
+def _process_in_thread(upload_id):
+    def run():
+        try:
+            process_chunked_upload(upload_id)
+        except Exception:
+            logger.exception('Error processing chunked upload %s', upload_id)
+        finally:
+            # The thread has its own database connection
+            connection.close()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def ajax_upload_init(request):
+    if not request.user.is_authenticated:
+        return JsonResponse({}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST request required'}, status=405)
+
+    try:
+        dataset = HTSDataset.objects.get(
+            owner=request.user, id=request.POST['dataset_id'],
+            deleted_date=None)
+        file_name = request.POST['file_name']
+        size = int(request.POST['size'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'dataset_id, file_name and size are '
+                                      'required'}, status=400)
+    except HTSDataset.DoesNotExist:
+        raise Http404()
+
+    if size <= 0 or size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        return JsonResponse({'error': 'File size must be between 1 and {} '
+                                      'bytes'.format(
+                                          settings.CHUNKED_UPLOAD_MAX_SIZE)},
+                            status=400)
+
+    upload = ChunkedUpload.objects.create(dataset=dataset,
+                                          file_name=os.path.basename(
+                                              file_name),
+                                          size=size)
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(upload.path, 'wb').close()
+
+    return JsonResponse(_upload_json(upload))
+
+
+def ajax_upload_status(request, upload_id):
+    if not request.user.is_authenticated:
+        return JsonResponse({}, status=401)
+
+    return JsonResponse(_upload_json(_get_upload(request, upload_id)))
+
+
+def ajax_upload_append(request, upload_id):
+    """
+    Write the request body to an upload, at the "offset" GET parameter
+
+    The offset must match the amount received so far. If it doesn't (e.g.
+    the response to an earlier append was lost), the response is 409
+    Conflict, with the offset to continue from.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST request required'}, status=405)
+
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'offset and Content-Length are '
+                                      'required'}, status=400)
+    if length > settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE:
+        return JsonResponse({'error': 'Chunks must be at most {} '
+                                      'bytes'.format(
+                                          settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE)},
+                            status=HTTP_REQUEST_TOO_LARGE)
+
+    with transaction.atomic():
+        # Locked, so concurrent appends to one upload are serialised
+        upload = _locked_upload(request, upload_id)
+        if offset != upload.offset:
+            return JsonResponse(dict(_upload_json(upload),
+                                     error='Expected offset {}'.format(
+                                         upload.offset)),
+                                status=HTTP_CONFLICT)
+        if offset + length > upload.size:
+            return JsonResponse({'error': 'Chunk extends past the end of '
+                                          'the file'}, status=400)
+
+        # Anything past the offset is left over from an interrupted
+        # append, so is overwritten. The body is copied in pieces, rather
+        # than read into memory.
+        received = 0
+        with open(upload.path, 'r+b') as f:
+            f.seek(offset)
+            while received < length:
+                data = request.read(min(HASH_CHUNK_SIZE, length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+        if received != length:
+            return JsonResponse({'error': 'Incomplete chunk'}, status=400)
+
+        upload.offset = offset + length
+        upload.save(update_fields=['offset', 'modified_date'])
+
+    return JsonResponse(_upload_json(upload))
+
+
+def ajax_upload_finalize(request, upload_id):
+    """
+    Check an upload is complete, and queue it for parsing
+
+    An optional "sha256" POST value is compared with the received file. On
+    a mismatch, the upload is reset so it can be sent again.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST request required'}, status=405)
+
+    with transaction.atomic():
+        upload = _locked_upload(request, upload_id)
+        if upload.offset != upload.size:
+            return JsonResponse(dict(_upload_json(upload),
+                                     error='Upload is incomplete'),
+                                status=HTTP_CONFLICT)
+
+        with open(upload.path, 'r+b') as f:
+            # Discard anything left over from interrupted appends
+            f.truncate(upload.size)
+            sha256 = file_sha256(File(f))
+
+        expected = request.POST.get('sha256')
+        if expected is not None and not hmac.compare_digest(
+                expected.lower(), sha256):
+            upload.offset = 0
+            upload.save(update_fields=['offset', 'modified_date'])
+            return JsonResponse(dict(_upload_json(upload),
+                                     error='Checksum mismatch, please '
+                                           'upload the file again'),
+                                status=400)
+
+        upload.status = ChunkedUpload.STATUS_PENDING
+        upload.result = {'sha256': sha256}
+        upload.save(update_fields=['status', 'result', 'modified_date'])
+
+        if settings.CHUNKED_UPLOAD_BACKGROUND_THREAD:
+            transaction.on_commit(lambda: _process_in_thread(upload.id))
+
+    logger.info('Chunked upload finalized', extra={'request': request})
+
+    return JsonResponse(_upload_json(upload), status=HTTP_ACCEPTED)
@@ -483,7 +483,8 @@ const activate = function() {
 
         $submit.prop("disabled", true).text("Loading...");
         $.ajax({
-            url: ajax.url("get_plot") + "?" + $form.serialize(),
+            url: ajax.url("get_plot") + "?" + $form.serialize() +
+                "&typedArrays=true",
             type: "GET",
             dataType: "json",
             success: function (data) {